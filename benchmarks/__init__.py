@@ -0,0 +1,12 @@
+"""
+Throughput and latency benchmarks of the web and netstring servers and
+proxies over loopback.
+
+Run
+
+    python -m benchmarks --output results.json --baseline baseline.json
+
+to measure every scenario, write the results as JSON and compare them with
+those of an earlier run; see python -m benchmarks --help and
+docs/USAGE.md.
+"""
@@ -0,0 +1,107 @@
+"""
+Run the benchmarks:
+
+    python -m benchmarks [--quick] [--output results.json] [--baseline baseline.json]
+
+Exits with status 1 if a scenario regressed compared to the baseline.
+"""
+import argparse
+import sys
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Measure the web and netstring servers and proxies over loopback.")
+    parser.add_argument("--transports", default="web,netstring", help="comma separated: web, netstring")
+    parser.add_argument("--versions", default="pre1,v1,v2", help="comma separated: pre1, v1, v2")
+    parser.add_argument("--sizes", default="100,4000,64000", help="comma separated payload sizes in bytes")
+    parser.add_argument("-k", "--filter", action="append", default=[],
+                        help="only run scenarios whose name contains this; may be repeated")
+    parser.add_argument("--duration", type=float, default=2.0, help="seconds to measure each scenario")
+    parser.add_argument("--warmup", type=float, default=0.5, help="seconds to call before measuring")
+    parser.add_argument("--concurrency", type=int, default=8, help="calls in flight at once")
+    parser.add_argument("--quick", action="store_true", help="measure briefly, e.g. to check that all scenarios run")
+    parser.add_argument("--reactor", choices=("default", "asyncio"), default="default",
+                        help="the asyncio reactor uses uvloop if it is installed")
+    parser.add_argument("--no-uvloop", action="store_true", help="use the standard asyncio event loop")
+    parser.add_argument("--codec", help="JSON codec to select with jsonrpclib.setCodec, e.g. orjson")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with the results written by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="relative change counted as regression (default: 0.1)")
+    options = parser.parse_args(argv)
+    if options.quick:
+        options.duration, options.warmup = 0.2, 0.05
+    return options
+
+
+def install_reactor(name, uvloop=True):
+    """
+    Install the reactor to measure; this must happen before the reactor is
+    imported.
+    """
+    if name != "asyncio":
+        return
+    from twisted.internet import asyncioreactor
+    loop = None
+    if uvloop:
+        try:
+            import uvloop as _uvloop
+        except ImportError:
+            pass
+        else:
+            loop = _uvloop.new_event_loop()
+    asyncioreactor.install(loop)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    install_reactor(options.reactor, not options.no_uvloop)
+
+    from twisted.internet import defer, task
+    from txjsonrpc_ng import jsonrpclib
+    from . import compare, runner
+
+    if options.codec:
+        jsonrpclib.setCodec(options.codec)
+
+    selected = runner.scenarios(
+        options.transports.split(","),
+        [version for name in options.versions.split(",")
+         for version, version_name in runner.VERSION_NAMES.items() if version_name == name],
+        [int(size) for size in options.sizes.split(",")])
+    if options.filter:
+        selected = [scenario for scenario in selected if any(f in scenario.name for f in options.filter)]
+    if not selected:
+        sys.exit("no scenarios selected")
+    tolerance = compare.TOLERANCE if options.tolerance is None else options.tolerance
+
+    def progress(result):
+        print(compare.format_results([result]).splitlines()[1], flush=True)
+
+    async def run(reactor):
+        print(compare.format_results([]), flush=True)
+        results = await runner.run(selected, options.duration, options.concurrency, options.warmup, progress)
+        report = {
+            "environment": runner.environment(),
+            "settings": {"duration": options.duration, "warmup": options.warmup,
+                         "concurrency": options.concurrency},
+            "results": results,
+        }
+        if options.output:
+            compare.save(options.output, report)
+        if options.baseline:
+            baseline = compare.load(options.baseline)
+            if baseline.get("settings") != report["settings"]:
+                print("warning: the baseline was measured with other settings: %s" % baseline.get("settings"))
+            rows = compare.compare(results, baseline["results"], tolerance)
+            print()
+            print(compare.format_comparison(rows, tolerance))
+            if any(row["regression"] for row in rows):
+                raise SystemExit(1)
+
+    task.react(lambda reactor: defer.ensureDeferred(run(reactor)))
+
+
+if __name__ == "__main__":
+    main()
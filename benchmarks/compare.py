@@ -0,0 +1,78 @@
+"""
+Comparing benchmark results with a baseline.
+"""
+import json
+
+# Relative change of throughput or p99 latency reported as a regression.
+TOLERANCE = 0.1
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(path, report):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare the results of the scenarios measured in both runs; return one
+    row per scenario with the relative change of throughput and p99
+    latency, and whether either got worse by more than tolerance.
+    """
+    base = {result["name"]: result for result in baseline}
+    rows = []
+    for result in results:
+        old = base.get(result["name"])
+        if old is None:
+            continue
+        rps_change = _change(old["rps"], result["rps"])
+        p99_change = _change(old["p99_ms"], result["p99_ms"])
+        rows.append({
+            "name": result["name"],
+            "rps": result["rps"],
+            "rps_change": rps_change,
+            "p99_ms": result["p99_ms"],
+            "p99_change": p99_change,
+            "regression": (rps_change is not None and rps_change < -tolerance)
+                          or (p99_change is not None and p99_change > tolerance)
+                          or result["errors"] > old["errors"],
+        })
+    return rows
+
+
+def _change(old, new):
+    if not old or new is None:
+        return None
+    return new / old - 1
+
+
+def format_results(results):
+    lines = ["%-44s %10s %9s %9s %7s" % ("scenario", "req/s", "p50 ms", "p99 ms", "errors")]
+    for result in results:
+        lines.append("%-44s %10.0f %9s %9s %7d" % (
+            result["name"], result["rps"], _number(result["p50_ms"]), _number(result["p99_ms"]), result["errors"]))
+    return "\n".join(lines)
+
+
+def format_comparison(rows, tolerance=TOLERANCE):
+    lines = ["%-44s %10s %8s %9s %8s" % ("scenario", "req/s", "change", "p99 ms", "change")]
+    for row in rows:
+        lines.append("%-44s %10.0f %8s %9s %8s%s" % (
+            row["name"], row["rps"], _percent(row["rps_change"]), _number(row["p99_ms"]),
+            _percent(row["p99_change"]), "  REGRESSION" if row["regression"] else ""))
+    regressions = sum(row["regression"] for row in rows)
+    lines.append("%d of %d scenarios regressed by more than %.0f%%" % (regressions, len(rows), tolerance * 100))
+    return "\n".join(lines)
+
+
+def _number(value):
+    return "-" if value is None else "%.2f" % value
+
+
+def _percent(change):
+    return "-" if change is None else "%+.1f%%" % (change * 100)
@@ -0,0 +1,187 @@
+"""
+Measuring the requests per second and latency of calls over loopback.
+
+Server and client run on the same reactor, so the numbers include the cost
+of both sides. They are only comparable between runs on the same machine
+with the same settings.
+"""
+import os
+import platform
+import sys
+import time
+from dataclasses import asdict, dataclass
+
+import twisted
+from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater
+
+from txjsonrpc_ng import jsonrpclib
+from txjsonrpc_ng.netstring import jsonrpc as netstring
+from txjsonrpc_ng.web import jsonrpc as web
+
+from . import servers
+
+TRANSPORTS = ("web", "netstring")
+VERSIONS = (jsonrpclib.VERSION_PRE1, jsonrpclib.VERSION_1, jsonrpclib.VERSION_2)
+VERSION_NAMES = {jsonrpclib.VERSION_PRE1: "pre1", jsonrpclib.VERSION_1: "v1", jsonrpclib.VERSION_2: "v2"}
+# The netstring proxy refuses responses of 100000 bytes and more.
+SIZES = (100, 4000, 64000)
+
+
+@dataclass(frozen=True)
+class Scenario:
+    """
+    One combination of transport, protocol version, payload size in bytes,
+    gzip compression of responses (web only) and CacheableResult.
+    """
+    transport: str
+    version: int
+    size: int
+    compression: bool = False
+    cacheable: bool = False
+
+    @property
+    def name(self):
+        return "%s-%s-%dB-%s-%s" % (self.transport, VERSION_NAMES[self.version], self.size,
+                                    "gzip" if self.compression else "identity",
+                                    "cacheable" if self.cacheable else "value")
+
+
+def scenarios(transports=TRANSPORTS, versions=VERSIONS, sizes=SIZES):
+    """
+    Return all scenarios for the given transports, versions and sizes.
+    """
+    return [Scenario(transport, version, size, compression, cacheable)
+            for transport in transports
+            for version in versions
+            for size in sizes
+            for compression in ((False, True) if transport == "web" else (False,))
+            for cacheable in (False, True)]
+
+
+def percentile(values, fraction):
+    """
+    Return the value below which fraction of the sorted values lie, by the
+    nearest-rank method.
+    """
+    if not values:
+        return None
+    rank = max(1, int(fraction * len(values) + 0.999999))
+    return values[min(rank, len(values)) - 1]
+
+
+async def measure(call, duration, concurrency=8, warmup=0.0, clock=time.perf_counter):
+    """
+    Make calls from concurrency loops, first for warmup seconds and then
+    for duration seconds, and return the numbers of the latter.
+    """
+    latencies = []
+    errors = []
+
+    async def loop(deadline, record):
+        while clock() < deadline:
+            start = clock()
+            try:
+                await call()
+            except Exception as error:
+                errors.append(error)
+                continue
+            if record:
+                latencies.append(clock() - start)
+
+    async def run(seconds, record):
+        deadline = clock() + seconds
+        await defer.gatherResults([defer.ensureDeferred(loop(deadline, record)) for _ in range(concurrency)],
+                                  consumeErrors=True)
+
+    if warmup:
+        await run(warmup, False)
+        del errors[:]
+    start = clock()
+    await run(duration, True)
+    elapsed = clock() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": elapsed,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": _ms(percentile(latencies, 0.5)),
+        "p99_ms": _ms(percentile(latencies, 0.99)),
+        "mean_ms": _ms(sum(latencies) / len(latencies) if latencies else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+async def run_scenario(scenario, duration, concurrency=8, warmup=0.0):
+    """
+    Serve the scenario on a loopback port, measure calls to it and return
+    the result as a dict.
+    """
+    if scenario.transport == "web":
+        port = reactor.listenTCP(0, web.JSONRPCSite(servers.WebServer()), interface="127.0.0.1")
+        proxy = web.Proxy("http://127.0.0.1:%d/" % port.getHost().port, version=scenario.version,
+                          compress=["gzip"] if scenario.compression else False, max_in_flight=concurrency)
+    else:
+        port = reactor.listenTCP(0, servers.netstring_factory(scenario.version), interface="127.0.0.1")
+        proxy = netstring.Proxy("127.0.0.1", port.getHost().port, version=scenario.version, persistent=True)
+    method = "cacheable" if scenario.cacheable else "payload"
+
+    def call():
+        return proxy.callRemote(method, scenario.size)
+
+    try:
+        # Check that the scenario works at all before measuring it.
+        if len(await call()) != len(servers.payload(scenario.size)):
+            raise AssertionError("%s: unexpected result" % scenario.name)
+        numbers = await measure(call, duration, concurrency, warmup)
+    finally:
+        if scenario.transport == "web":
+            await proxy.pool.closeCachedConnections()
+        else:
+            proxy.disconnect()
+        await port.stopListening()
+        # Let the connections close before the next scenario.
+        await deferLater(reactor, 0.01)
+    return {"name": scenario.name, **asdict(scenario), **numbers}
+
+
+async def run(scenarios, duration, concurrency=8, warmup=0.0, progress=None):
+    """
+    Measure each of scenarios in turn; return the list of results. progress
+    is called with each result.
+    """
+    results = []
+    for scenario in scenarios:
+        result = await run_scenario(scenario, duration, concurrency, warmup)
+        results.append(result)
+        if progress is not None:
+            progress(result)
+    return results
+
+
+def environment():
+    """
+    Return what the results depend on besides the code.
+    """
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "twisted": twisted.__version__,
+        "reactor": "%s.%s" % (type(reactor).__module__, type(reactor).__name__),
+        "event_loop": _event_loop(),
+        "codec": jsonrpclib.getCodec().name,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "argv": sys.argv[1:],
+    }
+
+
+def _event_loop():
+    loop = getattr(reactor, "_asyncioEventloop", None)
+    return None if loop is None else "%s.%s" % (type(loop).__module__, type(loop).__name__)
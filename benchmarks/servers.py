@@ -0,0 +1,58 @@
+"""
+The servers measured by the benchmarks.
+
+Both return a payload of about the requested size, either as a plain value
+which is serialized for every call or as a CacheableResult which is
+serialized once. Payloads are built once per size, so building them is not
+measured.
+"""
+import functools
+
+from txjsonrpc_ng import jsonrpclib
+from txjsonrpc_ng.netstring import jsonrpc as netstring
+from txjsonrpc_ng.web import jsonrpc as web
+from txjsonrpc_ng.web.data import CacheableResult
+
+_payloads = {}
+_cacheable = {}
+
+
+def payload(size):
+    """
+    Return a list of records which serializes to about size bytes.
+    """
+    if size not in _payloads:
+        def record(i):
+            return {"id": i, "name": "item-%06d" % i, "price": i * 0.25, "tags": ["a", "b"]}
+
+        count = max(1, size // (len(jsonrpclib.dumpb(record(0))) + 1))
+        _payloads[size] = [record(i) for i in range(count)]
+    return _payloads[size]
+
+
+class Methods:
+
+    def jsonrpc_payload(self, size):
+        return payload(size)
+
+    def jsonrpc_cacheable(self, size):
+        if size not in _cacheable:
+            _cacheable[size] = CacheableResult(payload(size))
+        return _cacheable[size]
+
+
+class WebServer(Methods, web.JSONRPC):
+    pass
+
+
+class NetstringServer(Methods, netstring.JSONRPC):
+    pass
+
+
+def netstring_factory(version=jsonrpclib.VERSION_2):
+    """
+    Return a factory of netstring servers replying in the given protocol
+    version, which unlike the web server does not follow the request.
+    """
+    # Allow requests beyond the default 1024 bytes.
+    return netstring.RPCFactory(functools.partial(NetstringServer, version), maxLength=1024 * 1024)
@@ -4,14 +4,20 @@
 Test JSON-RPC over TCP support.
 """
 
+import functools
+
 import pytest
-from twisted.internet import reactor, defer
+from twisted.internet import protocol, reactor, defer
+from twisted.internet.task import deferLater
+from twisted.protocols import basic
 from twisted.trial import unittest
 
 from txjsonrpc_ng import jsonrpclib
-from txjsonrpc_ng.jsonrpclib import VERSION_2
+from txjsonrpc_ng.jsonrpclib import VERSION_1, VERSION_2
+from txjsonrpc_ng.metrics import Metrics
 from txjsonrpc_ng.netstring import jsonrpc
 from txjsonrpc_ng.netstring.jsonrpc import ( JSONRPC, Proxy, QueryFactory)
+from txjsonrpc_ng.web.data import CacheableResult, RawJSON
 
 
 class RuntimeErrorTest(RuntimeError):
@@ -106,6 +112,7 @@ class TestJsonRPC:
     @pytest.mark.parametrize("method, args, expected", (
             ("add", (2, 3), 5),
             ("defer", ("a",), "a"),
+            ("defer", ("\u00e4\u20ac",), "\u00e4\u20ac"),
             ("dict", ({"a": 1}, "a"), 1),
             ("pair", ("a", 1), ["a", 1]),
             ("complex", (), {"a": ["b", "c", 12, []], "D": "foo"})
@@ -128,6 +135,116 @@ class TestJsonRPC:
         assert exc.faultCode == code
 
 
+class TestBatch:
+
+    async def testBatch(self, proxy):
+        calls = proxy.batch().call("add", 1, 2).call("defer", "a").call("fault").send()
+
+        assert await calls[0] == 3
+        assert await calls[1] == "a"
+        with pytest.raises(jsonrpclib.Fault) as exc_info:
+            await calls[2]
+        assert exc_info.value.faultCode == 12
+
+    async def testPersistentBatch(self, host_port):
+        proxy = Proxy("127.0.0.1", host_port, version=VERSION_2, persistent=True)
+        try:
+            single = proxy.callRemote("add", 5, 5)
+            calls = proxy.callRemoteBatch(("add", 1, 2), ("pair", "a", 1))
+            results = await defer.gatherResults(calls + [single])
+        finally:
+            proxy.disconnect()
+        assert results == [3, ["a", 1], 10]
+
+
+class BatchError(basic.NetstringReceiver):
+    """
+    Answer every request with an error for a whole batch.
+    """
+
+    def stringReceived(self, string):
+        self.sendString(b'{"jsonrpc": "2.0", "error": {"code": -32600, "message": "invalid"}, "id": null}')
+
+
+class RawClient(basic.NetstringReceiver):
+
+    def __init__(self):
+        self.replies = defer.DeferredQueue()
+
+    def stringReceived(self, string):
+        self.replies.put(string)
+
+
+class TestBatchErrors:
+
+    async def test_version_1_server(self):
+        # Batch replies are JSON-RPC 2.0 whatever the version of the server.
+        server = reactor.listenTCP(0, jsonrpc.RPCFactory(functools.partial(ResourceForTest, VERSION_1)),
+                                   interface="127.0.0.1")
+        proxy = Proxy("127.0.0.1", server.getHost().port, version=VERSION_2, persistent=True)
+        try:
+            calls = proxy.callRemoteBatch(("add", 1, 2), ("pair", "a", 1))
+            assert await defer.gatherResults(calls) == [3, ["a", 1]]
+            assert await proxy.callRemote("add", 2, 2, version=VERSION_1) == 4
+        finally:
+            proxy.disconnect()
+            await server.stopListening()
+
+    async def test_whole_batch_error(self):
+        server = reactor.listenTCP(0, protocol.Factory.forProtocol(BatchError), interface="127.0.0.1")
+        proxy = Proxy("127.0.0.1", server.getHost().port, version=VERSION_2, persistent=True)
+        try:
+            calls = proxy.callRemoteBatch(("add", 1, 2), ("pair", "a", 1))
+            for call in calls:
+                with pytest.raises(jsonrpclib.Fault) as exc_info:
+                    await call
+                assert exc_info.value.faultCode == -32600
+            assert not proxy.connection.batches
+        finally:
+            proxy.disconnect()
+            await server.stopListening()
+
+    async def test_answered_batches_are_dropped(self, host_port):
+        proxy = Proxy("127.0.0.1", host_port, version=VERSION_2, persistent=True)
+        try:
+            await defer.gatherResults(proxy.callRemoteBatch(("add", 1, 2), ("fault",)), consumeErrors=True)
+        except defer.FirstError:
+            pass
+        finally:
+            proxy.disconnect()
+        assert not proxy.connection.batches
+
+    async def test_invalid_json(self, host_port):
+        client = await protocol.ClientCreator(reactor, RawClient).connectTCP("127.0.0.1", host_port)
+        try:
+            client.sendString(b'[{"jsonrpc": "2.0", "method": "add"')
+            reply = jsonrpclib.getCodec().loads(await client.replies.get())
+        finally:
+            client.transport.loseConnection()
+        assert reply["error"]["code"] == jsonrpclib.NOT_WELLFORMED_ERROR == -32700
+        assert reply["id"] is None
+
+    async def raw_call(self, host_port, string):
+        client = await protocol.ClientCreator(reactor, RawClient).connectTCP("127.0.0.1", host_port)
+        try:
+            client.sendString(string)
+            return jsonrpclib.getCodec().loads(await client.replies.get())
+        finally:
+            client.transport.loseConnection()
+
+    async def test_empty_batch(self, host_port):
+        reply = await self.raw_call(host_port, b"[]")
+        assert reply["error"]["code"] == jsonrpclib.INVALID_JSONRPC
+        assert reply["id"] is None
+
+    async def test_invalid_elements(self, host_port):
+        reply = await self.raw_call(
+            host_port, b'[1, {"jsonrpc": "2.0", "method": "add", "params": [1, 2], "id": 7}, "call"]')
+        assert [element.get("id") for element in reply] == [None, 7, None]
+        assert reply[0]["error"]["code"] == reply[2]["error"]["code"] == jsonrpclib.INVALID_JSONRPC
+        assert reply[1]["result"] == 3
+
+
 class TestJSONRPCClassMaxLength:
 
     @pytest.fixture
@@ -190,7 +307,7 @@ class TestJSONRPCIntrospection:
                      'deferFault', 'dict', 'fail', 'fault',
                      'pair', 'system.listMethods',
                      'system.methodHelp',
-                     'system.methodSignature']
+                     'system.methodSignature', 'system.stats']
 
         return d
 
@@ -212,3 +329,272 @@ class TestJSONRPCIntrospection:
     async def testMethodSignature(self, proxy, method_name, expected):
         response = await proxy.callRemote("system.methodSignature", method_name, version=2)
         assert response == expected
+
+
+class TestPersistentProxy(TestJsonRPC):
+
+    @pytest.fixture
+    def proxy(self, host_port):
+        proxy = Proxy("127.0.0.1", host_port, version=VERSION_2, persistent=True)
+        yield proxy
+        proxy.disconnect()
+
+    async def testPipelinedCallsShareConnection(self, proxy):
+        calls = [proxy.callRemote("add", i, i) for i in range(10)]
+        connector = proxy.connection.connector
+
+        results = await defer.gatherResults(calls)
+
+        assert results == [2 * i for i in range(10)]
+        assert proxy.connection.connector is connector
+        assert len(proxy.requests) == 0
+
+    async def testReconnectsAfterConnectionLoss(self, proxy):
+        assert await proxy.callRemote("add", 1, 2) == 3
+        proxy.connection.connection.transport.loseConnection()
+        await deferLater(reactor, 0.05)
+
+        assert proxy.connection.connection is None
+        assert await proxy.callRemote("add", 3, 4) == 7
+
+    async def testVersionPre1MatchesInOrder(self, host_port):
+        proxy = Proxy("127.0.0.1", host_port, persistent=True)
+        try:
+            results = await defer.gatherResults(
+                [proxy.callRemote("add", i, 1) for i in range(3)])
+        finally:
+            proxy.disconnect()
+        assert [result["result"] for result in results] == [1, 2, 3]
+
+    async def testVersionPre1OutOfOrderCompletion(self):
+        server = reactor.listenTCP(0, jsonrpc.RPCFactory(Echo), interface="127.0.0.1")
+        proxy = Proxy("127.0.0.1", server.getHost().port, persistent=True)
+        try:
+            slow = proxy.callRemote("echo", "slow", 0.2)
+            fast = proxy.callRemote("echo", "fast", 0)
+            assert (await slow)["result"] == "slow"
+            assert (await fast)["result"] == "fast"
+        finally:
+            proxy.disconnect()
+            await server.stopListening()
+
+
+class Echo(JSONRPC):
+
+    def jsonrpc_echo(self, value, delay):
+        return deferLater(reactor, delay, lambda: value)
+
+
+class Counter(JSONRPC):
+    instances = 0
+
+    def __init__(self):
+        JSONRPC.__init__(self)
+        Counter.instances += 1
+        self.calls = 0
+
+    def jsonrpc_count(self):
+        self.calls += 1
+        return self.calls
+
+    @jsonrpc.with_protocol
+    def jsonrpc_connection(self, protocol, key, value):
+        previous = getattr(protocol, "value", None)
+        protocol.value = {key: value}
+        return previous
+
+
+class TestSharedHandlers:
+
+    @pytest.fixture
+    def factory(self):
+        Counter.instances = 0
+        factory = jsonrpc.RPCFactory(ResourceForTest, sharedHandlers=True)
+        factory.putSubHandler("counter", Counter)
+        factory.addIntrospection()
+        return factory
+
+    @pytest.fixture
+    def host_port(self, factory):
+        server = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        yield server.getHost().port
+        server.stopListening()
+
+    async def test_handlers_are_shared(self, proxy):
+        assert [await proxy.callRemote("counter.count") for _ in range(3)] == [1, 2, 3]
+        assert Counter.instances == 1
+
+    async def test_per_connection_state(self, host_port):
+        proxy = Proxy("127.0.0.1", host_port, version=VERSION_2, persistent=True)
+        other = Proxy("127.0.0.1", host_port, version=VERSION_2, persistent=True)
+        try:
+            assert await proxy.callRemote("counter.connection", "a", 1) is None
+            assert await other.callRemote("counter.connection", "b", 2) is None
+            assert await proxy.callRemote("counter.connection", "c", 3) == {"a": 1}
+            d, = proxy.callRemoteBatch(("counter.connection", "d", 4))
+            assert await d == {"c": 3}
+        finally:
+            proxy.disconnect()
+            other.disconnect()
+
+    async def test_introspection(self, proxy):
+        methods = await proxy.callRemote("system.listMethods")
+        assert "counter.count" in methods and "add" in methods
+        assert await proxy.callRemote("system.methodHelp", "defer") == "Help for defer."
+
+    async def test_put_sub_handler_affects_new_connections(self, factory, proxy):
+        await proxy.callRemote("counter.count")
+        factory.putSubHandler("other", Counter)
+        assert await proxy.callRemote("other.count") == 1
+        assert Counter.instances == 3
+
+    def test_dispatch_table_is_shared(self, factory, monkeypatch):
+        lookups = []
+        getFunction = Counter._getFunction
+
+        def counting(handler, functionPath):
+            lookups.append(functionPath)
+            return getFunction(handler, functionPath)
+
+        monkeypatch.setattr(Counter, "_getFunction", counting)
+        first, second = factory.buildProtocol(None), factory.buildProtocol(None)
+        assert first._getDispatchEntry("counter.count") is second._getDispatchEntry("counter.count")
+        assert lookups == ["count"]
+        # Methods of the connection itself are still bound per connection.
+        assert first._getDispatchEntry("add").function.__self__ is first
+        assert second._getDispatchEntry("add").function.__self__ is second
+
+    def test_dispatch_table_is_invalidated(self, factory):
+        first, second = factory.buildProtocol(None), factory.buildProtocol(None)
+        counter = first.getSubHandler("counter")
+        assert first._getDispatchEntry("counter.count").function() == 1
+        counter.jsonrpc_count = lambda: "replaced"
+        counter.invalidateDispatchTable()
+        assert second._getDispatchEntry("counter.count").function() == "replaced"
+
+    def test_sub_handlers_are_read_only(self, factory):
+        first, second = factory.buildProtocol(None), factory.buildProtocol(None)
+        with pytest.raises(TypeError):
+            first.putSubHandler("counter", Counter())
+        assert first.getSubHandler("counter") is second.getSubHandler("counter")
+
+
+class Cached(JSONRPC):
+    calls = 0
+
+    @jsonrpc.cached(maxsize=10)
+    def jsonrpc_compute(self, value):
+        Cached.calls += 1
+        return [value]
+
+
+class TestCached:
+
+    @pytest.fixture
+    def host_port(self):
+        Cached.calls = 0
+        Cached.jsonrpc_compute.cache.clear()
+        server = reactor.listenTCP(0, jsonrpc.RPCFactory(Cached), interface="127.0.0.1")
+        yield server.getHost().port
+        server.stopListening()
+
+    async def test_cached(self, proxy):
+        for value in (1, 1, 2, 1):
+            assert await proxy.callRemote("compute", value) == [value]
+        assert Cached.calls == 2
+
+    def test_cacheable_result_for_each_id(self):
+        protocol = Cached()
+        result = CacheableResult({"a": 1})
+        for id in (1, 2):
+            assert jsonrpclib.loadb(protocol._dumps(result, id)) == {"jsonrpc": "2.0", "result": {"a": 1}, "id": id}
+        with pytest.raises(jsonrpclib.Fault) as error:
+            jsonrpclib.loadb(protocol._dumps(CacheableResult(object()), 3))
+        assert error.value.faultCode == JSONRPC.FAILURE
+
+    def test_raw_json(self):
+        protocol = Cached()
+        assert protocol._dumps(RawJSON(b'{"a":  1.50}'), 5) == b'{"jsonrpc":"2.0","result":{"a":  1.50},"id":5}'
+        protocol.version = jsonrpclib.VERSION_PRE1
+        assert protocol._dumps(RawJSON("[1]"), None) == b"[[1]]"
+
+
+class Async(JSONRPC):
+
+    async def jsonrpc_double(self, value):
+        return await deferLater(reactor, 0, lambda: value * 2)
+
+    async def jsonrpc_fault(self):
+        raise jsonrpclib.Fault(42, "async fault")
+
+
+class TestCoroutines:
+
+    @pytest.fixture
+    def host_port(self):
+        server = reactor.listenTCP(0, jsonrpc.RPCFactory(Async), interface="127.0.0.1")
+        yield server.getHost().port
+        server.stopListening()
+
+    async def test_result(self, proxy):
+        assert await proxy.callRemote("double", 21) == 42
+
+    async def test_fault(self, proxy):
+        with pytest.raises(jsonrpclib.Fault, match="async fault"):
+            await proxy.callRemote("fault")
+
+    async def test_batch(self, proxy):
+        calls = proxy.callRemoteBatch(("double", 1), ("double", 2))
+        assert await defer.gatherResults(calls) == [2, 4]
+
+
+class Limited(JSONRPC):
+    pending = []
+
+    @jsonrpc.limited(1, queue_size=0)
+    def jsonrpc_wait(self):
+        Limited.pending.append(defer.Deferred())
+        return Limited.pending[-1]
+
+
+class TestLimited:
+
+    @pytest.fixture
+    def host_port(self):
+        server = reactor.listenTCP(0, jsonrpc.RPCFactory(Limited), interface="127.0.0.1")
+        yield server.getHost().port
+        server.stopListening()
+
+    async def test_overloaded(self, host_port):
+        # Calls of different connections share the limit.
+        first = Proxy("127.0.0.1", host_port, version=VERSION_2).callRemote("wait")
+        for _ in range(500):
+            if Limited.pending:
+                break
+            await deferLater(reactor, 0.01)
+        with pytest.raises(jsonrpclib.Fault) as exc_info:
+            await Proxy("127.0.0.1", host_port, version=VERSION_2).callRemote("wait")
+        assert exc_info.value.faultCode == jsonrpclib.SERVER_OVERLOADED
+        Limited.pending.pop().callback("done")
+        assert await first == "done"
+
+
+class TestMetrics:
+
+    @pytest.fixture
+    def metrics(self):
+        metrics = Metrics()
+        ResourceForTest.metrics = metrics
+        yield metrics
+        del ResourceForTest.metrics
+
+    async def test_calls(self, metrics, proxy):
+        assert await proxy.callRemote("add", 1, 2) == 3
+        d, = proxy.callRemoteBatch(("add", 2, 3))
+        assert await d == 5
+        with pytest.raises(jsonrpclib.Fault):
+            await proxy.callRemote("fail")
+        assert metrics.methods["add"].calls == 2
+        assert metrics.methods["fail"].errors == 1
+        assert metrics.request_bytes.count == 3
+        assert metrics.response_bytes.count == 3
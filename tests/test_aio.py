@@ -0,0 +1,141 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from txjsonrpc_ng.aio import AsyncProxy
+
+# The tests run on the default reactor, so AsyncProxy is tried out with the
+# asyncio reactor in another process.
+SCRIPT = textwrap.dedent("""
+    import asyncio
+    import json
+
+    from twisted.internet import asyncioreactor
+
+    asyncioreactor.install()
+
+    from twisted.internet import defer, task
+    from twisted.web import server
+
+    from txjsonrpc_ng.aio import AsyncProxy, shared_pool
+    from txjsonrpc_ng.jsonrpclib import VERSION_2, Fault
+    from txjsonrpc_ng.netstring import jsonrpc as netstring
+    from txjsonrpc_ng.web.jsonrpc import JSONRPC
+
+
+    class Example(JSONRPC):
+        running = peak = 0
+        cancelled = False
+
+        async def jsonrpc_add(self, a, b):
+            Example.running += 1
+            Example.peak = max(Example.peak, Example.running)
+            await asyncio.sleep(0.01)
+            Example.running -= 1
+            return a + b
+
+        def jsonrpc_fault(self):
+            raise Fault(7, "no")
+
+        async def jsonrpc_sleep(self):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                Example.cancelled = True
+                raise
+
+
+    class NetstringExample(netstring.JSONRPC):
+
+        def jsonrpc_echo(self, value):
+            return value
+
+
+    async def main(reactor):
+        loop = asyncio.get_running_loop()
+        results = {}
+        port = reactor.listenTCP(0, server.Site(Example()), interface="127.0.0.1")
+        url = "http://127.0.0.1:%d/" % port.getHost().port
+        async with AsyncProxy(url, version=VERSION_2, max_in_flight=3) as proxy:
+            results["call"] = await proxy.call("add", 1, 2)
+            results["gather"] = await proxy.gather(*[("add", i, i) for i in range(10)])
+            results["peak"] = Example.peak
+            try:
+                await proxy.call("fault")
+            except Fault as e:
+                results["fault"] = e.faultCode
+            try:
+                await asyncio.wait_for(proxy.call("sleep"), 0.1)
+            except asyncio.TimeoutError:
+                results["timeout"] = True
+            results["partial"] = [
+                str(result) for result in
+                await proxy.gather(("add", 1, 1), ("fault",), return_exceptions=True)]
+            pending = asyncio.ensure_future(proxy.call("sleep"))
+            await asyncio.sleep(0.1)
+        try:
+            await pending
+        except defer.CancelledError:
+            results["closed"] = True
+        for _ in range(100):
+            if Example.cancelled:
+                break
+            await asyncio.sleep(0.01)
+        results["server_cancelled"] = Example.cancelled
+        results["shared_pool"] = proxy.proxy.pool is shared_pool()
+        await shared_pool().closeCachedConnections().asFuture(loop)
+        await port.stopListening().asFuture(loop)
+
+        port = reactor.listenTCP(0, netstring.RPCFactory(NetstringExample), interface="127.0.0.1")
+        netstring_proxy = netstring.Proxy("127.0.0.1", port.getHost().port, version=VERSION_2, persistent=True)
+        async with AsyncProxy(netstring_proxy) as proxy:
+            results["netstring"] = await proxy.gather(("echo", 1), ("echo", "a"))
+        await port.stopListening().asFuture(loop)
+        print(json.dumps(results))
+
+
+    task.react(lambda reactor: defer.Deferred.fromFuture(asyncio.ensure_future(main(reactor))))
+""")
+
+
+@pytest.fixture(scope="module")
+def results():
+    output = subprocess.run([sys.executable, "-c", SCRIPT], capture_output=True, text=True, timeout=60,
+                            env={**os.environ, "PYTHONPATH": os.getcwd()})
+    assert output.returncode == 0, output.stderr
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+class TestAsyncProxy:
+
+    def test_call(self, results):
+        assert results["call"] == 3
+
+    def test_gather(self, results):
+        assert results["gather"] == [2 * i for i in range(10)]
+        # max_in_flight bounds the calls made at once.
+        assert results["peak"] == 3
+
+    def test_fault(self, results):
+        assert results["fault"] == 7
+        assert results["partial"][0] == "2"
+        assert "Fault 7" in results["partial"][1]
+
+    def test_cancel(self, results):
+        assert results["timeout"] is True
+        assert results["closed"] is True
+        assert results["server_cancelled"] is True
+
+    def test_shared_pool(self, results):
+        assert results["shared_pool"] is True
+
+    def test_netstring(self, results):
+        assert results["netstring"] == [1, "a"]
+
+    def test_needs_asyncio_reactor(self):
+        with pytest.raises(RuntimeError):
+            AsyncProxy("http://127.0.0.1:7080/")
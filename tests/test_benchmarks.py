@@ -0,0 +1,124 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+from benchmarks import compare, runner
+from benchmarks.runner import Scenario
+from txjsonrpc_ng.jsonrpclib import VERSION_1, VERSION_2, VERSION_PRE1
+
+
+def result(name, rps, p99_ms, errors=0):
+    return {"name": name, "rps": rps, "p50_ms": p99_ms / 2, "p99_ms": p99_ms, "errors": errors}
+
+
+class TestScenarios:
+
+    def test_names(self):
+        assert Scenario("web", VERSION_2, 4000, True, True).name == "web-v2-4000B-gzip-cacheable"
+        assert Scenario("netstring", VERSION_PRE1, 100).name == "netstring-pre1-100B-identity-value"
+
+    def test_all(self):
+        selected = runner.scenarios()
+        # Compression is only measured for the web transport.
+        assert len(selected) == 3 * 3 * 4 + 3 * 3 * 2
+        assert len({scenario.name for scenario in selected}) == len(selected)
+        assert not any(scenario.compression for scenario in selected if scenario.transport == "netstring")
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert runner.percentile(values, 0.5) == 50
+        assert runner.percentile(values, 0.99) == 99
+        assert runner.percentile(values, 1.0) == 100
+        assert runner.percentile([7], 0.99) == 7
+        assert runner.percentile([], 0.5) is None
+
+
+class TestMeasure:
+
+    async def test_counts(self):
+        calls = []
+
+        async def call():
+            calls.append(True)
+            await deferLater(reactor, 0.001)
+
+        numbers = await runner.measure(call, 0.05, concurrency=2, warmup=0.01)
+        assert 0 < numbers["requests"] < len(calls)
+        assert numbers["errors"] == 0
+        assert numbers["rps"] == numbers["requests"] / numbers["seconds"]
+        assert numbers["p50_ms"] <= numbers["p99_ms"]
+
+    async def test_errors(self):
+        async def call():
+            await deferLater(reactor, 0.001)
+            raise ValueError()
+
+        numbers = await runner.measure(call, 0.02, concurrency=2)
+        assert numbers["requests"] == 0
+        assert numbers["errors"] > 0
+        assert numbers["p99_ms"] is None
+
+    @pytest.mark.parametrize("scenario", (
+        Scenario("web", VERSION_PRE1, 100),
+        Scenario("web", VERSION_2, 4000, compression=True, cacheable=True),
+        Scenario("netstring", VERSION_1, 100, cacheable=True),
+        Scenario("netstring", VERSION_2, 4000),
+    ), ids=lambda scenario: scenario.name)
+    async def test_run_scenario(self, scenario):
+        measured = await runner.run_scenario(scenario, 0.05, concurrency=2)
+        assert measured["name"] == scenario.name
+        assert measured["size"] == scenario.size
+        assert measured["requests"] > 0
+        assert measured["errors"] == 0
+
+
+class TestCompare:
+
+    def test_compare(self):
+        baseline = [result("a", 1000, 2.0), result("b", 1000, 2.0), result("c", 1000, 2.0),
+                    result("d", 1000, 2.0), result("gone", 1000, 2.0)]
+        results = [result("a", 950, 2.1), result("b", 850, 2.0), result("c", 1000, 2.5),
+                   result("d", 1100, 1.0, errors=1), result("new", 1000, 2.0)]
+        rows = compare.compare(results, baseline)
+        assert [row["name"] for row in rows] == ["a", "b", "c", "d"]
+        assert [row["regression"] for row in rows] == [False, True, True, True]
+        assert rows[0]["rps_change"] == pytest.approx(-0.05)
+        assert rows[2]["p99_change"] == pytest.approx(0.25)
+        assert "3 of 4 scenarios regressed by more than 10%" in compare.format_comparison(rows)
+
+    def test_tolerance(self):
+        rows = compare.compare([result("a", 850, 2.0)], [result("a", 1000, 2.0)], tolerance=0.2)
+        assert not rows[0]["regression"]
+
+    def test_missing_latency(self):
+        rows = compare.compare([result("a", 0, 0.0) | {"p99_ms": None}], [result("a", 1000, 2.0)])
+        assert rows[0]["p99_change"] is None
+        assert rows[0]["regression"]
+        assert "-" in compare.format_comparison(rows)
+
+
+def test_command_line(tmp_path):
+    output = tmp_path / "results.json"
+    command = [sys.executable, "-m", "benchmarks", "--duration", "0.05", "--warmup", "0",
+               "--transports", "netstring", "--versions", "v2", "--sizes", "100"]
+    env = {**os.environ, "PYTHONPATH": os.getcwd()}
+    run = subprocess.run(command + ["--output", str(output)], capture_output=True, text=True, timeout=60, env=env)
+    assert run.returncode == 0, run.stderr
+    report = json.loads(output.read_text())
+    assert [measured["name"] for measured in report["results"]] == [
+        "netstring-v2-100B-identity-value", "netstring-v2-100B-identity-cacheable"]
+    assert report["settings"] == {"duration": 0.05, "warmup": 0.0, "concurrency": 8}
+    assert report["environment"]["twisted"]
+
+    # Every scenario is worse than a baseline which is ten times as fast.
+    for measured in report["results"]:
+        measured["rps"] *= 10
+    output.write_text(json.dumps(report))
+    run = subprocess.run(command + ["--baseline", str(output)], capture_output=True, text=True, timeout=60, env=env)
+    assert run.returncode == 1, run.stderr
+    assert "2 of 2 scenarios regressed" in run.stdout
@@ -0,0 +1,292 @@
+import json
+
+import pytest
+from twisted.internet import defer
+
+from txjsonrpc_ng import jsonrpclib
+from txjsonrpc_ng.cache import ResultCache, SingleFlight, cached, single_flight
+from txjsonrpc_ng.jsonrpclib import Fault
+from txjsonrpc_ng.web.data import CacheableResult
+
+
+class Clock:
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResultCache:
+
+    def test_get_put(self):
+        cache = ResultCache()
+        result = CacheableResult("value")
+        assert cache.get("a") is None
+        cache.put("a", result)
+        assert cache.get("a") is result
+        assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "entries": 1, "bytes": 0}
+
+    def test_lru_eviction(self):
+        cache = ResultCache(maxsize=2)
+        for key in "abc":
+            cache.put(key, CacheableResult(key))
+            cache.get("a")
+        assert cache.get("b") is None
+        assert cache.get("a").value == "a"
+        assert cache.get("c").value == "c"
+        assert cache.evictions == 1
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = ResultCache(ttl=10, clock=clock)
+        cache.put("a", CacheableResult("a"))
+        clock.now = 9.9
+        assert cache.get("a") is not None
+        clock.now = 10
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_maxbytes(self):
+        cache = ResultCache(maxbytes=100)
+        for key in "abc":
+            cache.put(key, CacheableResult(key, body=b"x" * 40, compressed_values={("gzip", 0): b"x" * 10}))
+        assert cache.get("a") is None
+        assert cache.nbytes() == 100
+
+
+class Methods:
+
+    def __init__(self):
+        self.calls = 0
+
+    @cached()
+    def jsonrpc_add(self, a, b):
+        self.calls += 1
+        return a + b
+
+    @cached()
+    def jsonrpc_deferred(self, **kwargs):
+        self.calls += 1
+        return defer.succeed(sorted(kwargs))
+
+    @cached()
+    async def jsonrpc_coroutine(self, value):
+        self.calls += 1
+        return [value]
+
+    @cached()
+    def jsonrpc_fault(self):
+        self.calls += 1
+        return Fault(1, "no")
+
+    @cached()
+    def jsonrpc_request(self, request, value):
+        self.calls += 1
+        return value
+
+    # Applied after cached, as with_request would be.
+    jsonrpc_request.with_request = True
+
+
+def with_request(method):
+    method.with_request = True
+    return method
+
+
+class TestCached:
+
+    @pytest.fixture(autouse=True)
+    def clear(self):
+        for method in (Methods.jsonrpc_add, Methods.jsonrpc_deferred, Methods.jsonrpc_coroutine,
+                       Methods.jsonrpc_fault, Methods.jsonrpc_request):
+            method.cache.clear()
+
+    def test_keyed_by_params(self):
+        methods = Methods()
+        assert methods.jsonrpc_add(1, 2).value == 3
+        assert methods.jsonrpc_add(1, 2) is methods.jsonrpc_add(1, 2)
+        assert methods.jsonrpc_add(2, 1).value == 3
+        assert methods.calls == 2
+        assert Methods.jsonrpc_add.cache.stats()["hits"] == 2
+
+    def test_shared_by_instances(self):
+        Methods().jsonrpc_add(1, 2)
+        other = Methods()
+        other.jsonrpc_add(1, 2)
+        assert other.calls == 0
+
+    def test_deferred(self):
+        methods = Methods()
+        first = methods.jsonrpc_deferred(b=1, a=2)
+        assert isinstance(first, defer.Deferred)
+        assert first.result.value == ["a", "b"]
+        assert methods.jsonrpc_deferred(a=2, b=1) is first.result
+        assert methods.calls == 1
+
+    def test_coroutine(self):
+        methods = Methods()
+        first = methods.jsonrpc_coroutine(1)
+        assert isinstance(first, defer.Deferred)
+        assert first.result.value == [1]
+        assert methods.jsonrpc_coroutine(1) is first.result
+        assert methods.calls == 1
+
+    def test_faults_are_not_cached(self):
+        methods = Methods()
+        assert isinstance(methods.jsonrpc_fault(), Fault)
+        assert isinstance(methods.jsonrpc_fault(), Fault)
+        assert methods.calls == 2
+
+    def test_with_request_is_refused(self):
+        # Callers with different requests, e.g. users, must not share a
+        # result.
+        with pytest.raises(TypeError):
+            Methods().jsonrpc_request(object(), 1)
+        with pytest.raises(TypeError):
+            cached()(with_request(lambda self, request: None))
+
+
+class TestSingleFlight:
+
+    @pytest.fixture
+    def flights(self):
+        return SingleFlight()
+
+    def test_concurrent_calls_are_shared(self, flights):
+        calls = []
+
+        def function(value):
+            calls.append(value)
+            calls.append(defer.Deferred())
+            return calls[-1]
+
+        first = flights.call("a", function, 1)
+        second = flights.call("a", function, 1)
+        other = flights.call("b", function, 2)
+        assert len(flights) == 2
+        calls[1].callback({"x": 1})
+        assert first.result is second.result
+        assert first.result.value == {"x": 1}
+        assert not other.called
+        assert len(flights) == 1
+        assert calls[0::2] == [1, 2]
+
+    def test_single_call_result_is_unchanged(self, flights):
+        shared = defer.Deferred()
+        d = flights.call("a", lambda: shared)
+        shared.callback({"x": 1})
+        assert d.result == {"x": 1}
+
+    def test_synchronous_result(self, flights):
+        assert flights.call("a", lambda: 3).result == 3
+        assert len(flights) == 0
+
+    def test_failure(self, flights):
+        shared = defer.Deferred()
+        waiters = [flights.call("a", lambda: shared) for _ in range(2)]
+        shared.errback(ValueError("no"))
+        for waiter in waiters:
+            with pytest.raises(ValueError):
+                waiter.result.raiseException()
+            waiter.addErrback(lambda failure: None)
+
+    def test_cancel(self, flights):
+        shared = defer.Deferred()
+        first = flights.call("a", lambda: shared)
+        second = flights.call("a", lambda: shared)
+        first.cancel()
+        first.addErrback(lambda failure: None)
+        assert not shared.called
+        second.cancel()
+        second.addErrback(lambda failure: None)
+        # The cancellation was consumed by the single flight.
+        assert shared.called and shared.result is None
+        assert len(flights) == 0
+
+    def test_decorator(self):
+        pending = []
+
+        class Methods:
+            @single_flight
+            def jsonrpc_get(self, value):
+                pending.append(defer.Deferred())
+                return pending[-1]
+
+        first = Methods().jsonrpc_get(1)
+        second = Methods().jsonrpc_get(1)
+        assert len(pending) == 1
+        pending[0].callback([1])
+        assert first.result is second.result
+
+    def test_decorator_coroutine(self):
+        pending = []
+
+        class Methods:
+            @single_flight
+            async def jsonrpc_get(self, value):
+                pending.append(defer.Deferred())
+                return await pending[-1]
+
+        first = Methods().jsonrpc_get(1)
+        second = Methods().jsonrpc_get(1)
+        assert len(pending) == 1
+        pending[0].callback([1])
+        assert first.result.value == [1]
+        assert first.result is second.result
+
+
+    def test_decorator_with_request_is_refused(self):
+        with pytest.raises(TypeError):
+            single_flight(with_request(lambda self, request: None))
+
+        class Methods:
+            @single_flight
+            def jsonrpc_get(self, request):
+                return [request]
+
+        # Applied after single_flight, as with_request would be.
+        Methods.jsonrpc_get.with_request = True
+        with pytest.raises(TypeError):
+            Methods().jsonrpc_get(object())
+
+
+class TestCacheableResultSerialize:
+
+    def test_serialized_once(self):
+        result = CacheableResult({"a": [1, 2]})
+        body = result.serialized()
+        assert body == jsonrpclib.dumpb({"a": [1, 2]})
+        assert result.serialized() is body
+
+    @pytest.mark.parametrize("id, version, expected", (
+            (None, jsonrpclib.VERSION_PRE1, [{"a": 1}]),
+            (7, jsonrpclib.VERSION_1, {"result": {"a": 1}, "error": None, "id": 7}),
+            ("x", jsonrpclib.VERSION_2, {"jsonrpc": "2.0", "result": {"a": 1}, "id": "x"}),
+    ))
+    def test_envelope(self, id, version, expected):
+        result = CacheableResult({"a": 1})
+        assert json.loads(result.serialize(id, version)) == expected
+
+    @pytest.mark.parametrize("value", (0, "", [], None, False))
+    def test_falsy_values(self, value):
+        result = CacheableResult(value)
+        assert json.loads(result.serialize(1, jsonrpclib.VERSION_2))["result"] == value
+        assert json.loads(result.serialize(None, jsonrpclib.VERSION_PRE1)) == [value]
+
+    def test_jsonp(self):
+        result = CacheableResult([1])
+        assert result.serialize(3, jsonrpclib.VERSION_2, b"cb") == b'cb({"jsonrpc":"2.0","result":[1],"id":3})'
+
+    def test_etag_independent_of_call(self):
+        result = CacheableResult("value")
+        etag = result.etag
+        result.serialize(1, jsonrpclib.VERSION_2)
+        assert CacheableResult("value").etag == etag
+        assert CacheableResult("other").etag != etag
+
+    def test_nbytes(self):
+        result = CacheableResult("value", compressed_values={("gzip", 0): b"x" * 10,
+                                                             ("gzip", 2): (b"y" * 20, 0, 0)})
+        assert result.nbytes() == 30
+        result.serialized()
+        assert result.nbytes() == 37
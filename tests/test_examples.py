@@ -21,7 +21,7 @@ def preprocess(result):
 
 
 result_subhandled = """
-Result: ['echo', 'math.add', 'system.listMethods', 'system.methodHelp', 'system.methodSignature', 'testing.getList']
+Result: ['echo', 'math.add', 'system.listMethods', 'system.methodHelp', 'system.methodSignature', 'system.stats', 'testing.getList']
 Result: [1, 2, 3, 4, 'a', 'b', 'c', 'd']
 Result: 8
 Result: bite me
@@ -1,10 +1,97 @@
 import pytest
 from pytest_twisted import inlineCallbacks
 
-from txjsonrpc_ng.jsonrpc import BaseProxy, BaseQueryFactory
+from txjsonrpc_ng.jsonrpc import BaseBatch, BaseProxy, BaseQueryFactory, BaseSubhandler, RequestRegistry
+from txjsonrpc_ng import jsonrpclib
 from txjsonrpc_ng.jsonrpclib import Fault, VERSION_PRE1, VERSION_1, VERSION_2
 
 
+@pytest.fixture(autouse=True)
+def json_codec():
+    """
+    The expected payloads are formatted as the standard library does it.
+    """
+    codec = jsonrpclib.getCodec()
+    jsonrpclib.setCodec("json")
+    yield
+    jsonrpclib.setCodec(codec)
+
+
+class Handler(BaseSubhandler):
+
+    def __init__(self):
+        BaseSubhandler.__init__(self)
+        self.lookups = 0
+
+    def _getFunction(self, functionPath):
+        self.lookups += 1
+        return BaseSubhandler._getFunction(self, functionPath)
+
+    def jsonrpc_echo(self, value):
+        return value
+
+    def jsonrpc_flagged(self):
+        pass
+
+    jsonrpc_flagged.with_request = True
+    jsonrpc_flagged.requires_auth = True
+
+
+class TestDispatchTable:
+
+    @pytest.fixture
+    def root(self):
+        root = Handler()
+        child = Handler()
+        child.putSubHandler("grandchild", Handler())
+        root.putSubHandler("child", child)
+        return root
+
+    def test_lookup_is_cached(self, root):
+        entry = root._getDispatchEntry("echo")
+        assert root._getDispatchEntry("echo") is entry
+        assert entry.function(1) == 1
+        assert root.lookups == 1
+
+    def test_nested_path(self, root):
+        entry = root._getDispatchEntry("child.grandchild.echo")
+        assert entry.function.__self__ is root.getSubHandler("child").getSubHandler("grandchild")
+        assert root._getDispatchEntry("child.grandchild.echo") is entry
+        assert root.lookups == 1
+
+    def test_flags(self, root):
+        assert root._getDispatchEntry("echo")[1:] == (False, False)
+        assert root._getDispatchEntry("flagged")[1:] == (True, True)
+
+    def test_errors_are_not_cached(self, root):
+        for _ in range(2):
+            with pytest.raises(jsonrpclib.NoSuchFunction):
+                root._getDispatchEntry("child.missing")
+        assert root.dispatchTable == {}
+
+    def test_put_sub_handler_invalidates(self, root):
+        grandchild = root.getSubHandler("child").getSubHandler("grandchild")
+        root._getDispatchEntry("child.grandchild.echo")
+        replacement = Handler()
+        grandchild.putSubHandler("more", replacement)
+        assert root.dispatchTable == {}
+
+        root._getDispatchEntry("child.grandchild.more.echo")
+        root.getSubHandler("child").putSubHandler("grandchild", Handler())
+        assert root.dispatchTable == {}
+        # The replaced handler no longer invalidates the tree.
+        root._getDispatchEntry("echo")
+        grandchild.putSubHandler("other", Handler())
+        assert "echo" in root.dispatchTable
+
+    def test_cyclic_tree(self):
+        handler = Handler()
+        handler.putSubHandler("self", handler)
+        assert handler._getDispatchEntry("self.self.echo").function(2) == 2
+        handler.putSubHandler("other", Handler())
+        assert handler.dispatchTable == {}
+
+
 class TestBaseQueryFactory:
 
     def test_creation(self):
@@ -15,17 +102,17 @@ class TestBaseQueryFactory:
     def test_buildVersionedPayloadPre1(self):
         factory = BaseQueryFactory("someMethod", version=VERSION_PRE1)
         payload = factory._buildVersionedPayload()
-        assert payload == '{"method": "", "params": []}'
+        assert payload == b'{"method": "", "params": []}'
 
     def test_buildVersionedPayload1(self):
         factory = BaseQueryFactory("someMethod", version=VERSION_1)
         payload = factory._buildVersionedPayload()
-        assert payload == '{"method": "", "params": [], "id": 1}'
+        assert payload == b'{"method": "", "params": [], "id": 1}'
 
     def test_buildVersionedPayload2(self):
         factory = BaseQueryFactory("someMethod", version=VERSION_2)
         payload = factory._buildVersionedPayload()
-        assert payload == '{"jsonrpc": "2.0", "method": "", "params": [], "id": 1}'
+        assert payload == b'{"jsonrpc": "2.0", "method": "", "params": [], "id": 1}'
 
     @inlineCallbacks
     def test_parseResponseNoJSON(self):
@@ -64,6 +151,88 @@ class TestBaseQueryFactory:
             assert error.faultString == "oops"
 
 
+class TestRequestRegistry:
+
+    def test_register_assigns_unique_ids(self):
+        registry = RequestRegistry()
+        factories = [BaseQueryFactory("someMethod", VERSION_2) for _ in range(3)]
+
+        ids = [registry.register(factory) for factory in factories]
+
+        assert ids == [1, 2, 3]
+        assert [factory.id for factory in factories] == ids
+        assert b'"id": 3' in factories[2].payload
+        assert len(registry) == 3
+
+    def test_release_on_reply(self):
+        registry = RequestRegistry()
+        first = BaseQueryFactory("someMethod", VERSION_2)
+        second = BaseQueryFactory("someMethod", VERSION_2)
+        registry.register(first)
+        registry.register(second)
+
+        registry.pop(second.id).parseResponse('{"jsonrpc": "2.0", "result": 2, "id": 2}')
+
+        assert list(registry.pending) == [first.id]
+        first.parseResponse('{"jsonrpc": "2.0", "result": 1, "id": 1}')
+        assert len(registry) == 0
+
+    @inlineCallbacks
+    def test_fail_all(self):
+        registry = RequestRegistry()
+        factory = BaseQueryFactory("someMethod", VERSION_2)
+        registry.register(factory)
+        d = factory.deferred
+
+        registry.failAll(ValueError("gone"))
+
+        assert len(registry) == 0
+        with pytest.raises(ValueError):
+            yield d
+
+
+class TestBaseBatch:
+
+    def test_payload(self):
+        batch = BaseBatch(BaseProxy()).call("add", 1, 2).call("echo", "a")
+        assert batch.payload == (
+            b'[{"jsonrpc": "2.0", "method": "add", "params": [1, 2], "id": 1}, '
+            b'{"jsonrpc": "2.0", "method": "echo", "params": ["a"], "id": 2}]')
+
+    @inlineCallbacks
+    def test_replies_out_of_order(self):
+        batch = BaseBatch(BaseProxy()).call("add", 1, 2).call("echo", "a")
+        first, second = [query.deferred for query in batch.queries]
+
+        batch.parseUnmarshalled([{"jsonrpc": "2.0", "result": "a", "id": 2},
+                                 {"jsonrpc": "2.0", "result": 3, "id": 1}])
+
+        assert (yield first) == 3
+        assert (yield second) == "a"
+
+    @inlineCallbacks
+    def test_error_for_whole_batch(self):
+        batch = BaseBatch(BaseProxy()).call("add", 1, 2)
+        d = batch.queries[0].deferred
+
+        batch.parseUnmarshalled({"jsonrpc": "2.0", "id": None, "error": {
+            "code": -32600, "message": "invalid request"}})
+
+        with pytest.raises(Fault) as exc_info:
+            yield d
+        assert exc_info.value.faultCode == -32600
+
+    @inlineCallbacks
+    def test_missing_reply(self):
+        batch = BaseBatch(BaseProxy()).call("add", 1, 2)
+        d = batch.queries[0].deferred
+
+        batch.parseUnmarshalled([])
+
+        with pytest.raises(ValueError):
+            yield d
+
+
 class TestBaseProxy:
 
     def test_creation(self):
@@ -1,3 +1,7 @@
+import json
+import math
+import sys
+
 import pytest
 from datetime import datetime
 from twisted.trial.unittest import TestCase
@@ -10,6 +14,17 @@ from txjsonrpc_ng.jsonrpclib import (
     ServerProxy)
 
 
+@pytest.fixture(autouse=True)
+def json_codec():
+    """
+    The expected payloads are formatted as the standard library does it.
+    """
+    codec = jsonrpclib.getCodec()
+    jsonrpclib.setCodec("json")
+    yield
+    jsonrpclib.setCodec(codec)
+
+
 class TestDump:
 
     def test_no_version(self):
@@ -57,6 +72,43 @@ class TestDump:
                 '"code": 123, "data": ""}, "id": null}')
 
 
+class TestDumpb:
+
+    @pytest.mark.parametrize("version", [VERSION_PRE1, VERSION_1, VERSION_2])
+    def test_matches_dumps(self, version):
+        for obj in ({"some": "data"}, Fault(123, "message")):
+            assert jsonrpclib.dumpb(obj, version=version, id=1) == \
+                dumps(obj, version=version, id=1).encode()
+
+    def test_non_ascii(self):
+        assert loads(jsonrpclib.dumpb(["\u00e4\u20ac"])) == ["\u00e4\u20ac"]
+
+
+class TestIterencode:
+
+    @pytest.mark.parametrize("version", [VERSION_PRE1, VERSION_1, VERSION_2])
+    def test_matches_dumpb(self, version):
+        for obj in ({"some": "data"}, Fault(123, "message")):
+            assert b"".join(jsonrpclib.iterencode(obj, version=version, id=1)) == \
+                jsonrpclib.dumpb(obj, version=version, id=1)
+
+    def test_chunk_size(self):
+        chunks = list(jsonrpclib.iterencode(list(range(10000)), chunk_size=1000, version=VERSION_2, id=1))
+        assert len(chunks) > 10
+        assert all(len(chunk) < 1100 for chunk in chunks)
+        assert loads(b"".join(chunks).decode())["result"] == list(range(10000))
+
+
+class TestLoadb:
+
+    def test_loadb(self):
+        assert jsonrpclib.loadb(b'{"apple": 2}') == {"apple": 2}
+
+    def test_loadb_fault(self):
+        with pytest.raises(Fault):
+            jsonrpclib.loadb(dumps(Fault(123, "message"), version=VERSION_2).encode())
+
+
 class TestLoads:
 
     @pytest.mark.parametrize("input,expected", (
@@ -209,3 +261,100 @@ class TestServerProxy:
         assert loaded["params"] == [1, 2]
         assert loaded["id"] == 1
         assert loaded["jsonrpc"] == "2.0"
+
+
+class TestCodecs:
+
+    @pytest.fixture(params=["json", "orjson", "ujson", "msgspec"])
+    def codec(self, request):
+        try:
+            jsonrpclib.setCodec(request.param)
+        except ImportError:
+            pytest.skip("%s is not installed" % request.param)
+        return jsonrpclib.getCodec()
+
+    def test_round_trip(self, codec):
+        obj = {"a": [1, 2.5, None, True, "\u00e4/"], "b": {"c": 2 ** 40}}
+        assert codec.loads(codec.dumps(obj)) == obj
+        assert codec.loads(codec.dumps(obj).encode()) == obj
+
+    def test_dumps_uses_codec(self, codec):
+        result = dumps({"some": "data"}, version=VERSION_2, id=3)
+        assert loads(result) == {"jsonrpc": "2.0", "result": {"some": "data"}, "id": 3}
+
+    def test_datetime(self, codec):
+        if codec.name == "msgspec":
+            pytest.skip("msgspec encodes datetime objects itself")
+        assert loads(dumps({"at": datetime(2024, 10, 30, 14, 30, 0)})) == {"at": "20241030T14:30:00"}
+
+    def test_big_int(self, codec):
+        if codec.name == "msgspec":
+            pytest.skip("msgspec has no standard library fallback")
+        assert loads(dumps([2 ** 70])) == [2 ** 70]
+
+    @pytest.mark.parametrize("number", (2 ** 64, -2 ** 63 - 1, 123456789012345678901234567890))
+    def test_big_int_round_trip(self, codec, number):
+        if codec.name == "msgspec":
+            pytest.skip("msgspec has no standard library fallback")
+        assert jsonrpclib.loadb(jsonrpclib.dumpb({"id": number})) == {"id": number}
+        assert loads('{"id": %d}' % number) == {"id": number}
+
+    def test_nan(self, codec):
+        if codec.name == "msgspec":
+            pytest.skip("msgspec has no standard library fallback")
+        # As sent by peers using the standard library.
+        values = loads(json.dumps([math.nan, math.inf, -math.inf]).encode())
+        assert math.isnan(values[0]) and values[1:] == [math.inf, -math.inf]
+        assert loads("[1e400]") == [math.inf]
+        if codec.name == "orjson":
+            assert dumps([math.nan]) == "[null]"
+            return
+        values = jsonrpclib.loadb(jsonrpclib.dumpb([math.nan, math.inf, -math.inf]))
+        assert math.isnan(values[0]) and values[1:] == [math.inf, -math.inf]
+
+    def test_not_serializable(self, codec):
+        with pytest.raises(TypeError):
+            dumps(object())
+
+    def test_invalid_json(self, codec):
+        with pytest.raises(ValueError):
+            loads("oops")
+
+    def test_formatting_options_use_stdlib(self, codec):
+        assert dumps([1, 2], indent=1) == "[\n 1,\n 2\n]"
+
+    def test_set_codec_instance(self):
+        codec = jsonrpclib.JSONCodec()
+        jsonrpclib.setCodec(codec)
+        assert jsonrpclib.getCodec() is codec
+
+    def test_set_auto_codec(self, monkeypatch):
+        jsonrpclib.setCodec("auto")
+        try:
+            import orjson  # noqa: F401
+        except ImportError:
+            pass
+        else:
+            assert isinstance(jsonrpclib.getCodec(), jsonrpclib.OrjsonCodec)
+        monkeypatch.setitem(sys.modules, "orjson", None)
+        monkeypatch.setitem(sys.modules, "ujson", None)
+        jsonrpclib.setCodec("auto")
+        assert isinstance(jsonrpclib.getCodec(), jsonrpclib.JSONCodec)
+
+    def test_set_unknown_codec(self):
+        with pytest.raises(KeyError):
+            jsonrpclib.setCodec("unknown")
+
+    def test_register_codec(self):
+        class UpperCodec(jsonrpclib.JSONCodec):
+            name = "upper"
+
+            def dumps(self, obj):
+                return jsonrpclib.JSONCodec.dumps(self, obj).upper()
+
+        jsonrpclib.registerCodec(UpperCodec)
+        try:
+            jsonrpclib.setCodec("upper")
+            assert dumps(["a"]) == '["A"]'
+        finally:
+            del jsonrpclib._codecs["upper"]
@@ -0,0 +1,184 @@
+from concurrent.futures import Future
+
+import pytest
+from twisted.internet import defer, reactor, task
+
+from txjsonrpc_ng import jsonrpclib
+from txjsonrpc_ng.jsonrpc import BaseSubhandler
+from txjsonrpc_ng.limits import DeadlineExceeded, Limiter, Overloaded, limited, uncancellable
+from txjsonrpc_ng.workers import ProcessExecutor
+
+
+def failure_of(d):
+    failures = []
+    d.addErrback(failures.append)
+    return failures[0]
+
+
+class TestLimiter:
+
+    def test_limit(self):
+        limiter = Limiter(2)
+        pending = [defer.Deferred() for _ in range(3)]
+        calls = [limiter.run(lambda d=d: d) for d in pending]
+        assert (limiter.running, limiter.waiting) == (2, 1)
+        pending[0].callback("a")
+        assert calls[0].result == "a"
+        assert (limiter.running, limiter.waiting) == (2, 0)
+        pending[1].callback("b")
+        pending[2].callback("c")
+        assert [call.result for call in calls[1:]] == ["b", "c"]
+        assert limiter.running == 0
+
+    def test_queue_size(self):
+        limiter = Limiter(1, queue_size=1)
+        limiter.run(defer.Deferred)
+        limiter.run(defer.Deferred)
+        failure = failure_of(limiter.run(defer.Deferred))
+        assert isinstance(failure.value, Overloaded)
+        assert failure.value.faultCode == jsonrpclib.SERVER_OVERLOADED
+        assert limiter.stats() == {"running": 1, "waiting": 1, "rejected": 1, "expired": 0}
+
+    def test_no_queue(self):
+        limiter = Limiter(1, queue_size=0)
+        assert limiter.run(lambda: "a").result == "a"
+        limiter.run(defer.Deferred)
+        assert isinstance(failure_of(limiter.run(lambda: "b")).value, Overloaded)
+
+    def test_failure_releases(self):
+        limiter = Limiter(1)
+        d = limiter.run(lambda: 1 / 0)
+        d.addErrback(lambda f: f.trap(ZeroDivisionError))
+        assert limiter.running == 0
+
+    def test_deadline(self):
+        clock = task.Clock()
+        limiter = Limiter(1, deadline=5, clock=clock)
+        running, waiting = defer.Deferred(lambda d: None), defer.Deferred(lambda d: None)
+        first = limiter.run(lambda: running)
+        second = limiter.run(lambda: waiting)
+        clock.advance(5)
+        for call in (first, second):
+            failure = failure_of(call)
+            assert isinstance(failure.value, DeadlineExceeded)
+            assert failure.value.faultCode == jsonrpclib.DEADLINE_EXCEEDED
+        # Both calls were cancelled; the second one started when the first
+        # one gave up its slot.
+        assert running.called and waiting.called
+        assert limiter.stats() == {"running": 0, "waiting": 0, "rejected": 0, "expired": 2}
+
+    def test_deadline_without_canceller(self):
+        clock = task.Clock()
+        limiter = Limiter(1, deadline=5, clock=clock)
+        running = defer.Deferred()
+        call = limiter.run(lambda: running)
+        clock.advance(5)
+        assert isinstance(failure_of(call).value, DeadlineExceeded)
+        assert running.called
+        assert limiter.running == 0
+
+    def test_deadline_uncancellable(self):
+        # Like the Deferreds of in_thread, which cannot stop their work.
+        clock = task.Clock()
+        limiter = Limiter(1, deadline=5, clock=clock)
+        running = uncancellable(defer.Deferred())
+        first = limiter.run(lambda: running)
+        second = limiter.run(lambda: "b")
+        clock.advance(5)
+        assert isinstance(failure_of(first).value, DeadlineExceeded)
+        assert isinstance(failure_of(second).value, DeadlineExceeded)
+        # The first call keeps its slot until its work has finished.
+        assert not running.called
+        assert limiter.stats() == {"running": 1, "waiting": 0, "rejected": 0, "expired": 2}
+        third = limiter.run(lambda: "c")
+        assert not third.called
+        running.callback("late")
+        assert third.result == "c"
+        assert limiter.running == 0
+
+    def test_deadline_met(self):
+        clock = task.Clock()
+        limiter = Limiter(1, deadline=5, clock=clock)
+        running = defer.Deferred()
+        call = limiter.run(lambda: running)
+        clock.advance(4)
+        running.callback("a")
+        assert call.result == "a"
+        assert not clock.getDelayedCalls()
+        assert limiter.run(lambda: "b").result == "b"
+        assert limiter.stats()["expired"] == 0
+
+    async def test_deadline_in_process(self):
+        clock = task.Clock()
+        limiter = Limiter(1, deadline=5, clock=clock)
+        pool = FuturePool()
+        executor = ProcessExecutor(pool)
+        first = limiter.run(executor.run, pow, 2, 3)
+        second = limiter.run(executor.run, pow, 2, 4)
+        # A worker has started the first call.
+        pool.futures[0].set_running_or_notify_cancel()
+        clock.advance(5)
+        assert isinstance(failure_of(first).value, DeadlineExceeded)
+        assert isinstance(failure_of(second).value, DeadlineExceeded)
+        assert len(pool.futures) == 1
+        assert limiter.running == 1
+
+        third = limiter.run(executor.run, pow, 2, 5)
+        pool.futures[0].set_result(8)
+        await task.deferLater(reactor, 0)
+        assert limiter.running == 1
+        # The third call is cancelled before a worker has started it.
+        clock.advance(5)
+        assert isinstance(failure_of(third).value, DeadlineExceeded)
+        assert pool.futures[1].cancelled()
+        assert limiter.running == 0
+
+    def test_cancel_with_deadline(self):
+        clock = task.Clock()
+        limiter = Limiter(1, deadline=5, clock=clock)
+        running = uncancellable(defer.Deferred())
+        call = limiter.run(lambda: running)
+        call.cancel()
+        assert failure_of(call).check(defer.CancelledError)
+        assert limiter.running == 1
+        running.callback("late")
+        assert limiter.running == 0
+        assert not clock.getDelayedCalls()
+
+    def test_cancel_waiting(self):
+        limiter = Limiter(1)
+        limiter.run(defer.Deferred)
+        waiting = limiter.run(lambda: "never")
+        waiting.cancel()
+        waiting.addErrback(lambda f: f.trap(defer.CancelledError))
+        assert limiter.waiting == 0
+
+
+class FuturePool:
+    """
+    A process pool whose calls are run by the test.
+    """
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, function, *args, **kwargs):
+        self.futures.append(Future())
+        return self.futures[-1]
+
+
+class Methods(BaseSubhandler):
+
+    @limited(1, queue_size=0)
+    def jsonrpc_limited(self, d):
+        return d
+
+
+def test_limited():
+    function = Methods()._getDispatchEntry("limited").function
+    d = defer.Deferred()
+    assert function(d) is not d
+    assert isinstance(failure_of(function(defer.Deferred())).value, Overloaded)
+    assert Methods.jsonrpc_limited.limiter.stats()["rejected"] == 1
+    d.callback("done")
+    assert Methods.jsonrpc_limited.limiter.running == 0
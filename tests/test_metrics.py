@@ -0,0 +1,71 @@
+from twisted.internet import defer
+from twisted.python import failure
+
+from txjsonrpc_ng.jsonrpclib import Fault
+from txjsonrpc_ng.metrics import Histogram, Metrics, prometheus
+
+
+class TestHistogram:
+
+    def test_observe(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        assert histogram.snapshot() == {"buckets": {"1": 2, "10": 3, "+Inf": 4}, "sum": 56.5, "count": 4}
+
+    def test_time(self):
+        histogram = Histogram()
+        assert histogram.time(lambda a, b: a + b, 1, b=2) == 3
+        assert histogram.count == 1
+
+
+class TestMetrics:
+
+    def test_call(self):
+        metrics = Metrics()
+        metrics.call("add")(3)
+        metrics.call("add")(Fault(1, "error"))
+        metrics.call("add")(failure.Failure(ValueError()))
+        d = defer.Deferred().addBoth(metrics.call("echo", client=True))
+        d.callback("result")
+        assert d.result == "result"
+        snapshot = metrics.snapshot()
+        assert snapshot["methods"]["add"]["calls"] == 3
+        assert snapshot["methods"]["add"]["errors"] == 2
+        assert snapshot["methods"]["add"]["latency"]["count"] == 3
+        assert snapshot["client_methods"]["echo"]["calls"] == 1
+
+    def test_compression(self):
+        metrics = Metrics()
+        assert metrics.compression_ratio("gzip") is None
+        metrics.record_compression("gzip", 1000, 100, 0.001)
+        metrics.record_compression("gzip", 1000, 300, 0.002)
+        assert metrics.compression_ratio("gzip") == 0.2
+        assert metrics.snapshot()["compression"] == {
+            "gzip": {"responses": 2, "bytes_in": 2000, "bytes_out": 400, "seconds": 0.003}}
+
+    def test_clear(self):
+        metrics = Metrics()
+        metrics.call("add")(3)
+        metrics.request_bytes.observe(10)
+        metrics.clear()
+        assert metrics.snapshot()["methods"] == {}
+        assert metrics.request_bytes.count == 0
+
+
+def test_prometheus():
+    metrics = Metrics(latency_buckets=(0.1,), size_buckets=(100,))
+    metrics.call('say "hi"')(1)
+    metrics.request_bytes.observe(50)
+    metrics.record_compression("br", 1000, 100, 0.5)
+    text = prometheus(metrics.snapshot())
+    lines = text.splitlines()
+    assert "# TYPE txjsonrpc_calls_total counter" in lines
+    assert 'txjsonrpc_calls_total{method="say \\"hi\\"",side="server"} 1' in lines
+    assert 'txjsonrpc_errors_total{method="say \\"hi\\"",side="server"} 0' in lines
+    assert 'txjsonrpc_call_seconds_bucket{method="say \\"hi\\"",side="server",le="+Inf"} 1' in lines
+    assert 'txjsonrpc_request_bytes_bucket{le="100"} 1' in lines
+    assert "txjsonrpc_request_bytes_sum 50" in lines
+    assert "txjsonrpc_serialization_seconds_count 0" in lines
+    assert 'txjsonrpc_compression_output_bytes_total{encoding="br"} 100' in lines
+    assert text.endswith("\n")
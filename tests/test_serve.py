@@ -0,0 +1,136 @@
+import os
+
+import pytest
+import pytest_twisted
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+from txjsonrpc_ng import jsonrpclib
+from txjsonrpc_ng.netstring import jsonrpc as netstring
+from txjsonrpc_ng.serve import Supervisor, aggregate, listen, load
+from txjsonrpc_ng.web import jsonrpc as web
+from txjsonrpc_ng.web.jsonrpc import JSONRPCSite
+
+
+class WebServer(web.JSONRPC):
+
+    def jsonrpc_pid(self):
+        return os.getpid()
+
+
+class NetstringServer(netstring.JSONRPC):
+
+    def jsonrpc_pid(self):
+        return os.getpid()
+
+
+def netstring_factory():
+    return netstring.RPCFactory(NetstringServer)
+
+
+web_server = WebServer()
+
+
+class TestLoad:
+
+    def test_resource_class(self):
+        site = load("tests.test_serve:WebServer")
+        assert isinstance(site, JSONRPCSite)
+        assert isinstance(site.resource, WebServer)
+
+    def test_resource_instance(self):
+        assert load("tests.test_serve:web_server").resource is web_server
+
+    def test_factory_function(self):
+        factory = load("tests.test_serve:netstring_factory")
+        assert isinstance(factory, netstring.RPCFactory)
+        assert factory.protocol is NetstringServer
+
+    def test_missing_name(self):
+        with pytest.raises(ValueError):
+            load("tests.test_serve")
+
+    def test_not_a_server(self):
+        with pytest.raises(TypeError):
+            load("tests.test_serve:aggregate")
+
+
+def test_aggregate():
+    reports = [
+        {"pid": 1, "connections": 2, "methods": {"pid": {"calls": 3}}, "name": "a"},
+        {"pid": 2, "connections": 1, "methods": {"pid": {"calls": 4}, "echo": {"calls": 1}}},
+    ]
+    assert aggregate(reports) == {"connections": 3, "methods": {"pid": {"calls": 7}, "echo": {"calls": 1}}}
+
+
+def test_listen():
+    sock = listen(0, "127.0.0.1")
+    try:
+        assert sock.getsockname()[1] > 0
+        assert not sock.getblocking()
+    finally:
+        sock.close()
+
+
+async def wait_for(condition, timeout=20.0):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return
+        await deferLater(reactor, 0.05, lambda: None)
+    raise AssertionError("timed out")
+
+
+@pytest_twisted.async_yield_fixture
+async def serve():
+    supervisors = []
+
+    def serve(spec, workers):
+        sock = listen(0, "127.0.0.1")
+        supervisor = Supervisor(spec, sock, workers, restart_delay=0.05, report_interval=0.1)
+        # Only start the workers; stopping is left to the fixture.
+        for index in range(workers):
+            supervisor.spawn(index)
+        supervisors.append((supervisor, sock))
+        return supervisor, sock.getsockname()[1]
+
+    yield serve
+    for supervisor, sock in supervisors:
+        await supervisor.stop()
+        sock.close()
+
+
+class TestSupervisor:
+
+    async def test_web(self, serve):
+        supervisor, port = serve("tests.test_serve:WebServer", 2)
+        await wait_for(lambda: len(supervisor.reports) == 2)
+        assert supervisor.stats()["workers"] == 2
+        proxy = web.Proxy("http://127.0.0.1:%d/" % port, version=jsonrpclib.VERSION_2)
+        pid = await proxy.callRemote("pid")
+        assert pid in supervisor.pids()
+        await wait_for(lambda: supervisor.stats().get("accepted", 0) >= 1)
+        # The metrics of the workers are summed up.
+        await wait_for(lambda: supervisor.stats()["metrics"].get("methods", {}).get("pid", {}).get("calls") == 1)
+
+    async def test_netstring(self, serve):
+        supervisor, port = serve("tests.test_serve:netstring_factory", 1)
+        await wait_for(lambda: len(supervisor.reports) == 1)
+        proxy = netstring.Proxy("127.0.0.1", port, version=jsonrpclib.VERSION_2)
+        assert await proxy.callRemote("pid") == supervisor.pids()[0]
+
+    async def test_restart(self, serve):
+        supervisor, port = serve("tests.test_serve:netstring_factory", 1)
+        await wait_for(lambda: len(supervisor.reports) == 1)
+        pid, = supervisor.pids()
+        os.kill(pid, 9)
+        await wait_for(lambda: supervisor.restarts == 1 and len(supervisor.reports) == 1)
+        assert supervisor.pids() != [pid]
+        proxy = netstring.Proxy("127.0.0.1", port, version=jsonrpclib.VERSION_2)
+        assert await proxy.callRemote("pid") == supervisor.pids()[0]
+
+    async def test_stop(self, serve):
+        supervisor, _ = serve("tests.test_serve:netstring_factory", 2)
+        await wait_for(lambda: len(supervisor.reports) == 2)
+        await supervisor.stop()
+        assert supervisor.workers == {}
+        assert supervisor.restarts == 0
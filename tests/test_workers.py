@@ -0,0 +1,170 @@
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+
+import pytest
+from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater
+from twisted.python.threadpool import ThreadPool
+
+from txjsonrpc_ng.jsonrpc import BaseSubhandler
+from txjsonrpc_ng.workers import ProcessExecutor, ThreadExecutor, in_process, in_thread, run_coroutine
+
+
+def pid():
+    return os.getpid()
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+class Methods(BaseSubhandler):
+
+    @in_thread()
+    def jsonrpc_thread(self):
+        return threading.current_thread() is threading.main_thread()
+
+    @staticmethod
+    @in_process(max_workers=1)
+    def jsonrpc_process(value):
+        return value * 2, os.getpid()
+
+    async def jsonrpc_coroutine(self, value):
+        return await deferLater(reactor, 0, lambda: value * 2)
+
+
+class TestThreadExecutor:
+
+    async def test_reactor_pool(self):
+        assert not await ThreadExecutor().run(lambda: threading.current_thread() is threading.main_thread())
+
+    async def test_own_pool(self):
+        pool = ThreadPool(minthreads=0, maxthreads=1, name="test-workers")
+        executor = ThreadExecutor(pool)
+        try:
+            name = await executor.run(lambda: threading.current_thread().name)
+            assert "test-workers" in name
+            assert pool.started
+        finally:
+            pool.stop()
+
+    async def test_exception(self):
+        with pytest.raises(ValueError):
+            await ThreadExecutor().run(fail, "no")
+
+
+class TestProcessExecutor:
+
+    @pytest.fixture(scope="class")
+    def executor(self):
+        executor = ProcessExecutor(max_workers=1)
+        yield executor
+        executor.pool.shutdown()
+
+    async def test_run(self, executor):
+        first = await executor.run(pid)
+        assert first != os.getpid()
+        assert await executor.run(pid) == first
+
+    async def test_exception(self, executor):
+        with pytest.raises(ValueError, match="no"):
+            await executor.run(fail, "no")
+
+
+class TestRunCoroutine:
+
+    async def test_result(self):
+        async def double(value):
+            return await deferLater(reactor, 0, lambda: value * 2)
+
+        d = run_coroutine(double, 21)
+        assert isinstance(d, defer.Deferred)
+        assert await d == 42
+
+    async def test_exception(self):
+        async def fail_later(message):
+            await deferLater(reactor, 0)
+            fail(message)
+
+        with pytest.raises(ValueError, match="no"):
+            await run_coroutine(fail_later, "no")
+
+    async def test_cancel(self):
+        waiting, cleaned_up = defer.Deferred(), []
+
+        async def wait():
+            try:
+                await waiting
+            finally:
+                cleaned_up.append(True)
+
+        d = run_coroutine(wait)
+        d.cancel()
+        with pytest.raises(defer.CancelledError):
+            await d
+        assert cleaned_up == [True]
+
+    @pytest.mark.parametrize("decorator", (in_thread, in_process))
+    def test_workers_reject_coroutines(self, decorator):
+        async def method():
+            pass
+
+        with pytest.raises(TypeError):
+            decorator()(method)
+
+    def test_asyncio_reactor(self):
+        # The reactor cannot be changed within the test run, so serve and
+        # call a coroutine method using asyncio in another process.
+        script = textwrap.dedent("""
+            from twisted.internet import asyncioreactor
+            asyncioreactor.install()
+            import asyncio
+            from twisted.internet import defer, reactor
+            from twisted.web import server
+            from txjsonrpc_ng.jsonrpclib import VERSION_2
+            from txjsonrpc_ng.web.jsonrpc import JSONRPC, Proxy
+
+            class Example(JSONRPC):
+                async def jsonrpc_sleep(self, value):
+                    await asyncio.sleep(0.01)
+                    return value
+
+            async def main():
+                port = reactor.listenTCP(0, server.Site(Example()), interface="127.0.0.1")
+                proxy = Proxy("http://127.0.0.1:%d/" % port.getHost().port, version=VERSION_2)
+                try:
+                    print(await proxy.callRemote("sleep", 42))
+                finally:
+                    reactor.stop()
+
+            reactor.callWhenRunning(defer.ensureDeferred, main())
+            reactor.run()
+        """)
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=60,
+                                env={**os.environ, "PYTHONPATH": os.getcwd()})
+        assert output.stdout.strip() == "42", output.stderr
+
+
+class TestDispatch:
+
+    async def test_coroutine(self):
+        function = Methods()._getDispatchEntry("coroutine").function
+        d = function(21)
+        assert isinstance(d, defer.Deferred)
+        assert await d == 42
+
+    async def test_in_thread(self):
+        function = Methods()._getDispatchEntry("thread").function
+        assert await defer.maybeDeferred(function) is False
+
+    async def test_in_process(self):
+        function = Methods()._getDispatchEntry("process").function
+        try:
+            value, worker = await defer.maybeDeferred(function, 21)
+            assert value == 42
+            assert worker != os.getpid()
+        finally:
+            Methods.jsonrpc_process.executor.pool.shutdown()
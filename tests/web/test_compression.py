@@ -0,0 +1,133 @@
+import tracemalloc
+
+import pytest
+
+from txjsonrpc_ng.web import compression
+
+
+class TestNegotiate:
+
+    @pytest.mark.parametrize("header, expected", (
+            (None, None),
+            ("", None),
+            ("gzip", "gzip"),
+            ("GZIP", "gzip"),
+            ("x-gzip", "gzip"),
+            ("identity", None),
+            ("gzip;q=0", None),
+            ("deflate, gzip", "gzip"),
+            ("deflate;q=1, gzip;q=0.5", "deflate"),
+            ("*", "gzip"),
+            ("*, gzip;q=0", "deflate"),
+            ("gzip;q=oops, deflate", "deflate"),
+    ))
+    def test_negotiate(self, header, expected):
+        assert compression.negotiate(header, ("gzip", "deflate")) == expected
+
+    def test_unavailable_encoding_is_skipped(self):
+        assert compression.negotiate("unknown, gzip;q=0.1", ("unknown", "gzip")) == "gzip"
+
+    def test_parse_accept_encoding(self):
+        assert compression.parse_accept_encoding("gzip;q=0.5, br , zstd;level=1;q=0.8") == {
+            "gzip": 0.5, "br": 1.0, "zstd": 0.8}
+
+
+class TestEncodings:
+
+    @pytest.mark.parametrize("name", compression.available())
+    def test_round_trip(self, name):
+        data = b"0123456789" * 1000
+        encoding = compression.encodings[name]
+        compressed = encoding.compress(data)
+        assert len(compressed) < len(data)
+        assert compression.decode(compressed, [name]) == data
+        assert encoding.decompress(encoding.compress(data, 1)) == data
+
+    @pytest.mark.parametrize("name", compression.available())
+    def test_compressor(self, name):
+        compressor = compression.encodings[name].compressor()
+        data = b"".join(compressor.compress(b"%d," % i) for i in range(10000)) + compressor.flush()
+        assert compression.decode(data, [name]) == b"".join(b"%d," % i for i in range(10000))
+
+    @pytest.mark.parametrize("name", ["gzip", "deflate"])
+    def test_begin_finish(self, name):
+        encoding = compression.encodings[name]
+        state = encoding.begin(b"0123456789" * 1000, 1)
+        for end in (b"", b"a", b"bc" * 100):
+            compressed = encoding.finish(state, end, 1)
+            assert compression.decode(compressed, [name]) == b"0123456789" * 1000 + end
+            assert len(compressed) < 1000
+
+    @pytest.mark.parametrize("name", compression.available())
+    def test_decoder(self, name):
+        data = b"0123456789" * 1000
+        compressed = compression.encodings[name].compress(data)
+        decoder = compression.Decoder([name])
+        chunks = [decoder.decode(compressed[i:i + 100]) for i in range(0, len(compressed), 100)]
+        assert b"".join(chunks) + decoder.flush() == data
+
+    def test_decoder_max_size(self):
+        decoder = compression.Decoder(["gzip"], max_size=1000)
+        with pytest.raises(compression.BodyTooLarge):
+            decoder.decode(compression.encodings["gzip"].compress(b" " * 1001))
+
+    @pytest.mark.parametrize("name", compression.available())
+    def test_decoder_bomb(self, name):
+        bomb = compression.encodings[name].compress(b"\0" * 50000000, 1)
+        tracemalloc.start()
+        try:
+            decoder = compression.Decoder([name], max_size=1000)
+            with pytest.raises(compression.BodyTooLarge):
+                decoder.decode(bomb)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert peak < 1000000
+
+    def test_decoder_stacked_bomb(self):
+        gzip = compression.encodings["gzip"]
+        bomb = gzip.compress(gzip.compress(b"\0" * 50000000, 1))
+        with pytest.raises(ValueError, match="content codings"):
+            compression.Decoder(["gzip, gzip"], max_size=1000)
+        tracemalloc.start()
+        try:
+            decoder = compression.Decoder(["gzip, gzip"], max_size=1000, max_codings=2)
+            with pytest.raises(compression.BodyTooLarge):
+                decoder.decode(bomb)
+                decoder.flush()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert peak < 1000000
+
+    def test_decoder_identity(self):
+        decoder = compression.Decoder([], max_size=3)
+        assert decoder.decode(b"abc") == b"abc"
+        with pytest.raises(compression.BodyTooLarge):
+            decoder.decode(b"d")
+
+    def test_decoder_invalid_data(self):
+        with pytest.raises(ValueError):
+            compression.Decoder(["gzip"]).decode(b"not gzip")
+
+    def test_decoder_raw_deflate(self):
+        import zlib
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        data = compressor.compress(b"abc" * 100) + compressor.flush()
+        decoder = compression.Decoder(["deflate"])
+        assert decoder.decode(data) + decoder.flush() == b"abc" * 100
+
+    def test_raw_deflate(self):
+        import zlib
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        data = compressor.compress(b"abc" * 100) + compressor.flush()
+        assert compression.decode(data, ["deflate"]) == b"abc" * 100
+
+    def test_decode_several_codings(self):
+        data = compression.encodings["gzip"].compress(
+            compression.encodings["deflate"].compress(b"abc"))
+        assert compression.decode(data, ["deflate, gzip"]) == b"abc"
+
+    def test_decode_unknown(self):
+        with pytest.raises(ValueError):
+            compression.decode(b"abc", ["unknown"])
@@ -5,18 +5,28 @@ Test JSON-RPC support.
 """
 import gzip
 import io
+import json
 from unittest.mock import MagicMock
 
 import pytest
 from twisted.internet import reactor, defer
-from twisted.web import server, static
+from twisted.internet.error import ConnectionLost
+from twisted.internet.error import TimeoutError
+from twisted.internet.task import deferLater
+from twisted.logger import globalLogPublisher
+from twisted.python.threadpool import ThreadPool
+from twisted.web import client, server, static
+from twisted.web.http_headers import Headers
 from twisted.web.http import Request
 
 from txjsonrpc_ng import jsonrpclib
 from txjsonrpc_ng.jsonrpc import addIntrospection
-from txjsonrpc_ng.web import jsonrpc
-from txjsonrpc_ng.web.data import CacheableResult
+from txjsonrpc_ng.metrics import Metrics
+from txjsonrpc_ng.web import compression as encodings, jsonrpc
+from txjsonrpc_ng.web.data import CacheableResult, StreamingResult
 from txjsonrpc_ng.web.jsonrpc import with_request
+from txjsonrpc_ng.web.metrics import MetricsResource
+from txjsonrpc_ng.web.render import CompressionSettings, DefaultRenderer, StreamingRenderer, etag_matches
 
 
 class RuntimeErrorTest(RuntimeError):
@@ -137,6 +147,7 @@ class TestJSONRPCTest:
     @pytest.mark.parametrize("method, args, expected", (
             ("add", (2, 3), 5),
             ("defer", ("a",), "a"),
+            ("defer", ("\u00e4\u20ac",), "\u00e4\u20ac"),
             ("dict", ({"a": 1}, "a"), 1),
             ("pair", ("a", 1), ["a", 1]),
             ("none", (), "null"),
@@ -173,7 +184,8 @@ class TestJSONRPCIntrospection:
         response = await proxy.callRemote("system.listMethods")
         assert response == ['add', 'complex', 'defer', 'deferFail', 'deferFault', 'dict', 'fail', 'fault', 'huge',
                             'none',
-                            'pair', 'system.listMethods', 'system.methodHelp', 'system.methodSignature', 'with_request']
+                            'pair', 'system.listMethods', 'system.methodHelp', 'system.methodSignature', 'system.stats',
+                            'with_request']
 
     @pytest.mark.parametrize("method, expected", (
             ("defer", "Help for defer."),
@@ -238,7 +250,7 @@ class TestCacheableJSONRPC:
     @pytest.fixture
     def proxy(self, site_port):
         url = "http://127.0.0.1:%d/" % site_port
-        return jsonrpc.Proxy(url, compress=True)
+        return jsonrpc.Proxy(url, compress=["gzip"])
 
     @pytest.mark.parametrize("method, expected", (
             ("cacheable", "bar"),
@@ -247,17 +259,596 @@ class TestCacheableJSONRPC:
     async def test_cacheable(self, proxy, method, expected):
         response = await proxy.callRemote(method)
         assert response == expected
-        if method == "cacheable":
-            assert CacheableJsonRpcTest.cacheable.string_value is not None
-        elif method == "cacheable_compressed":
-            compressed_data = io.BytesIO(CacheableJsonRpcTest.compressed_cacheable.compressed_value)
-            with gzip.GzipFile(mode='rb', fileobj=compressed_data) as in_file:
-                contents = in_file.read()
-            compressed_data.close()
-            assert contents.decode() == CacheableJsonRpcTest.compressed_cacheable.string_value
+        result = CacheableJsonRpcTest.cacheable if method == "cacheable" else CacheableJsonRpcTest.compressed_cacheable
+        assert result.body == jsonrpclib.dumpb(expected)
         response = await proxy.callRemote(method)
         assert response == expected
 
+    async def test_compressed_for_each_id(self, site_port):
+        result = CacheableJsonRpcTest.compressed_cacheable
+        result.compressed_values.clear()
+        agent = client.Agent(reactor)
+        responses = []
+        for id in (1, 2, "three"):
+            body = jsonrpclib.dumpb({"jsonrpc": "2.0", "method": "cacheable_compressed", "id": id})
+            response = await agent.request(
+                b"POST", b"http://127.0.0.1:%d/" % site_port,
+                Headers({"Accept-Encoding": ["gzip"]}), client.FileBodyProducer(io.BytesIO(body)))
+            assert response.headers.getRawHeaders("content-encoding") == ["gzip"]
+            responses.append(json.loads(gzip.decompress(await client.readBody(response))))
+        assert [response["id"] for response in responses] == [1, 2, "three"]
+        assert all(response["result"] == CacheableJsonRpcTest.compressable_data for response in responses)
+        # The compressed value is kept once for all ids.
+        assert list(result.compressed_values) == [("gzip", jsonrpclib.VERSION_2)]
+
+    async def test_jsonp(self, site_port):
+        agent = client.Agent(reactor)
+        for id in (1, 2):
+            body = jsonrpclib.dumpb({"jsonrpc": "2.0", "method": "cacheable", "id": id})
+            response = await agent.request(
+                b"POST", b"http://127.0.0.1:%d/?callback=cb" % site_port, None,
+                client.FileBodyProducer(io.BytesIO(body)))
+            assert await client.readBody(response) == b'cb({"jsonrpc":"2.0","result":"bar","id":%d})' % id
+
+
+class JsonpTest(jsonrpc.JSONRPC):
+
+    def __init__(self):
+        jsonrpc.JSONRPC.__init__(self)
+        self.waiting = {}
+
+    def jsonrpc_wait(self, name):
+        self.waiting[name] = defer.Deferred()
+        return self.waiting[name]
+
+
+class TestJSONP:
+
+    @pytest.fixture
+    def resource(self):
+        return JsonpTest()
+
+    @pytest.fixture
+    def site_port(self, resource):
+        p = reactor.listenTCP(0, server.Site(resource), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    def request(self, site_port, query, name):
+        body = jsonrpclib.dumpb({"jsonrpc": "2.0", "method": "wait", "params": [name], "id": 1})
+        return client.Agent(reactor).request(
+            b"POST", b"http://127.0.0.1:%d/%s" % (site_port, query), None,
+            client.FileBodyProducer(io.BytesIO(body)))
+
+    async def test_interleaved_requests(self, resource, site_port):
+        first = self.request(site_port, b"?callback=first", "first")
+        second = self.request(site_port, b"", "second")
+        third = self.request(site_port, b"?callback=app.third", "third")
+        while len(resource.waiting) < 3:
+            await deferLater(reactor, 0.01)
+        # Each response keeps the callback of its own request, whichever
+        # request came last.
+        for name in ("third", "first", "second"):
+            resource.waiting[name].callback(name)
+        responses = [await first, await second, await third]
+        assert [await client.readBody(response) for response in responses] == [
+            b'first(%s)' % jsonrpclib.dumpb("first", id=1, version=jsonrpclib.VERSION_2),
+            jsonrpclib.dumpb("second", id=1, version=jsonrpclib.VERSION_2),
+            b'app.third(%s)' % jsonrpclib.dumpb("third", id=1, version=jsonrpclib.VERSION_2)]
+        assert [response.headers.getRawHeaders("content-type") for response in responses] == [
+            ["text/javascript"], ["application/json"], ["text/javascript"]]
+
+    @pytest.mark.parametrize("callback", (b"alert(1)//", b"1abc", b"a%20b", b"a%3Bb", b"%C3%A9"))
+    async def test_invalid_callback(self, resource, site_port, callback):
+        response = await self.request(site_port, b"?callback=" + callback, "invalid")
+        assert response.code == 400
+        assert await client.readBody(response) == b"invalid JSONP callback"
+        assert not resource.waiting
+
+
+class CachedJsonRpcTest(jsonrpc.JSONRPC):
+    calls = 0
+
+    @jsonrpc.cached(ttl=60)
+    def jsonrpc_compute(self, value):
+        CachedJsonRpcTest.calls += 1
+        return {"value": value, "data": "0123456789" * 200}
+
+
+class TestCached:
+
+    @pytest.fixture
+    def site_port(self):
+        CachedJsonRpcTest.calls = 0
+        CachedJsonRpcTest.jsonrpc_compute.cache.clear()
+        p = reactor.listenTCP(0, server.Site(CachedJsonRpcTest()), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    async def test_cached_per_params(self, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, version=jsonrpclib.VERSION_2, compress=True)
+        for value in (1, 1, 2, 1):
+            assert (await proxy.callRemote("compute", value))["value"] == value
+        assert CachedJsonRpcTest.calls == 2
+
+    async def test_response_ids(self, site_port):
+        for id in (1, 2, 2):
+            response, body = await post(
+                site_port, b'{"jsonrpc": "2.0", "method": "compute", "params": [1], "id": %d}' % id)
+            assert json.loads(body)["id"] == id
+        assert CachedJsonRpcTest.calls == 1
+
+    async def test_batch(self, site_port):
+        response, body = await post(
+            site_port, b'[{"jsonrpc": "2.0", "method": "compute", "params": [1], "id": 1},'
+                       b' {"jsonrpc": "2.0", "method": "compute", "params": [1], "id": 2}]')
+        assert [reply["result"]["value"] for reply in json.loads(body)] == [1, 1]
+
+
+class RawJsonRpcTest(jsonrpc.JSONRPC):
+    # Spacing and key order show that the value is not re-encoded.
+    row = b'{"b": 1,  "a": [1.50, "x"]}'
+
+    def jsonrpc_row(self):
+        return jsonrpc.RawJSON(self.row)
+
+    @jsonrpc.cached()
+    def jsonrpc_cached_row(self):
+        return jsonrpc.RawJSON(self.row.decode())
+
+
+class TestRawJSON:
+
+    @pytest.fixture
+    def site_port(self):
+        p = reactor.listenTCP(0, server.Site(RawJsonRpcTest()), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    @pytest.mark.parametrize("method", ("row", "cached_row"))
+    async def test_spliced(self, site_port, method):
+        response, body = await post(site_port, b'{"jsonrpc": "2.0", "method": "%s", "id": 4}' % method.encode())
+        assert body == b'{"jsonrpc":"2.0","result":%s,"id":4}' % RawJsonRpcTest.row
+
+    async def test_pre1(self, site_port):
+        response, body = await post(site_port, b'{"method": "row"}')
+        assert body == b"[%s]" % RawJsonRpcTest.row
+
+    async def test_batch(self, site_port):
+        response, body = await post(
+            site_port, b'[{"jsonrpc": "2.0", "method": "row", "id": 1},'
+                       b' {"jsonrpc": "2.0", "method": "cached_row", "id": 2}]')
+        assert [reply["result"] for reply in json.loads(body)] == [json.loads(RawJsonRpcTest.row)] * 2
+
+    async def test_proxy(self, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, version=jsonrpclib.VERSION_2)
+        assert await proxy.callRemote("row") == {"b": 1, "a": [1.5, "x"]}
+
+
+class SingleFlightJsonRpcTest(jsonrpc.JSONRPC):
+    single_flight = True
+
+    def __init__(self):
+        jsonrpc.JSONRPC.__init__(self)
+        self.pending = []
+
+    def jsonrpc_latest(self, value):
+        self.pending.append(defer.Deferred())
+        return self.pending[-1]
+
+
+class TestSingleFlight:
+
+    @pytest.fixture
+    def resource(self):
+        return SingleFlightJsonRpcTest()
+
+    @pytest.fixture
+    def site_port(self, resource):
+        p = reactor.listenTCP(0, server.Site(resource), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    async def test_concurrent_calls_are_shared(self, resource, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, version=jsonrpclib.VERSION_2)
+        calls = [proxy.callRemote("latest", value) for value in (1, 1, 1, 2)]
+        for _ in range(500):
+            if sum(len(waiters) for _, waiters in resource.flights.inflight.values()) == 4:
+                break
+            await deferLater(reactor, 0.01)
+        assert len(resource.pending) == 2
+        for d, value in zip(resource.pending, ("one", "two")):
+            d.callback(value)
+        assert [await call for call in calls] == ["one", "one", "one", "two"]
+
+
+class ConditionalJsonRpcTest(jsonrpc.JSONRPC):
+
+    def __init__(self, max_age=None):
+        jsonrpc.JSONRPC.__init__(self)
+        self.codes = []
+        self.value = "0123456789" * 100
+        self.max_age = max_age
+
+    def render(self, request):
+        request.notifyFinish().addCallback(lambda _: self.codes.append(request.code))
+        return jsonrpc.JSONRPC.render(self, request)
+
+    def jsonrpc_data(self, key):
+        return CacheableResult({key: self.value}, max_age=self.max_age)
+
+
+class TestConditionalRequests:
+
+    @pytest.fixture
+    def resource(self):
+        return ConditionalJsonRpcTest()
+
+    @pytest.fixture
+    def site_port(self, resource):
+        p = reactor.listenTCP(0, server.Site(resource), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    @pytest.mark.parametrize("if_none_match, expected", (
+            (None, False),
+            ('"abc"', True),
+            ('W/"abc"', True),
+            ('"other", "abc"', True),
+            ("*", True),
+            ('"other"', False),
+    ))
+    def test_etag_matches(self, if_none_match, expected):
+        assert etag_matches(if_none_match, 'W/"abc"') == expected
+
+    async def test_not_modified(self, resource, site_port):
+        body = b'{"jsonrpc": "2.0", "method": "data", "params": ["a"], "id": 1}'
+        response, _ = await post(site_port, body)
+        etag = response.headers.getRawHeaders(b"etag")[0]
+        assert not response.headers.hasHeader(b"cache-control")
+
+        response, content = await post(site_port, body, {b"If-None-Match": [etag]})
+        assert response.code == 304
+        assert content == b""
+
+        resource.value = "changed"
+        response, content = await post(site_port, body, {b"If-None-Match": [etag]})
+        assert response.code == 200
+        assert json.loads(content)["result"] == {"a": "changed"}
+
+    async def test_proxy_revalidates(self, resource, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, compress=True, cache_size=1)
+        for _ in range(2):
+            assert await proxy.callRemote("data", "a") == {"a": resource.value}
+        resource.value = "changed"
+        assert await proxy.callRemote("data", "a") == {"a": "changed"}
+        assert await proxy.callRemote("data", "b") == {"b": "changed"}
+        # Only the most recent result is kept.
+        assert await proxy.callRemote("data", "a") == {"a": "changed"}
+        assert resource.codes == [200, 304, 200, 200, 200]
+
+    async def test_proxy_uses_fresh_results(self):
+        resource = ConditionalJsonRpcTest(max_age=60)
+        p = reactor.listenTCP(0, server.Site(resource), interface="127.0.0.1")
+        try:
+            proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % p.getHost().port, cache_size=10)
+            for _ in range(3):
+                assert await proxy.callRemote("data", "a") == {"a": resource.value}
+            assert resource.codes == [200]
+        finally:
+            await p.stopListening()
+
+
+class ThreadedJsonRpcTest(jsonrpc.JSONRPC):
+    except_map = {ValueErrorTest: 42}
+
+    @jsonrpc.in_thread()
+    def jsonrpc_main_thread(self):
+        import threading
+        return threading.current_thread() is threading.main_thread()
+
+    @jsonrpc.in_thread()
+    def jsonrpc_fail(self):
+        raise ValueErrorTest()
+
+
+class TestInThread:
+
+    @pytest.fixture
+    def site_port(self):
+        p = reactor.listenTCP(0, server.Site(ThreadedJsonRpcTest()), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    async def test_in_thread(self, proxy):
+        assert await proxy.callRemote("main_thread") is False
+
+    async def test_exception(self, proxy):
+        with pytest.raises(jsonrpc.Fault) as exc_info:
+            await proxy.callRemote("fail")
+        assert exc_info.value.faultCode == 42
+
+
+class LimitedJsonRpcTest(jsonrpc.JSONRPC):
+
+    def __init__(self):
+        jsonrpc.JSONRPC.__init__(self)
+        self.limiter = jsonrpc.Limiter(1, queue_size=0)
+        self.pending = []
+
+    def jsonrpc_wait(self):
+        self.pending.append(defer.Deferred())
+        return self.pending[-1]
+
+
+class TestLimiter:
+
+    @pytest.fixture
+    def resource(self):
+        return LimitedJsonRpcTest()
+
+    @pytest.fixture
+    def site_port(self, resource):
+        p = reactor.listenTCP(0, server.Site(resource), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    async def test_overloaded(self, resource, site_port):
+        body = b'{"jsonrpc": "2.0", "method": "wait", "id": 1}'
+        first = defer.ensureDeferred(post(site_port, body))
+        for _ in range(500):
+            if resource.pending:
+                break
+            await deferLater(reactor, 0.01)
+        response, content = await post(site_port, body)
+        assert response.code == 503
+        assert json.loads(content)["error"]["code"] == jsonrpclib.SERVER_OVERLOADED
+        resource.pending[0].callback("done")
+        response, content = await first
+        assert response.code == 200
+        assert json.loads(content)["result"] == "done"
+
+    async def test_batch(self, resource, site_port):
+        batch = defer.ensureDeferred(post(
+            site_port, b'[{"jsonrpc": "2.0", "method": "wait", "id": 1},'
+                       b' {"jsonrpc": "2.0", "method": "wait", "id": 2}]'))
+        for _ in range(500):
+            if resource.pending:
+                break
+            await deferLater(reactor, 0.01)
+        resource.pending[0].callback("done")
+        response, content = await batch
+        assert response.code == 200
+        assert json.loads(content)[0]["result"] == "done"
+        assert json.loads(content)[1]["error"]["code"] == jsonrpclib.SERVER_OVERLOADED
+
+
+class AsyncJsonRpcTest(jsonrpc.JSONRPC):
+
+    def __init__(self):
+        jsonrpc.JSONRPC.__init__(self)
+        self.pending = []
+        self.cancelled = []
+
+    async def jsonrpc_double(self, value):
+        return await deferLater(reactor, 0, lambda: value * 2)
+
+    async def jsonrpc_fault(self):
+        await deferLater(reactor, 0)
+        raise jsonrpclib.Fault(42, "async fault")
+
+    @with_request
+    async def jsonrpc_method(self, request):
+        return request.method.decode()
+
+    @jsonrpc.requires_auth
+    async def jsonrpc_authorized(self):
+        return "ok"
+
+    async def jsonrpc_wait(self):
+        self.pending.append(defer.Deferred())
+        try:
+            return await self.pending[-1]
+        except defer.CancelledError:
+            self.cancelled.append(True)
+            raise
+
+
+class TestCoroutines:
+
+    @pytest.fixture
+    def resource(self):
+        return AsyncJsonRpcTest()
+
+    @pytest.fixture
+    def proxy(self, resource):
+        p = reactor.listenTCP(0, server.Site(resource), interface="127.0.0.1")
+        yield jsonrpc.Proxy("http://127.0.0.1:%d/" % p.getHost().port, version=jsonrpclib.VERSION_2)
+        p.stopListening()
+
+    async def test_result(self, proxy):
+        assert await proxy.callRemote("double", 21) == 42
+
+    async def test_fault(self, proxy):
+        with pytest.raises(jsonrpclib.Fault, match="async fault"):
+            await proxy.callRemote("fault")
+
+    async def test_with_request(self, proxy):
+        assert await proxy.callRemote("method") == "POST"
+
+    async def test_requires_auth(self, proxy):
+        assert await proxy.callRemote("authorized") == "ok"
+
+    async def test_batch(self, proxy):
+        calls = proxy.callRemoteBatch(("double", 1), ("double", 2))
+        assert await defer.gatherResults(calls) == [2, 4]
+
+    async def test_cancel(self, resource, proxy):
+        d = proxy.callRemote("wait")
+        for _ in range(500):
+            if resource.pending:
+                break
+            await deferLater(reactor, 0.01)
+        d.cancel()
+        with pytest.raises(defer.CancelledError):
+            await d
+        # The client went away, which cancels the coroutine.
+        for _ in range(500):
+            if resource.cancelled:
+                break
+            await deferLater(reactor, 0.01)
+        assert resource.cancelled == [True]
+
+
+class SlowJsonRpcTest(jsonrpc.JSONRPC):
+
+    def __init__(self):
+        jsonrpc.JSONRPC.__init__(self)
+        self.pending = []
+
+    def jsonrpc_wait(self, value):
+        self.pending.append(defer.Deferred())
+        return self.pending[-1].addCallback(lambda _: value)
+
+
+class TestProxyLimits:
+
+    @pytest.fixture
+    def resource(self):
+        return SlowJsonRpcTest()
+
+    @pytest.fixture
+    def site_port(self, resource):
+        p = reactor.listenTCP(0, server.Site(resource), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    async def wait_pending(self, resource, count):
+        for _ in range(500):
+            if len(resource.pending) >= count:
+                return
+            await deferLater(reactor, 0.01)
+
+    async def test_timeout(self, resource, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, timeout=0.1)
+        with pytest.raises(TimeoutError):
+            await proxy.callRemote("wait", 1)
+        # The request was cancelled, which cancels the call on the server.
+        await self.wait_pending(resource, 1)
+        for _ in range(500):
+            if resource.pending[0].called:
+                break
+            await deferLater(reactor, 0.01)
+        assert resource.pending[0].called
+        assert len(proxy.requests) == 0
+
+    async def test_timeout_per_call(self, resource, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, timeout=0.01)
+        d = proxy.callRemote("wait", 1, timeout=10)
+        await self.wait_pending(resource, 1)
+        resource.pending[0].callback(None)
+        assert await d == 1
+
+    async def test_cancel(self, resource, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port)
+        d = proxy.callRemote("wait", 1)
+        await self.wait_pending(resource, 1)
+        d.cancel()
+        with pytest.raises(defer.CancelledError):
+            await d
+
+    async def test_max_in_flight(self, resource, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, max_in_flight=2)
+        assert proxy.pool.maxPersistentPerHost == 2
+        calls = [proxy.callRemote("wait", value) for value in range(3)]
+        await self.wait_pending(resource, 2)
+        await deferLater(reactor, 0.05)
+        assert len(resource.pending) == 2
+        resource.pending[0].callback(None)
+        await self.wait_pending(resource, 3)
+        for d in resource.pending[1:]:
+            d.callback(None)
+        assert [await call for call in calls] == [0, 1, 2]
+
+    async def test_cancel_waiting(self, resource, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, max_in_flight=1)
+        first = proxy.callRemote("wait", 1)
+        second = proxy.callRemote("wait", 2)
+        await self.wait_pending(resource, 1)
+        second.cancel()
+        with pytest.raises(defer.CancelledError):
+            await second
+        assert len(proxy.requests) == 1
+        resource.pending[0].callback(None)
+        assert await first == 1
+        assert len(proxy.requests) == 0
+        # The cancelled call never made its request.
+        assert len(resource.pending) == 1
+
+    async def test_batch_timeout(self, resource, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, version=jsonrpclib.VERSION_2, timeout=0.1)
+        first, second = proxy.callRemoteBatch(("wait", 1), ("wait", 2))
+        for d in (first, second):
+            with pytest.raises(TimeoutError):
+                await d
+
+    def test_pool_settings(self):
+        proxy = jsonrpc.Proxy("http://127.0.0.1/", max_persistent_per_host=8, cached_connection_timeout=30)
+        assert proxy.pool.maxPersistentPerHost == 8
+        assert proxy.pool.cachedConnectionTimeout == 30
+
+
+class TestMetrics:
+
+    @pytest.fixture
+    def resource(self):
+        resource = JsonRpcTest()
+        resource.metrics = Metrics()
+        addIntrospection(resource)
+        return resource
+
+    @pytest.fixture
+    def site_port(self, resource):
+        root = static.Data(b"", "text/plain")
+        root.putChild(b"rpc", resource)
+        root.putChild(b"metrics", MetricsResource(resource.metrics.snapshot))
+        p = reactor.listenTCP(0, server.Site(root), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    @pytest.fixture
+    def proxy(self, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/rpc" % site_port, version=jsonrpclib.VERSION_2, compress=["gzip"])
+        proxy.metrics = Metrics()
+        return proxy
+
+    async def test_calls(self, resource, proxy):
+        assert await proxy.callRemote("add", 1, 2) == 3
+        assert len(await proxy.callRemote("huge")) == 1001
+        with pytest.raises(jsonrpc.Fault):
+            await proxy.callRemote("fail")
+        metrics = resource.metrics
+        assert (metrics.methods["add"].calls, metrics.methods["add"].errors) == (1, 0)
+        assert (metrics.methods["fail"].calls, metrics.methods["fail"].errors) == (1, 1)
+        assert metrics.request_bytes.count == 3
+        assert metrics.response_bytes.count == 3
+        assert metrics.serialization.count == 3
+        assert 0 < metrics.compression_ratio("gzip") < 1
+        assert proxy.metrics.client_methods["fail"].errors == 1
+
+    async def test_system_stats(self, proxy):
+        await proxy.callRemote("add", 1, 2)
+        stats = await proxy.callRemote("system.stats")
+        assert stats["methods"]["add"]["calls"] == 1
+        assert stats["methods"]["add"]["latency"]["count"] == 1
+
+    async def test_prometheus(self, site_port, proxy):
+        await proxy.callRemote("add", 1, 2)
+        response = await client.Agent(reactor).request(b"GET", b"http://127.0.0.1:%d/metrics" % site_port)
+        assert response.headers.getRawHeaders(b"content-type")[0].startswith(b"text/plain")
+        body = await client.readBody(response)
+        assert b'txjsonrpc_calls_total{method="add",side="server"} 1' in body.splitlines()
+
 
 class TestProxyVersionPre1(TestJSONRPCTest):
     """
@@ -301,6 +892,161 @@ class TestCompression:
         assert len(response) > 1000
 
 
+class TestCompressionNegotiation:
+
+    @pytest.fixture(params=encodings.available())
+    def encoding(self, request):
+        return request.param
+
+    @pytest.fixture
+    def site_port(self, encoding):
+        json_rpc_test = JsonRpcTest()
+        json_rpc_test.compression = CompressionSettings(encodings=(encoding,), min_size=100)
+        p = reactor.listenTCP(0, server.Site(json_rpc_test), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    async def test_round_trip(self, site_port, encoding):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, compress=True)
+        assert await proxy.callRemote("huge") == "0123456789" * 100 + "X"
+
+    async def test_response_headers(self, site_port, encoding):
+        agent = client.Agent(reactor)
+        response = await agent.request(
+            b"POST", b"http://127.0.0.1:%d/" % site_port,
+            Headers({b"Accept-Encoding": [b"gzip;q=0.5, deflate, br, zstd"]}),
+            client.FileBodyProducer(io.BytesIO(b'{"method": "huge", "params": []}')))
+        body = await client.readBody(response)
+
+        assert response.headers.getRawHeaders("content-encoding") == [encoding]
+        assert response.headers.getRawHeaders("vary") == ["Accept-Encoding"]
+        assert json.loads(encodings.decode(body, [encoding])) == ["0123456789" * 100 + "X"]
+
+    async def test_not_accepted(self, site_port, encoding):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, compress=["identity"])
+        assert await proxy.callRemote("huge") == "0123456789" * 100 + "X"
+
+
+class TestThreadedCompression:
+
+    @pytest.fixture(params=[False, True])
+    def thread_pool(self, request):
+        if not request.param:
+            yield None
+            return
+        pool = ThreadPool(minthreads=1, maxthreads=1)
+        pool.start()
+        yield pool
+        pool.stop()
+
+    @pytest.fixture
+    def site_port(self, thread_pool):
+        json_rpc_test = JsonRpcTest()
+        json_rpc_test.compression = CompressionSettings(thread_threshold=1000, thread_pool=thread_pool)
+        p = reactor.listenTCP(0, server.Site(json_rpc_test), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    async def test_compressed_in_thread(self, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, compress=True)
+        assert await proxy.callRemote("huge") == "0123456789" * 100 + "X"
+        assert await proxy.callRemote("add", 1, 2) == 3
+
+    async def test_request_lost_while_compressing(self):
+        request = MagicMock()
+        request.getHeader.return_value = "gzip"
+        finished = defer.Deferred()
+        request.notifyFinish.return_value = finished
+        renderer = DefaultRenderer(b"x" * 2000, "id1", 1, request, CompressionSettings(thread_threshold=0))
+
+        d = renderer.render(lambda result, id, version: result)
+        finished.errback(ConnectionLost())
+        await d
+
+        assert renderer.request_lost
+        request.write.assert_not_called()
+
+
+class StreamingJsonRpcTest(jsonrpc.JSONRPC):
+
+    def jsonrpc_stream(self, count):
+        return StreamingResult([{"index": i, "name": "item %d" % i} for i in range(count)])
+
+    def jsonrpc_unserializable(self):
+        return StreamingResult(list(range(100000)) + [object()])
+
+
+class TestStreaming:
+
+    @pytest.fixture
+    def site_port(self):
+        p = reactor.listenTCP(0, server.Site(StreamingJsonRpcTest()), interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    @pytest.mark.parametrize("version", [jsonrpclib.VERSION_PRE1, jsonrpclib.VERSION_2])
+    @pytest.mark.parametrize("compress", [False] + [[name] for name in encodings.available()])
+    async def test_round_trip(self, site_port, version, compress):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, version=version, compress=compress)
+        result = await proxy.callRemote("stream", 20000)
+        assert result == [{"index": i, "name": "item %d" % i} for i in range(20000)]
+
+    async def test_chunked(self, site_port):
+        response, body = await post(site_port, b'{"jsonrpc": "2.0", "method": "stream", "params": [3], "id": 1}')
+
+        assert not response.headers.hasHeader(b"content-length")
+        assert json.loads(body)["result"][2] == {"index": 2, "name": "item 2"}
+
+    async def test_serialization_error_drops_connection(self, site_port):
+        with pytest.raises(client.ResponseFailed):
+            await post(site_port, b'{"jsonrpc": "2.0", "method": "unserializable", "id": 1}')
+
+    async def test_backpressure(self):
+        request = MagicMock()
+        request.getHeader.return_value = None
+        renderer = StreamingRenderer(StreamingResult(None), "id1", 2, request)
+
+        def write(data):
+            # The transport buffer fills up on the first write only.
+            if request.write.call_count == 1:
+                renderer.pauseProducing()
+
+        request.write.side_effect = write
+
+        d = renderer.render(lambda result, id, version: iter([b"0", b"1", b"2"]))
+        request.registerProducer.assert_called_once_with(renderer, True)
+        await deferLater(reactor, 0.05)
+        assert [call.args for call in request.write.call_args_list] == [(b"0",)]
+
+        renderer.resumeProducing()
+        await d
+        assert b"".join(call.args[0] for call in request.write.call_args_list) == b"012"
+        request.unregisterProducer.assert_called_once_with()
+
+    async def test_stop_producing(self):
+        request = MagicMock()
+        request.getHeader.return_value = None
+        renderer = StreamingRenderer(StreamingResult(None), "id1", 2, request)
+
+        def chunks(result, id, version):
+            yield b"0"
+            renderer.stopProducing()
+            yield b"1"
+
+        await renderer.render(chunks)
+
+        assert renderer.request_lost
+        request.loseConnection.assert_not_called()
+
+    def test_producing_before_render(self):
+        renderer = StreamingRenderer(StreamingResult(None), "id1", 2, MagicMock())
+        renderer.pauseProducing()
+        renderer.resumeProducing()
+        renderer.stopProducing()
+        assert not renderer.paused
+        assert renderer.request_lost
+
+
 class TestAuthenticatedProxy(TestJSONRPCTest):
     """
     Test with authenticated proxy. We run this with the same inout/ouput as
@@ -354,6 +1100,121 @@ class ProxyErrorHandlingTestCase:
             await proxy.callRemote("someMethod"), Exception)
 
 
+async def post(site_port, body, headers=None):
+    response = await send(site_port, body, headers)
+    return response, await client.readBody(response)
+
+
+def send(site_port, body, headers=None):
+    agent = client.Agent(reactor)
+    return agent.request(
+        b"POST", b"http://127.0.0.1:%d/" % site_port,
+        Headers({b"Content-Type": [b"application/json"], **(headers or {})}),
+        client.FileBodyProducer(io.BytesIO(body)))
+
+
+class TestRequestBody:
+
+    body = b'{"jsonrpc": "2.0", "method": "defer", "params": ["%s"], "id": 1}' % (b"x" * 2000)
+
+    @pytest.fixture
+    def site_port(self):
+        site = jsonrpc.JSONRPCSite(JsonRpcTest(), max_body_size=5000)
+        p = reactor.listenTCP(0, site, interface="127.0.0.1")
+        yield p.getHost().port
+        p.stopListening()
+
+    async def test_plain(self, site_port):
+        response, body = await post(site_port, self.body)
+        assert json.loads(body)["result"] == "x" * 2000
+
+    @pytest.mark.parametrize("name", encodings.available())
+    async def test_compressed(self, site_port, name):
+        compressed = encodings.encodings[name].compress(self.body)
+        response, body = await post(site_port, compressed, {b"Content-Encoding": [name.encode()]})
+        assert json.loads(body)["result"] == "x" * 2000
+
+    async def test_content_length_too_large(self, site_port):
+        response = await send(site_port, b" " * 5001)
+        assert response.code == 413
+
+    async def test_decoded_body_too_large(self, site_port):
+        response = await send(site_port, gzip.compress(b" " * 100000), {b"Content-Encoding": [b"gzip"]})
+        assert response.code == 413
+
+    async def test_unsupported_encoding(self, site_port):
+        response = await send(site_port, self.body, {b"Content-Encoding": [b"unknown"]})
+        assert response.code == 415
+
+    async def test_stacked_encodings(self, site_port):
+        compressed = gzip.compress(gzip.compress(self.body))
+        response = await send(site_port, compressed, {b"Content-Encoding": [b"gzip, gzip"]})
+        assert response.code == 415
+
+    async def test_invalid_compressed_data(self, site_port):
+        response = await send(site_port, self.body, {b"Content-Encoding": [b"gzip"]})
+        assert response.code == 400
+
+    async def test_response_too_large(self, site_port):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % site_port, compress=True, max_body_size=100)
+        assert await proxy.callRemote("add", 1, 2) == 3
+        with pytest.raises(encodings.BodyTooLarge):
+            await proxy.callRemote("huge")
+
+
+class TestBatch:
+
+    async def test_batch(self, site_port):
+        body = (b'[{"jsonrpc": "2.0", "method": "add", "params": [1, 2], "id": 1},'
+                b' {"jsonrpc": "2.0", "method": "defer", "params": ["a"], "id": "b"},'
+                b' {"jsonrpc": "2.0", "method": "add", "params": [3, 4]},'
+                b' {"jsonrpc": "2.0", "method": "fault", "id": 3},'
+                b' 17]')
+
+        response, content = await post(site_port, body)
+
+        assert json.loads(content) == [
+            {"jsonrpc": "2.0", "result": 3, "id": 1},
+            {"jsonrpc": "2.0", "result": "a", "id": "b"},
+            {"jsonrpc": "2.0", "error": {"message": "hello", "code": 12, "data": ""}, "id": 3},
+            {"jsonrpc": "2.0", "error": {"message": "invalid request", "code": -32600, "data": ""}, "id": None},
+        ]
+
+    async def test_notifications_only(self, site_port):
+        body = b'[{"jsonrpc": "2.0", "method": "add", "params": [1, 2]}]'
+
+        response, content = await post(site_port, body)
+
+        assert response.code == 200
+        assert content == b""
+
+    async def test_empty_batch(self, site_port):
+        response, content = await post(site_port, b"[]")
+
+        assert json.loads(content)["error"]["code"] == -32600
+
+
+class TestProxyBatch:
+
+    async def test_batch(self, proxy):
+        calls = proxy.batch().call("add", 1, 2).call("defer", "a").call("fault").send()
+
+        assert await calls[0] == 3
+        assert await calls[1] == "a"
+        with pytest.raises(jsonrpclib.Fault) as e_info:
+            await calls[2]
+        assert e_info.value.faultCode == 12
+        assert len(proxy.requests) == 0
+
+    async def test_call_remote_batch(self, proxy):
+        calls = proxy.callRemoteBatch(("add", 1, 2), ("pair", "a", 1))
+
+        assert await defer.gatherResults(calls) == [3, ["a", 1]]
+
+    def test_empty_batch(self, proxy):
+        assert proxy.batch().send() == []
+
+
 class TestRenderer:
     """Test render.py classes."""
 
@@ -379,8 +1240,24 @@ class TestRenderer:
         renderer.render(string_renderer)
         request.write.assert_called_once()
 
-    def test_cacheable_result_renderer_with_cached_value(self):
-        """Test CacheableResultRenderer with cached compressed value."""
+    @pytest.mark.parametrize("settings, logged", (
+            (CompressionSettings(), 0),
+            (CompressionSettings(log_compression=True), 1),
+    ))
+    def test_log_compression(self, settings, logged):
+        request = MagicMock()
+        request.getHeader.return_value = "gzip"
+        events = []
+        globalLogPublisher.addObserver(events.append)
+        try:
+            DefaultRenderer(b"x" * 2000, "id1", 1, request, settings).render(lambda result, id, version: result)
+        finally:
+            globalLogPublisher.removeObserver(events.append)
+        request.setHeader.assert_any_call("content-encoding", "gzip")
+        assert len([event for event in events if "compress data" in event.get("log_format", "")]) == logged
+
+    def test_cacheable_result_renderer(self):
+        """Test CacheableResultRenderer builds the response around the serialized value."""
         from txjsonrpc_ng.web.render import CacheableResultRenderer
 
         # Create mock request
@@ -389,44 +1266,70 @@ class TestRenderer:
         request.setHeader = MagicMock()
         request.write = MagicMock()
 
-        # Create CacheableResult with cached values
         cache_result = CacheableResult("test_value")
-        cache_result.string_value = "cached_string"
-        cache_result.compressed_value = b"cached_compressed"
+        assert cache_result.body is None
 
-        renderer = CacheableResultRenderer(cache_result, "id1", 1, request)
+        renderer = CacheableResultRenderer(cache_result, "id1", 2, request)
 
         def string_renderer(result, id, version):
-            return f"result:{result}"
+            raise AssertionError("not used for serializable results")
 
         renderer.render(string_renderer)
-        request.write.assert_called_once()
 
-    def test_cacheable_result_renderer_without_cached_value(self):
-        """Test CacheableResultRenderer without cached values."""
+        assert cache_result.body == b'"test_value"'
+        request.write.assert_called_once_with(b'{"jsonrpc":"2.0","result":"test_value","id":"id1"}')
+
+    def test_cacheable_result_renderer_not_serializable(self):
+        """Test CacheableResultRenderer leaves unserializable results to the string renderer."""
         from txjsonrpc_ng.web.render import CacheableResultRenderer
 
-        # Create mock request
         request = MagicMock()
         request.getHeader.return_value = None
-        request.setHeader = MagicMock()
-        request.write = MagicMock()
 
-        # Create CacheableResult without cached values
-        cache_result = CacheableResult("test_value")
-        assert cache_result.string_value is None
-        assert cache_result.compressed_value is None
+        renderer = CacheableResultRenderer(CacheableResult(object()), "id1", 1, request)
+        renderer.render(lambda result, id, version: b"rendered_result_string")
 
-        renderer = CacheableResultRenderer(cache_result, "id1", 1, request)
+        request.write.assert_called_once_with(b"rendered_result_string")
 
-        def string_renderer(result, id, version):
-            return "rendered_result_string"
+    @pytest.mark.parametrize("encoding", ("gzip", "deflate", "br", "zstd"))
+    @pytest.mark.parametrize("version", (0, 1, 2))
+    @pytest.mark.parametrize("callback", (None, b"cb"))
+    def test_cacheable_result_renderer_compressed(self, encoding, version, callback):
+        """Test compressed responses of CacheableResultRenderer for several calls."""
+        from txjsonrpc_ng.web.render import CacheableResultRenderer
 
-        renderer.render(string_renderer)
+        if encoding not in encodings.encodings:
+            pytest.skip("%s not available" % encoding)
+        cache_result = CacheableResult(["0123456789"] * 200)
+        for id in (1, 2):
+            request = MagicMock()
+            request.getHeader.return_value = encoding
+            renderer = CacheableResultRenderer(cache_result, id, version, request, callback=callback)
+            renderer.render(lambda result, id, version: b"")
+            data = request.write.call_args[0][0]
+            assert encodings.encodings[encoding].decompress(data) == cache_result.serialize(id, version, callback)
+        if callback is not None:
+            # JSONP responses are compressed per call.
+            assert cache_result.compressed_values == {}
+        elif version == 0 or encoding in ("gzip", "deflate"):
+            assert list(cache_result.compressed_values) == [(encoding, version)]
+
+    def test_cacheable_result_renderer_compressed_in_thread(self):
+        """Test CacheableResultRenderer keeps compressed data only in the reactor thread."""
+        from txjsonrpc_ng.web.render import CacheableResultRenderer
 
-        # Should have called string_renderer and stored result
-        assert cache_result.string_value == "rendered_result_string"
-        request.write.assert_called_once()
+        cache_result = CacheableResult(["0123456789"] * 200)
+        request = MagicMock()
+        request.getHeader.return_value = "gzip"
+        compression = CompressionSettings(thread_threshold=0)
+        renderer = CacheableResultRenderer(cache_result, 1, 2, request, compression)
+        response = cache_result.serialize(1, 2)
+        # As it runs in a worker thread.
+        compressed = renderer.compress(response, "gzip")
+        assert cache_result.compressed_values == {}
+        renderer.write_compressed(compressed, "gzip", len(response), 0, None)
+        assert list(cache_result.compressed_values) == [("gzip", 2)]
+        assert gzip.decompress(request.write.call_args[0][0]) == response
 
     def test_renderer_factory_cacheable(self):
         """Test renderer_factory returns CacheableResultRenderer for CacheableResult."""
@@ -0,0 +1,108 @@
+"""
+Calling JSON-RPC servers from asyncio code.
+
+AsyncProxy wraps a web or netstring Proxy so that calls are awaited as
+coroutines rather than Deferreds:
+
+    async with AsyncProxy("http://127.0.0.1:7080/", version=VERSION_2) as proxy:
+        total = await proxy.call("add", 1, 2)
+        results = await proxy.gather(("add", 1, 2), ("add", 3, 4))
+
+It needs the asyncio reactor, installed with the event loop the calls are
+made from before the reactor is imported; see docs/USAGE.md.
+"""
+import asyncio
+
+from twisted.internet import reactor
+from twisted.web.client import HTTPConnectionPool
+
+from txjsonrpc_ng.limits import Limiter
+from txjsonrpc_ng.web.jsonrpc import Proxy
+from txjsonrpc_ng.workers import _asyncio_reactor
+
+# Idle connections the shared pool keeps per host.
+SHARED_POOL_SIZE = 16
+
+_shared_pool = None
+
+
+def shared_pool():
+    """
+    Return the HTTP connection pool of the AsyncProxy instances created
+    without a pool, so they reuse each other's connections.
+    """
+    global _shared_pool
+    if _shared_pool is None:
+        _shared_pool = HTTPConnectionPool(reactor)
+        _shared_pool.maxPersistentPerHost = SHARED_POOL_SIZE
+    return _shared_pool
+
+
+class AsyncProxy:
+    """
+    An asyncio facade for a Proxy.
+
+    @type proxy: C{str} or a web or netstring C{Proxy}
+    @ivar proxy: The proxy making the calls. A URL is turned into a web
+    Proxy using the pool, shared_pool() by default, and the further keyword
+    arguments.
+
+    @type max_in_flight: C{int} or None
+    @ivar max_in_flight: The maximum number of calls made at once, e.g. by
+    gather(); further calls wait until one of them has finished.
+    """
+
+    def __init__(self, proxy, max_in_flight=None, pool=None, **kwargs):
+        if not _asyncio_reactor():
+            raise RuntimeError("AsyncProxy needs the asyncio reactor")
+        if isinstance(proxy, str):
+            proxy = Proxy(proxy, pool=pool or shared_pool(), **kwargs)
+        self.proxy = proxy
+        self.limiter = Limiter(max_in_flight) if max_in_flight is not None else None
+        self.calls = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def call(self, method, *args, **kwargs):
+        """
+        Call method with args and return its result. Faults and other
+        errors are raised; cancelling the call cancels the request.
+        """
+        if self.limiter is not None:
+            d = self.limiter.run(self.proxy.callRemote, method, *args, **kwargs)
+        else:
+            d = self.proxy.callRemote(method, *args, **kwargs)
+        self.calls.add(d)
+        try:
+            return await d.asFuture(asyncio.get_running_loop())
+        finally:
+            self.calls.discard(d)
+
+    async def gather(self, *calls, return_exceptions=False):
+        """
+        Make each (method, *args) call of calls concurrently, at most
+        max_in_flight at once, and return their results in order.
+        """
+        return await asyncio.gather(*(self.call(method, *args) for method, *args in calls),
+                                    return_exceptions=return_exceptions)
+
+    async def close(self):
+        """
+        Cancel the calls still in flight, which fail with
+        twisted.internet.defer.CancelledError, and close the connection of a
+        persistent netstring proxy. Connection pools stay open.
+        """
+        for d in list(self.calls):
+            d.cancel()
+        disconnect = getattr(self.proxy, "disconnect", None)
+        if disconnect is not None:
+            disconnect()
+        # Let the cancelled calls finish.
+        await asyncio.sleep(0)
+
+
+__all__ = ["AsyncProxy", "shared_pool"]
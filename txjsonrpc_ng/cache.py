@@ -0,0 +1,255 @@
+"""
+Caching of method results.
+
+Decorate a jsonrpc_ method with cached to keep its results, keyed by the
+call parameters. Results are kept as CacheableResult instances, so their
+serialized value and compressed responses are kept with them.
+"""
+import collections
+import functools
+import inspect
+import json
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from txjsonrpc_ng import jsonrpclib
+from txjsonrpc_ng.web.data import CacheableResult, RawJSON
+from txjsonrpc_ng.workers import run_coroutine
+
+
+class ResultCache:
+    """
+    Least recently used cache of CacheableResults.
+
+    @type maxsize: C{int} or None
+    @ivar maxsize: The maximum number of entries.
+
+    @type ttl: C{float} or None
+    @ivar ttl: Seconds after which an entry expires.
+
+    @type maxbytes: C{int} or None
+    @ivar maxbytes: The maximum size of the serialized and compressed data
+    kept by all entries. As the renderers add these to a result after it has
+    been cached, the limit is enforced whenever an entry is added.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Return the cached result for key, or None.
+        """
+        try:
+            expires, result = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires is not None and expires <= self.clock():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self.entries[key] = (expires, result)
+        self.entries.move_to_end(key)
+        while self.maxsize is not None and len(self.entries) > self.maxsize:
+            self._evict()
+        if self.maxbytes is not None:
+            size = self.nbytes()
+            while size > self.maxbytes and self.entries:
+                size -= self._evict().nbytes()
+
+    def _evict(self):
+        _, (_, result) = self.entries.popitem(last=False)
+        self.evictions += 1
+        return result
+
+    def clear(self):
+        self.entries.clear()
+
+    def nbytes(self):
+        """
+        Return the size of the serialized and compressed data of all entries.
+        """
+        return sum(result.nbytes() for _, result in self.entries.values())
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.nbytes(),
+        }
+
+
+def call_key(args, kwargs):
+    """
+    Return a canonical key for the parameters of a call.
+    """
+    return json.dumps([args, kwargs], sort_keys=True, separators=(",", ":"), default=repr)
+
+
+class SingleFlight:
+    """
+    Run a call only once while identical calls are in flight.
+
+    Calls with the same key which are made before the first one has finished
+    wait for its result instead of running again. Every caller gets its own
+    Deferred; the shared call is only cancelled once all of them have been.
+    Plain JSON results are shared as a CacheableResult, so the response is
+    serialized and compressed once for all callers where possible.
+    """
+
+    def __init__(self):
+        self.inflight = {}
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def call(self, key, function, *args, **kwargs):
+        try:
+            shared, waiters = self.inflight[key]
+        except KeyError:
+            shared = defer.maybeDeferred(function, *args, **kwargs)
+            if shared.called:
+                # Finished synchronously, so there is nothing to share.
+                return shared
+            waiters = []
+            self.inflight[key] = (shared, waiters)
+            shared.addBoth(self._done, key)
+
+        def cancel(waiter):
+            waiters.remove(waiter)
+            if not waiters:
+                shared.cancel()
+
+        waiter = defer.Deferred(cancel)
+        waiters.append(waiter)
+        return waiter
+
+    def _done(self, result, key):
+        _, waiters = self.inflight.pop(key)
+        if isinstance(result, failure.Failure):
+            for waiter in waiters:
+                waiter.errback(result)
+            return None
+        if isinstance(result, _PLAIN) and len(waiters) > 1:
+            result = CacheableResult(result)
+        for waiter in waiters:
+            waiter.callback(result)
+        return None
+
+
+# Results shared by SingleFlight as CacheableResult; other objects, like
+# None or Handler instances, have a meaning of their own to the servers.
+_PLAIN = (dict, list, tuple, str, int, float, RawJSON)
+
+
+def single_flight(method):
+    """
+    Decorator to run a jsonrpc_ method only once for concurrent calls with
+    the same parameters; see SingleFlight.
+
+    The calls are shared by all instances of the class and all clients, so
+    the result must only depend on the parameters; methods taking the
+    request or connection (with_request, with_protocol) raise TypeError.
+    The SingleFlight is available as the flights attribute of the decorated
+    method.
+    """
+    _check_shareable(method, "single_flight")
+    flights = SingleFlight()
+    function = _coroutine(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        _check_shareable(wrapper, "single_flight")
+        key = call_key(args, kwargs)
+        return flights.call(key, function, self, *args, **kwargs)
+
+    wrapper.flights = flights
+    return wrapper
+
+
+def cached(ttl=None, maxsize=128, maxbytes=None, max_age=None):
+    """
+    Decorator to cache the results of a jsonrpc_ method by its parameters.
+
+    The cache is kept per method and shared by all instances of the class
+    and all clients, so the result must only depend on the parameters;
+    methods taking the request or connection (with_request, with_protocol)
+    raise TypeError. Faults and exceptions are not cached. The ResultCache is available as
+    the cache attribute of the decorated method, e.g. for its stats().
+    If max_age is given, the web server tells clients that they may use a
+    result for that many seconds without asking again.
+    """
+    def decorator(method):
+        _check_shareable(method, "cached")
+        cache = ResultCache(maxsize, ttl, maxbytes)
+        function = _coroutine(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            _check_shareable(wrapper, "cached")
+            key = call_key(args, kwargs)
+            result = cache.get(key)
+            if result is not None:
+                return result
+            result = function(self, *args, **kwargs)
+            if isinstance(result, defer.Deferred):
+                return result.addCallback(store, key)
+            return store(result, key)
+
+        def store(result, key):
+            if isinstance(result, jsonrpclib.Fault):
+                return result
+            if not isinstance(result, CacheableResult):
+                result = CacheableResult(result, max_age=max_age)
+            cache.put(key, result)
+            return result
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def _check_shareable(method, decorator):
+    """
+    Raise TypeError if method is passed the request or connection, which
+    a result shared by all callers cannot depend on. with_request may be
+    applied after the decorator, so this is checked again per call.
+    """
+    if getattr(method, "with_request", False):
+        raise TypeError("%s cannot be combined with with_request or with_protocol, "
+                        "as its results are shared by all callers" % decorator)
+
+
+def _coroutine(method):
+    """
+    Return a function calling method which returns a Deferred rather than a
+    coroutine if method is a coroutine function.
+    """
+    if inspect.iscoroutinefunction(method):
+        return functools.partial(run_coroutine, method)
+    return method
+
+
+__all__ = ["ResultCache", "SingleFlight", "cached", "call_key", "single_flight"]
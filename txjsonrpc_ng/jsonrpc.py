@@ -1,9 +1,20 @@
+import collections
+import functools
+import inspect
+import itertools
+import weakref
 from typing import List
 
 from twisted.internet import defer, protocol
 from twisted.python import reflect
 
 from txjsonrpc_ng import jsonrpclib
+from txjsonrpc_ng.limits import limit
+from txjsonrpc_ng.metrics import REGISTRY
+from txjsonrpc_ng.workers import run_coroutine
+
+
+DispatchEntry = collections.namedtuple("DispatchEntry", "function with_request requires_auth")
 
 
 class BaseSubhandler:
@@ -16,9 +27,22 @@ class BaseSubhandler:
 
     def __init__(self):
         self.subHandlers = {}
+        # Full method path -> DispatchEntry, filled by _getDispatchEntry.
+        self.dispatchTable = {}
+        # The handlers this is a sub-handler of; created when it becomes
+        # one, as most handlers never do.
+        self._dispatchParents = None
 
     def putSubHandler(self, prefix, handler):
+        previous = self.subHandlers.get(prefix)
+        if isinstance(previous, BaseSubhandler) and previous._dispatchParents is not None:
+            previous._dispatchParents.discard(self)
         self.subHandlers[prefix] = handler
+        if isinstance(handler, BaseSubhandler):
+            if handler._dispatchParents is None:
+                handler._dispatchParents = weakref.WeakSet()
+            handler._dispatchParents.add(self)
+        self.invalidateDispatchTable()
 
     def getSubHandler(self, prefix):
         return self.subHandlers.get(prefix, None)
@@ -26,6 +50,51 @@ class BaseSubhandler:
     def getSubHandlerPrefixes(self):
         return self.subHandlers.keys()
 
+    def invalidateDispatchTable(self, _seen=None):
+        """
+        Forget the methods looked up by this handler and by all handlers it
+        is a sub-handler of.
+
+        This happens when putSubHandler changes the tree; call it yourself
+        if _getFunction would return something else for a path otherwise.
+        """
+        seen = set() if _seen is None else _seen
+        if id(self) in seen:
+            return
+        seen.add(id(self))
+        self.dispatchTable.clear()
+        for parent in list(self._dispatchParents or ()):
+            parent.invalidateDispatchTable(seen)
+
+    def _getDispatchEntry(self, functionPath):
+        """
+        Return the DispatchEntry for a method path, looking it up with
+        _getFunction on first use only.
+        """
+        try:
+            return self.dispatchTable[functionPath]
+        except KeyError:
+            pass
+        entry = self.dispatchTable[functionPath] = self._buildDispatchEntry(functionPath)
+        return entry
+
+    def _buildDispatchEntry(self, functionPath):
+        """
+        Look up a method path with _getFunction and return its DispatchEntry.
+        """
+        function = self._getFunction(functionPath)
+        with_request, requires_auth = hasattr(function, 'with_request'), hasattr(function, 'requires_auth')
+        # Methods decorated with workers.in_thread or in_process, and with
+        # limits.limited. Coroutine functions run with
+        # workers.run_coroutine.
+        executor, limiter = getattr(function, 'executor', None), getattr(function, 'limiter', None)
+        if executor is not None:
+            function = functools.partial(executor.run, function)
+        elif inspect.iscoroutinefunction(function):
+            function = functools.partial(run_coroutine, function)
+        function = limit(limiter, function)
+        return DispatchEntry(function, with_request, requires_auth)
+
     def _getFunction(self, functionPath):
         """
         Given a string, return a function, or raise jsonrpclib.NoSuchFunction.
@@ -65,34 +134,100 @@ class BaseSubhandler:
         return reflect.prefixedMethodNames(self.__class__, 'jsonrpc_')
 
 
+class RequestRegistry:
+    """
+    Allocate request ids and keep track of the calls awaiting a reply.
+
+    Ids come from a monotonic counter and are therefore unique for the
+    lifetime of the registry, which is normally that of a proxy. A call
+    stays registered until its deferred has fired, so replies can be
+    dispatched to it by id in any order.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self._ids = itertools.count(1)
+
+    def register(self, query):
+        query.id = next(self._ids)
+        self.pending[query.id] = query
+        query.deferred.addBoth(self._release, query.id)
+        return query.id
+
+    def _release(self, result, id):
+        self.pending.pop(id, None)
+        return result
+
+    def pop(self, id):
+        return self.pending.pop(id, None)
+
+    def failAll(self, reason):
+        """
+        Fail all outstanding calls, e.g. because their connection was lost.
+        """
+        queries = list(self.pending.values())
+        self.pending.clear()
+        for query in queries:
+            query.clientConnectionFailed(None, reason)
+
+    def __len__(self):
+        return len(self.pending)
+
+
 class BaseQueryFactory(protocol.ClientFactory):
     deferred = None
     protocol = None  # type: ignore[assignment]
 
-    # XXX add an "id" parameter
-    id = 0
+    # Proxies assign a unique id through their RequestRegistry.
+    id = 1
 
     def __init__(self, method, version=jsonrpclib.VERSION_PRE1, *args):
-        # XXX pass the "id" parameter here
         self.version = version
-        self.id = self.id + 1
-        self.payload = self._buildVersionedPayload(method, args)
+        self.method = method
+        self.args = args
+        self._payload = None
         self.deferred = defer.Deferred()
 
-    def _buildVersionedPayload(self, *args):
-        if self.version == jsonrpclib.VERSION_PRE1:
-            return jsonrpclib._preV1Request(*args)
-        elif self.version == jsonrpclib.VERSION_1:
-            return jsonrpclib._v1Request(*args, id=self.id)
-        elif self.version == jsonrpclib.VERSION_2:
-            return jsonrpclib._v2Request(*args, id=self.id)
+    @property
+    def payload(self):
+        """
+        The serialized request, as bytes. It is built on first access, so
+        the request id may still be changed after the factory has been
+        created.
+        """
+        if self._payload is None:
+            self._payload = self._buildVersionedPayload(self.method, self.args)
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload = payload
+
+    def _buildVersionedPayload(self, method="", params=[]):
+        request = jsonrpclib._request(self.version, method, params, self.id)
+        if request is not None:
+            return jsonrpclib.dumpb(request)
 
     def parseResponse(self, contents):
+        if not self.deferred:
+            return
+        try:
+            unmarshalled = jsonrpclib.getCodec().loads(contents)
+        except Exception as error:
+            self.deferred.errback(error)
+            self.deferred = None
+        else:
+            self.parseUnmarshalled(unmarshalled)
+
+    def parseUnmarshalled(self, unmarshalled):
+        """
+        Fire the deferred with an already decoded response.
+        """
         if not self.deferred:
             return
         try:
             # Convert the response from JSON-RPC to python.
-            result = jsonrpclib.loads(contents)
+            result = jsonrpclib.checkFault(unmarshalled)
             if self.version != jsonrpclib.VERSION_PRE1:
                 result = result["result"]
             elif isinstance(result, list):
@@ -115,16 +250,100 @@ class BaseQueryFactory(protocol.ClientFactory):
         self.deferred.errback(ValueError(status, message))
         self.deferred = None
 
+class BaseBatch:
+    """
+    Collect calls to send them in a single JSON-RPC 2.0 batch request.
+
+    Add calls with batch.call(method, *args), which can be chained, then
+    use batch.send(), which returns one Deferred per call, in call order.
+    """
+    version = jsonrpclib.VERSION_2
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.queries = []
+
+    def call(self, method, *args):
+        query = BaseQueryFactory(method, self.version, *args)
+        self.proxy.requests.register(query)
+        self.queries.append(query)
+        return self
+
+    @property
+    def payload(self):
+        return jsonrpclib._v2BatchRequest(
+            [(query.method, query.args, query.id) for query in self.queries])
+
+    def send(self):
+        deferreds = [query.deferred for query in self.queries]
+        if self.queries:
+            self.proxy._sendBatch(self)
+        return deferreds
+
+    def parseUnmarshalled(self, unmarshalled):
+        """
+        Fire the deferred of every call from the matching reply element.
+        """
+        if not isinstance(unmarshalled, list):
+            unmarshalled = [unmarshalled]
+        queries = {query.id: query for query in self.queries}
+        orphan = None
+        for element in unmarshalled:
+            id = element.get("id") if isinstance(element, dict) else None
+            query = queries.pop(id, None)
+            if query is not None:
+                query.parseUnmarshalled(element)
+            elif id is None:
+                # An error which could not be attributed to a single call.
+                orphan = element
+        for query in queries.values():
+            if orphan is not None:
+                query.parseUnmarshalled(orphan)
+            else:
+                query.clientConnectionFailed(
+                    None, ValueError("no reply for request id %r" % query.id))
+
+    def fail(self, reason):
+        for query in self.queries:
+            query.clientConnectionFailed(None, reason)
+
+
+class BatchQueryMixin:
+    """
+    Make a query factory send a BaseBatch instead of a single call.
+
+    The factory's own deferred fires once the reply has been dispatched
+    to the calls of the batch; if it fails, all calls of the batch fail.
+    """
+
+    def _setBatch(self, batch):
+        self.batch = batch
+        self.payload = batch.payload
+        self.deferred.addErrback(batch.fail)
+
+    def parseUnmarshalled(self, unmarshalled):
+        if not self.deferred:
+            return
+        self.batch.parseUnmarshalled(unmarshalled)
+        self.deferred.callback(None)
+        self.deferred = None
+
+
 # see https://docs.twisted.org/en/stable/web/howto/client.html
 
 class BaseProxy:
     """
     A Proxy base class for making remote JSON-RPC calls.
+
+    Calls are recorded in metrics, metrics.REGISTRY by default; set it to
+    None to record nothing.
     """
+    metrics = REGISTRY
 
     def __init__(self, version=jsonrpclib.VERSION_PRE1, factoryClass=None):
         self.version = version
         self.factoryClass = factoryClass
+        self.requests = RequestRegistry()
 
     def _getVersion(self, keywords):
         version = keywords.get("version")
@@ -138,6 +357,25 @@ class BaseProxy:
             factoryClass = self.factoryClass
         return factoryClass
 
+    def batch(self):
+        """
+        Start a JSON-RPC 2.0 batch; see BaseBatch.
+        """
+        return BaseBatch(self)
+
+    def callRemoteBatch(self, *calls):
+        """
+        Send each (method, *args) tuple of calls in one batch request and
+        return one Deferred per call.
+        """
+        batch = self.batch()
+        for method, *args in calls:
+            batch.call(method, *args)
+        return batch.send()
+
+    def _sendBatch(self, batch):
+        raise NotImplementedError("Implement _sendBatch() in subclasses")
+
 
 class Introspection(BaseSubhandler):
     """
@@ -196,6 +434,15 @@ class Introspection(BaseSubhandler):
         method = self._jsonrpc_parent._getFunction(method)
         return getattr(method, 'signature', None) or ''
 
+    def jsonrpc_stats(self) -> dict:
+        """
+        Return the metrics recorded by this server; see
+        metrics.Metrics.snapshot. If it records none, an empty dict is
+        returned.
+        """
+        metrics = getattr(self._jsonrpc_parent, 'metrics', None)
+        return metrics.snapshot() if metrics is not None else {}
+
 
 def addIntrospection(jsonrpc):
     """
@@ -12,6 +12,8 @@ from datetime import datetime
 from xmlrpc.client import Fault as Fault
 
 import json
+import re
+from typing import Dict, Type
 
 # From xmlrpclib.
 SERVER_ERROR = xmlrpclib.SERVER_ERROR
@@ -25,6 +27,8 @@ INTERNAL_ERROR = xmlrpclib.INTERNAL_ERROR
 
 # Custom errors.
 METHOD_NOT_CALLABLE = -32604
+SERVER_OVERLOADED = -32000
+DEADLINE_EXCEEDED = -32001
 
 # Version constants.
 
@@ -50,7 +54,255 @@ class JSONRPCEncoder(json.JSONEncoder):
         raise TypeError("%r is not JSON serializable" % (obj,))
 
 
+class Codec:
+    """
+    A JSON backend used by dumps and loads.
+
+    dumps returns a str and dumpb UTF-8 encoded bytes; loads accepts either.
+    All of them must treat objects the way JSONRPCEncoder does, in
+    particular datetime objects.
+    """
+    name: str = ""
+
+    def dumps(self, obj):
+        raise NotImplementedError("Implement dumps() in subclasses")
+
+    def dumpb(self, obj):
+        return self.dumps(obj).encode()
+
+    def loads(self, string):
+        raise NotImplementedError("Implement loads() in subclasses")
+
+
+class JSONCodec(Codec):
+    """
+    The standard library json module.
+    """
+    name = "json"
+
+    def dumps(self, obj):
+        return json.dumps(obj, cls=JSONRPCEncoder)
+
+    def loads(self, string):
+        return json.loads(string)
+
+
+class OrjsonCodec(Codec):
+    """
+    orjson, if installed.
+
+    Objects orjson cannot encode, like integers beyond 64 bit, are encoded
+    with the standard library instead, and so is JSON with long numbers or
+    NaN and Infinity decoded. orjson encodes NaN and Infinity as null.
+    """
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return self.dumpb(obj).decode()
+
+    def dumpb(self, obj):
+        try:
+            return self._orjson.dumps(
+                obj, default=_encodeDefault, option=self._option)
+        except TypeError:
+            return json.dumps(obj, cls=JSONRPCEncoder).encode()
+
+    def loads(self, string):
+        if _hasLongNumber(string):
+            # orjson decodes integers beyond 64 bit as float.
+            return json.loads(string)
+        try:
+            return self._orjson.loads(string)
+        except self._orjson.JSONDecodeError:
+            # NaN, Infinity and numbers beyond the float range.
+            return json.loads(string)
+
+
+class UjsonCodec(Codec):
+    """
+    ujson, if installed.
+
+    Objects ujson cannot encode, like integers beyond 64 bit, are encoded
+    with the standard library instead, and so is JSON with long numbers or
+    NaN and Infinity decoded.
+    """
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        try:
+            return self._ujson.dumps(
+                obj, default=_encodeDefault, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return json.dumps(obj, cls=JSONRPCEncoder)
+
+    def loads(self, string):
+        if _hasLongNumber(string):
+            return json.loads(string)
+        try:
+            return self._ujson.loads(string)
+        except ValueError:
+            return json.loads(string)
+
+
+class MsgspecCodec(Codec):
+    """
+    msgspec, if installed.
+
+    msgspec always encodes datetime objects itself, in ISO 8601 format
+    rather than the format of JSONRPCEncoder, so this codec is only used
+    when selected explicitly.
+    """
+    name = "msgspec"
+
+    def __init__(self):
+        import msgspec
+        self._msgspec = msgspec
+
+    def dumps(self, obj):
+        return self.dumpb(obj).decode()
+
+    def dumpb(self, obj):
+        return self._msgspec.json.encode(obj, enc_hook=_encodeDefault)
+
+    def loads(self, string):
+        try:
+            return self._msgspec.json.decode(string)
+        except self._msgspec.DecodeError as error:
+            raise ValueError(str(error)) from error
+
+
+_encodeDefault = JSONRPCEncoder().default
+
+# Numbers which may not fit into 64 bit integers, decoded with the standard
+# library by the codecs which would lose their precision. Long fractions
+# match too, which only costs the faster decoding.
+_LONG_NUMBER = re.compile(r"\d{19}")
+_LONG_NUMBER_BYTES = re.compile(rb"\d{19}")
+
+
+def _hasLongNumber(string):
+    if isinstance(string, str):
+        return _LONG_NUMBER.search(string) is not None
+    return _LONG_NUMBER_BYTES.search(string) is not None
+
+
+_codecs: Dict[str, Type[Codec]] = {}
+_codec: Codec = JSONCodec()
+
+# The codecs setCodec("auto") tries, in this order. msgspec is left out, as
+# it encodes datetime objects differently.
+_AUTO_CODECS = ("orjson", "ujson")
+
+
+def registerCodec(codecClass):
+    """
+    Make a Codec subclass selectable by its name.
+    """
+    _codecs[codecClass.name] = codecClass
+
+
+def setCodec(codec):
+    """
+    Select the codec used by dumps and loads, either by registered name or
+    as a Codec instance. "auto" selects the first of orjson and ujson which
+    is installed, or else the standard library.
+    """
+    global _codec
+    if codec == "auto":
+        codec = _autoCodec()
+    elif not isinstance(codec, Codec):
+        codec = _codecs[codec]()
+    _codec = codec
+
+
+def _autoCodec():
+    for name in _AUTO_CODECS:
+        try:
+            return _codecs[name]()
+        except ImportError:
+            pass
+    return JSONCodec()
+
+
+def getCodec():
+    return _codec
+
+
+for _codecClass in (JSONCodec, OrjsonCodec, UjsonCodec, MsgspecCodec):
+    registerCodec(_codecClass)
+
+# The standard library stays the default, as orjson encodes NaN and Infinity
+# as null; select a faster backend with setCodec, e.g. setCodec("auto").
+
+
 def dumps(obj, **kwargs):
+    obj = _envelope(obj, kwargs)
+    if kwargs:
+        # Formatting options are only understood by the standard library.
+        return json.dumps(obj, cls=JSONRPCEncoder, **kwargs)
+    return _codec.dumps(obj)
+
+
+def dumpb(obj, **kwargs):
+    """
+    Like dumps, but return UTF-8 encoded bytes.
+    """
+    obj = _envelope(obj, kwargs)
+    if kwargs:
+        return json.dumps(obj, cls=JSONRPCEncoder, **kwargs).encode()
+    return _codec.dumpb(obj)
+
+
+def iterencode(obj, chunk_size=65536, **kwargs):
+    """
+    Like dumpb, but yield the encoded response in UTF-8 chunks of about
+    chunk_size bytes, so it never has to be held in memory as a whole.
+
+    This always uses the standard library encoder, as the faster codecs
+    cannot encode incrementally.
+    """
+    obj = _envelope(obj, kwargs)
+    parts, size = [], 0
+    for part in JSONRPCEncoder(**kwargs).iterencode(obj):
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(parts).encode()
+            parts, size = [], 0
+    if parts:
+        yield "".join(parts).encode()
+
+
+def envelopeb(id=None, version=VERSION_PRE1):
+    """
+    Return the UTF-8 encoded parts of a response before and after its
+    serialized result, to build responses from a result serialized once.
+
+    Pre-version 1.0 responses are the result in an array, as sent by the
+    servers.
+    """
+    if version == VERSION_PRE1:
+        return b"[", b"]"
+    id = _codec.dumpb(id)
+    if version == VERSION_2:
+        return b'{"jsonrpc":"2.0","result":', b',"id":%s}' % id
+    return b'{"result":', b',"error":null,"id":%s}' % id
+
+
+def _envelope(obj, kwargs):
+    """
+    Wrap a result or Fault as a response of the version given in kwargs.
+    The "version" and "id" keys are removed from kwargs.
+    """
     try:
         version = kwargs.pop("version")
     except KeyError:
@@ -87,11 +339,28 @@ def dumps(obj, **kwargs):
             obj = {"jsonrpc": "2.0", "result": result, "id": id}
     else:
         obj = {"result": result, "error": error, "id": id}
-    return json.dumps(obj, cls=JSONRPCEncoder, **kwargs)
+    return obj
 
 
 def loads(string, **kws):
-    unmarshalled = json.loads(string, **kws)
+    if kws:
+        return checkFault(json.loads(string, **kws))
+    return checkFault(_codec.loads(string))
+
+
+def loadb(data):
+    """
+    Like loads, but for UTF-8 encoded bytes, which are decoded without
+    converting them to str first.
+    """
+    return checkFault(_codec.loads(data))
+
+
+def checkFault(unmarshalled):
+    """
+    Raise the Fault carried by an already decoded response, if any, and
+    return the response unchanged otherwise.
+    """
     # XXX there's going to need to be some version-conditional code here...
     # for versions greater than VERSION_PRE1, we'll have to check for the
     # "error" key, not the "fault" key... and then raise if "fault" is not
@@ -110,7 +379,11 @@ class SimpleParser(object):
     buffer = ''
 
     def feed(self, data):
-        self.buffer += data
+        # Take str or bytes; a single chunk is kept without copying it.
+        if self.buffer:
+            self.buffer += data
+        else:
+            self.buffer = data
 
     def close(self):
         self.data = loads(self.buffer)
@@ -150,13 +423,24 @@ class Transport(xmlrpclib.Transport):
         return getparser()
 
 
+def _request(version, method="", params=[], id=""):
+    """
+    Return the request object for a call in the given version.
+    """
+    if version == VERSION_PRE1:
+        return {"method": method, "params": params}
+    elif version == VERSION_1:
+        return {"method": method, "params": params, "id": id}
+    elif version == VERSION_2:
+        return {"jsonrpc": "2.0", "method": method, "params": params, "id": id}
+
+
 def _preV1Request(method="", params=[], *args):
-    return dumps({"method": method, "params": params})
+    return dumps(_request(VERSION_PRE1, method, params))
 
 
 def _v1Request(method="", params=[], id="", *args):
-    return dumps(
-        {"method": method, "params": params, "id": id})
+    return dumps(_request(VERSION_1, method, params, id))
 
 
 def _v1Notification(method="", params=[], *args):
@@ -164,14 +448,22 @@ def _v1Notification(method="", params=[], *args):
 
 
 def _v2Request(method="", params=[], id="", *args):
-    return dumps({
-        "jsonrpc": "2.0", "method": method, "params": params, "id": id})
+    return dumps(_request(VERSION_2, method, params, id))
 
 
 def _v2Notification(method="", params=[], *args):
     return _v2Request(method=method, params=params, id=None)
 
 
+def _v2BatchRequest(calls):
+    """
+    Build one batch request, as bytes, from a sequence of
+    (method, params, id) calls.
+    """
+    return dumpb([_request(VERSION_2, method, params, id)
+                  for method, params, id in calls])
+
+
 class ServerProxy(xmlrpclib.ServerProxy):
     """
     XXX add missing docstring
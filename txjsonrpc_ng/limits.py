@@ -0,0 +1,204 @@
+"""
+Limiting the number of calls in flight.
+
+Without a limit, a server under overload accepts every call, so latency
+and memory grow without bound. A Limiter runs at most a given number of
+calls at once, lets a bounded number of further calls wait for a slot and
+refuses the rest right away with an Overloaded fault. Set the limiter
+attribute of a JSONRPC resource or protocol class to limit all its calls,
+or decorate methods with limited to limit them on their own.
+"""
+import functools
+import weakref
+from typing import Callable, Optional
+
+from twisted.internet import defer, reactor
+from twisted.python import failure, log
+
+from txjsonrpc_ng import jsonrpclib
+
+
+class Overloaded(jsonrpclib.Fault):
+    """
+    A call was refused because too many calls are in flight. The web server
+    replies to it with status 503.
+    """
+
+    def __init__(self, message="server overloaded", code=jsonrpclib.SERVER_OVERLOADED):
+        jsonrpclib.Fault.__init__(self, code, message)
+
+
+class DeadlineExceeded(Overloaded):
+    """
+    A call did not finish within the deadline of its limiter.
+    """
+
+    def __init__(self, message="deadline exceeded"):
+        Overloaded.__init__(self, message, jsonrpclib.DEADLINE_EXCEEDED)
+
+
+class Limiter:
+    """
+    Run at most limit calls at once, backed by a DeferredSemaphore.
+
+    @type limit: C{int}
+    @ivar limit: The maximum number of calls running at once.
+
+    @type queue_size: C{int} or None
+    @ivar queue_size: The maximum number of calls waiting for a slot; further
+    calls fail with Overloaded. 0 refuses calls as soon as all slots are
+    taken, None lets any number of calls wait.
+
+    @type deadline: C{float} or None
+    @ivar deadline: Seconds after which a call which is still waiting or
+    running fails with DeadlineExceeded. A running call is cancelled, unless
+    its Deferred is marked with uncancellable: then, as for in_thread and
+    running in_process methods, it keeps its slot until it has actually
+    finished, so the limit still bounds the work being done.
+    """
+
+    def __init__(self, limit, queue_size=None, deadline=None, clock=reactor):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.clock = clock
+        self.semaphore = defer.DeferredSemaphore(limit)
+        self.rejected = 0
+        self.expired = 0
+
+    @property
+    def running(self):
+        return self.limit - self.semaphore.tokens
+
+    @property
+    def waiting(self):
+        return len(self.semaphore.waiting)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Call function once a slot is free; return a Deferred firing with its
+        result.
+        """
+        if (self.queue_size is not None and not self.semaphore.tokens
+                and self.waiting >= self.queue_size):
+            self.rejected += 1
+            return defer.fail(Overloaded())
+        if self.deadline is None:
+            return self.semaphore.run(function, *args, **kwargs)
+        return self._run_with_deadline(function, args, kwargs)
+
+    def _run_with_deadline(self, function, args, kwargs):
+        # The running call, once it has a slot.
+        calls = []
+
+        def stop(_):
+            # At the deadline or cancelled by the caller.
+            if timer.active():
+                timer.cancel()
+            if not calls:
+                acquired.cancel()
+            else:
+                _stop(calls[0])
+
+        result = defer.Deferred(stop)
+
+        def expire():
+            self.expired += 1
+            result.errback(DeadlineExceeded())
+            stop(None)
+
+        def start(_):
+            call = defer.maybeDeferred(function, *args, **kwargs)
+            calls.append(call)
+            call.addBoth(release)
+            call.addBoth(deliver)
+
+        def release(outcome):
+            self.semaphore.release()
+            return outcome
+
+        def deliver(outcome):
+            if timer.active():
+                timer.cancel()
+            if not result.called:
+                if isinstance(outcome, failure.Failure):
+                    result.errback(outcome)
+                else:
+                    result.callback(outcome)
+            elif isinstance(outcome, failure.Failure) and not outcome.check(defer.CancelledError):
+                log.err(outcome, "limits: call failed after its deadline")
+
+        timer = self.clock.callLater(self.deadline, expire)
+        acquired = self.semaphore.acquire()
+        acquired.addCallbacks(start, lambda f: f.trap(defer.CancelledError) and None)
+        return result
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "expired": self.expired,
+        }
+
+
+# Deferreds marked with uncancellable -> their try_cancel function or None.
+_uncancellable: weakref.WeakKeyDictionary[defer.Deferred, Optional[Callable[[], bool]]] = weakref.WeakKeyDictionary()
+
+
+def uncancellable(d, try_cancel=None):
+    """
+    Mark d as a Deferred whose cancelling does not stop the work it stands
+    for, like the Deferred of a call in a thread: cancelling it would merely
+    fail it with CancelledError. A Limiter then lets the work keep its slot
+    until d has fired.
+
+    @type try_cancel: C{callable} or None
+    @param try_cancel: Called without arguments to stop work which may not
+    have started yet; returns whether it did, as Future.cancel does. Only
+    then is d cancelled.
+
+    @return: d
+    """
+    _uncancellable[d] = try_cancel
+    return d
+
+
+def _stop(d):
+    """
+    Cancel d if that stops the work it stands for.
+    """
+    if d in _uncancellable:
+        try_cancel = _uncancellable[d]
+        if try_cancel is None or not try_cancel():
+            return
+    d.cancel()
+
+
+def limited(limit, queue_size=None, deadline=None):
+    """
+    Decorator to limit the calls of a jsonrpc_ method in flight; see
+    Limiter.
+
+    The limit is shared by all instances of the class, and applies in
+    addition to the limiter of the resource or protocol. The Limiter is
+    available as the limiter attribute of the decorated method.
+    """
+    def decorator(method):
+        method.limiter = Limiter(limit, queue_size, deadline)
+        return method
+
+    return decorator
+
+
+def limit(limiter, function):
+    """
+    Return function limited by limiter, or function itself if limiter is
+    None.
+    """
+    if limiter is None:
+        return function
+    return functools.partial(limiter.run, function)
+
+
+__all__ = ["DeadlineExceeded", "Limiter", "Overloaded", "limit", "limited", "uncancellable"]
@@ -0,0 +1,215 @@
+"""
+Instrumentation of the servers and proxies.
+
+The servers record the calls of each method with their errors and latency,
+the sizes of requests and responses, the time spent serializing responses
+and how well they compress; the proxies record the calls they make. All of
+this goes to REGISTRY unless the metrics attribute of a server or proxy
+class or instance is set to another Metrics instance, or to None to
+record nothing.
+
+Metrics.snapshot() returns the numbers as a JSON serializable dict, which
+the system.stats method of Introspection returns as well. prometheus()
+formats a snapshot in the Prometheus text format, as served by
+web.metrics.MetricsResource.
+"""
+import bisect
+import time
+
+from twisted.python import failure
+
+from txjsonrpc_ng import jsonrpclib
+
+# Upper bounds of the histogram buckets, in seconds and bytes.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Histogram:
+    """
+    Count observed values in buckets with the given upper bounds, like a
+    Prometheus histogram.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self, function, *args, **kwargs):
+        """
+        Call function and observe how many seconds it took.
+        """
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        # Cumulative counts, so snapshots of several processes can be added
+        # up.
+        buckets, total = {}, 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            buckets[str(bound)] = total
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class MethodStats:
+    """
+    The number of calls of a method, how many of them failed and how long
+    they took.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram(buckets)
+
+    def record(self, seconds, error):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.latency.observe(seconds)
+
+    def snapshot(self):
+        return {"calls": self.calls, "errors": self.errors, "latency": self.latency.snapshot()}
+
+
+class Metrics:
+    """
+    The numbers recorded by servers and proxies.
+
+    Methods are recorded by name once they have been found, so calls of
+    unknown methods do not add entries.
+    """
+
+    def __init__(self, latency_buckets=LATENCY_BUCKETS, size_buckets=SIZE_BUCKETS):
+        self.latency_buckets = latency_buckets
+        self.methods = {}
+        self.client_methods = {}
+        self.request_bytes = Histogram(size_buckets)
+        self.response_bytes = Histogram(size_buckets)
+        self.serialization = Histogram(latency_buckets)
+        # Coding name -> [responses, bytes in, bytes out, seconds].
+        self.compression = {}
+
+    def call(self, method, client=False):
+        """
+        Start timing a call of method; return a function to pass its result
+        to, e.g. with addBoth. Failures and Faults count as errors.
+        """
+        methods = self.client_methods if client else self.methods
+        stats = methods.get(method)
+        if stats is None:
+            stats = methods[method] = MethodStats(self.latency_buckets)
+        start = time.perf_counter()
+
+        def done(result):
+            stats.record(time.perf_counter() - start, isinstance(result, (failure.Failure, jsonrpclib.Fault)))
+            return result
+
+        return done
+
+    def record_compression(self, encoding, original_size, compressed_size, seconds):
+        stats = self.compression.get(encoding)
+        if stats is None:
+            stats = self.compression[encoding] = [0, 0, 0, 0.0]
+        stats[0] += 1
+        stats[1] += original_size
+        stats[2] += compressed_size
+        stats[3] += seconds
+
+    def compression_ratio(self, encoding):
+        """
+        Return the compressed size of the responses compressed with
+        encoding relative to their original size, or None.
+        """
+        stats = self.compression.get(encoding)
+        if not stats or not stats[1]:
+            return None
+        return stats[2] / stats[1]
+
+    def snapshot(self):
+        return {
+            "methods": {name: stats.snapshot() for name, stats in self.methods.items()},
+            "client_methods": {name: stats.snapshot() for name, stats in self.client_methods.items()},
+            "request_bytes": self.request_bytes.snapshot(),
+            "response_bytes": self.response_bytes.snapshot(),
+            "serialization": self.serialization.snapshot(),
+            "compression": {
+                encoding: {"responses": responses, "bytes_in": bytes_in, "bytes_out": bytes_out, "seconds": seconds}
+                for encoding, (responses, bytes_in, bytes_out, seconds) in self.compression.items()},
+        }
+
+    def clear(self):
+        self.__init__(self.latency_buckets, self.request_bytes.buckets)
+
+
+REGISTRY = Metrics()
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in labels.items())
+
+
+def _histogram(lines, name, histogram, **labels):
+    for bound, count in histogram["buckets"].items():
+        lines.append("%s_bucket%s %s" % (name, _labels(**labels, le=bound), count))
+    lines.append("%s_sum%s %s" % (name, _labels(**labels) if labels else "", histogram["sum"]))
+    lines.append("%s_count%s %s" % (name, _labels(**labels) if labels else "", histogram["count"]))
+
+
+def prometheus(snapshot, prefix="txjsonrpc"):
+    """
+    Format a snapshot of Metrics in the Prometheus text exposition format.
+    """
+    lines = []
+
+    def header(name, kind, help):
+        lines.append("# HELP %s_%s %s" % (prefix, name, help))
+        lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+
+    methods = [(side, name, stats)
+               for side, key in (("server", "methods"), ("client", "client_methods"))
+               for name, stats in sorted(snapshot.get(key, {}).items())]
+    header("calls_total", "counter", "Calls of a method.")
+    for side, name, stats in methods:
+        lines.append("%s_calls_total%s %s" % (prefix, _labels(method=name, side=side), stats["calls"]))
+    header("errors_total", "counter", "Calls of a method which failed.")
+    for side, name, stats in methods:
+        lines.append("%s_errors_total%s %s" % (prefix, _labels(method=name, side=side), stats["errors"]))
+    header("call_seconds", "histogram", "Duration of calls of a method.")
+    for side, name, stats in methods:
+        _histogram(lines, prefix + "_call_seconds", stats["latency"], method=name, side=side)
+
+    for name, help in (("request_bytes", "Size of requests received."),
+                       ("response_bytes", "Size of responses before compression."),
+                       ("serialization", "Duration of serializing responses.")):
+        if name in snapshot:
+            metric = name + "_seconds" if name == "serialization" else name
+            header(metric, "histogram", help)
+            _histogram(lines, "%s_%s" % (prefix, metric), snapshot[name])
+
+    compression = sorted(snapshot.get("compression", {}).items())
+    for name, key, help in (("compressed_responses_total", "responses", "Responses compressed."),
+                            ("compression_input_bytes_total", "bytes_in", "Bytes before compression."),
+                            ("compression_output_bytes_total", "bytes_out", "Bytes after compression."),
+                            ("compression_seconds_total", "seconds", "Time spent compressing.")):
+        header(name, "counter", help)
+        for encoding, stats in compression:
+            lines.append("%s_%s%s %s" % (prefix, name, _labels(encoding=encoding), stats[key]))
+    return "\n".join(lines) + "\n"
+
+
+__all__ = ["Histogram", "MethodStats", "Metrics", "REGISTRY", "prometheus"]
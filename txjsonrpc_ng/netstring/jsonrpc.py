@@ -7,13 +7,31 @@ API Stability: semi-stable
 
 Maintainer: U{Duncan McGreggor <mailto:oubiwann@adytum.us>}
 """
+import collections
+import types
+
 from twisted.internet import defer, protocol, reactor
 from twisted.protocols import basic
 from twisted.python import log
 
 from txjsonrpc_ng import jsonrpclib
+from txjsonrpc_ng.cache import cached, single_flight
+from txjsonrpc_ng.limits import Limiter, limit, limited
+from txjsonrpc_ng.metrics import REGISTRY
+from txjsonrpc_ng.workers import in_process, in_thread
 from txjsonrpc_ng.jsonrpc import (
-    BaseProxy, BaseQueryFactory, BaseSubhandler, Introspection)
+    BaseBatch, BaseProxy, BaseQueryFactory, BaseSubhandler, BatchQueryMixin,
+    Introspection, RequestRegistry)
+from txjsonrpc_ng.web.data import CacheableResult, RawJSON
+
+
+def with_protocol(method):
+    """
+    Decorator to pass the JSONRPC protocol instance of the connection as the
+    first argument, e.g. to keep per-connection state in shared handlers.
+    """
+    method.with_request = True
+    return method
 
 
 class JSONRPC(basic.NetstringReceiver, BaseSubhandler):
@@ -24,6 +42,13 @@ class JSONRPC(basic.NetstringReceiver, BaseSubhandler):
     Binary, Boolean, DateTime, Deferreds, or Handler instances.
 
     By default methods beginning with 'jsonrpc_' are published.
+
+    If limiter is set to a limits.Limiter on the class, calls of all
+    connections beyond its limits fail with an Overloaded fault. Use the
+    limited decorator to limit single methods.
+
+    Calls, payload sizes and serialization are recorded in metrics,
+    metrics.REGISTRY by default; set it to None to record nothing.
     """
     # Error codes for Twisted, if they conflict with yours then
     # modify them at runtime.
@@ -32,7 +57,11 @@ class JSONRPC(basic.NetstringReceiver, BaseSubhandler):
 
     separator = '.'
     closed = 0
-
+    limiter = None
+    metrics = REGISTRY
+    # Set by RPCFactory with sharedHandlers: the dispatch table of the
+    # methods of the shared sub-handlers.
+    _sharedDispatchTable = None
 
     def __init__(self, version=jsonrpclib.VERSION_2):
         BaseSubhandler.__init__(self)
@@ -44,9 +73,27 @@ class JSONRPC(basic.NetstringReceiver, BaseSubhandler):
     def connectionMade(self):
         self.MAX_LENGTH = self.factory.maxLength
 
+    def _getDispatchEntry(self, functionPath):
+        shared = self._sharedDispatchTable
+        if shared is None or self.separator not in functionPath:
+            return BaseSubhandler._getDispatchEntry(self, functionPath)
+        # Methods of shared sub-handlers are the same for all connections.
+        try:
+            return shared[functionPath]
+        except KeyError:
+            pass
+        entry = shared[functionPath] = self._buildDispatchEntry(functionPath)
+        return entry
+
     def stringReceived(self, line):
+        if self.metrics is not None:
+            self.metrics.request_bytes.observe(len(line))
         parser, unmarshaller = jsonrpclib.getparser()
-        deferred = defer.maybeDeferred(parser.feed, line.decode())
+        deferred = defer.maybeDeferred(parser.feed, line)
+        # A JSON-RPC 2.0 batch is sent as an array of calls.
+        if line.lstrip().startswith(b"["):
+            deferred.addCallback(lambda x: self._cbDispatchBatch(parser))
+            return deferred
 
         req, req_id = self._cbDispatch(parser, unmarshaller)
         deferred.addCallback(lambda x: req)
@@ -57,18 +104,94 @@ class JSONRPC(basic.NetstringReceiver, BaseSubhandler):
     def _cbDispatch(self, parser, unmarshaller):
         parser.close()
         args, functionPath, req_id  = unmarshaller.close(), unmarshaller.getmethodname(), unmarshaller.getid()
-        function = self._getFunction(functionPath)
-        return defer.maybeDeferred(function, *args), req_id
+        entry = self._getDispatchEntry(functionPath)
+        if entry.with_request:
+            args = [self] + list(args)
+        if self.metrics is None:
+            return defer.maybeDeferred(limit(self.limiter, entry.function), *args), req_id
+        done = self.metrics.call(functionPath)
+        return defer.maybeDeferred(limit(self.limiter, entry.function), *args).addBoth(done), req_id
+
+    def _cbDispatchBatch(self, parser):
+        try:
+            parser.close()
+        except ValueError:
+            f = jsonrpclib.Fault(jsonrpclib.NOT_WELLFORMED_ERROR, "parse error")
+            self._send(jsonrpclib.dumpb(f, id=None, version=jsonrpclib.VERSION_2))
+            return None
+        if not parser.data:
+            f = jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC, "empty batch")
+            self._send(jsonrpclib.dumpb(f, id=None, version=jsonrpclib.VERSION_2))
+            return None
+        calls = []
+        for call in parser.data:
+            if isinstance(call, dict):
+                req_id = call.get("id")
+                # Notifications are run but get no element in the reply.
+                reply = req_id is not None
+            else:
+                req_id, reply = None, True
+            d = defer.maybeDeferred(self._callBatched, call)
+            d.addErrback(self._ebRender, req_id=req_id)
+            calls.append((d, req_id, reply))
+        d = defer.DeferredList([call[0] for call in calls])
+        d.addCallback(self._cbRenderBatch, calls)
+        return d
+
+    def _callBatched(self, call):
+        if not isinstance(call, dict):
+            raise jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC, "invalid request")
+        entry = self._getDispatchEntry(call.get("method"))
+        params = call.get("params", [])
+        args = [self] if entry.with_request else []
+        function = limit(self.limiter, entry.function)
+        if self.metrics is not None:
+            done = self.metrics.call(call.get("method"))
+        if isinstance(params, dict):
+            d = defer.maybeDeferred(function, *args, **params)
+        else:
+            d = defer.maybeDeferred(function, *args, *params)
+        if self.metrics is not None:
+            d.addBoth(done)
+        return d
+
+    def _cbRenderBatch(self, results, calls):
+        # Batches only exist in JSON-RPC 2.0, whatever the version of the
+        # server.
+        parts = [self._dumps(result, req_id, jsonrpclib.VERSION_2)
+                 for (success, result), (_, req_id, reply) in zip(results, calls)
+                 if reply]
+        if parts:
+            self._send(b"[%s]" % b", ".join(parts))
 
     def _cbRender(self, result, req_id):
-        if self.version == jsonrpclib.VERSION_PRE1 and not isinstance(result, jsonrpclib.Fault):
+        if self.metrics is None:
+            return self._send(self._dumps(result, req_id))
+        return self._send(self.metrics.serialization.time(self._dumps, result, req_id))
+
+    def _send(self, string):
+        if self.metrics is not None:
+            self.metrics.response_bytes.observe(len(string))
+        return self.sendString(string)
+
+    def _dumps(self, result, req_id, version=None):
+        if version is None:
+            version = self.version
+        if isinstance(result, RawJSON):
+            return result.serialize(req_id, version)
+        if isinstance(result, CacheableResult):
+            try:
+                return result.serialize(req_id, version)
+            except Exception:
+                result = result.value
+        if version == jsonrpclib.VERSION_PRE1 and not isinstance(result, jsonrpclib.Fault):
             result = (result,)
         try:
-            s = jsonrpclib.dumps(result, id=req_id, version=self.version)
+            s = jsonrpclib.dumpb(result, id=req_id, version=version)
         except:
             f = jsonrpclib.Fault(self.FAILURE, "can't serialize output")
-            s = jsonrpclib.dumps(f, id=req_id, version=self.version)
-        return self.sendString(s.encode())
+            s = jsonrpclib.dumpb(f, id=req_id, version=version)
+        return s
 
     def _ebRender(self, failure, req_id):
         if isinstance(failure.value, jsonrpclib.Fault):
@@ -80,25 +203,151 @@ class JSONRPC(basic.NetstringReceiver, BaseSubhandler):
 class QueryProtocol(basic.NetstringReceiver):
 
     def connectionMade(self):
-        self.data = ''
-        msg = self.factory.payload
-        packet = '%d:%s,' % (len(msg), msg)
-        self.transport.write(packet.encode())
+        self.sendString(self.factory.payload)
 
     def stringReceived(self, string):
-        self.factory.data = string.decode()
+        self.factory.data = string
         self.transport.loseConnection()
 
 
 class QueryFactory(BaseQueryFactory):
 
     protocol = QueryProtocol  # type: ignore[assignment]
-    data = ''
+    data = b''
 
     def clientConnectionLost(self, _, reason):
         self.parseResponse(self.data)
 
 
+class BatchQueryFactory(BatchQueryMixin, QueryFactory):
+    """
+    Factory for sending a batch of calls in one JSON-RPC 2.0 request.
+    """
+
+    def __init__(self, batch):
+        QueryFactory.__init__(self, None, batch.version)
+        self._setBatch(batch)
+
+
+class PersistentQueryProtocol(basic.NetstringReceiver):
+    """
+    Client protocol which keeps its connection open and pipelines requests.
+    """
+
+    def connectionMade(self):
+        self.factory.clientConnectionMade(self)
+
+    def sendQuery(self, query):
+        self.sendString(query.payload)
+
+    def stringReceived(self, string):
+        self.factory.responseReceived(string)
+
+
+class PersistentQueryFactory(protocol.ClientFactory):
+    """
+    Keep one long-lived connection to a host/port and send many calls over it.
+
+    Calls are written as soon as the connection is up and their replies are
+    matched to the waiting calls by JSON-RPC id. Replies to pre-version 1.0
+    requests have no id and the server replies in the order its calls
+    finish, so these requests are sent one at a time: the next one is only
+    written after the reply to the previous one. An error
+    reply to a whole batch, which has no id either, fails the calls of the
+    oldest unanswered batch. When the connection is lost, the outstanding
+    calls fail and the next call opens a new connection.
+    """
+
+    protocol = PersistentQueryProtocol  # type: ignore[assignment]
+
+    def __init__(self, host, port, requests=None):
+        self.host = host
+        self.port = port
+        self.connection = None
+        self.connector = None
+        self.queued = []
+        self.requests = requests if requests is not None else RequestRegistry()
+        self.unnumbered = collections.deque()
+        self.batches = collections.deque()
+
+    def sendQuery(self, query):
+        """
+        Send a call which has already been registered with self.requests.
+        """
+        if isinstance(query, BaseBatch):
+            self.batches.append(query)
+            d = defer.DeferredList([call.deferred for call in query.queries])
+            d.addCallback(lambda _: self.batches.remove(query) if query in self.batches else None)
+        elif query.version == jsonrpclib.VERSION_PRE1:
+            # Only the first of the unnumbered calls has been written.
+            self.unnumbered.append(query)
+            if len(self.unnumbered) > 1:
+                return
+        self._write(query)
+
+    def _write(self, query):
+        if self.connection is not None:
+            self.connection.sendQuery(query)
+            return
+        self.queued.append(query)
+        if self.connector is None:
+            self.connector = reactor.connectTCP(self.host, self.port, self)
+
+    def clientConnectionMade(self, connection):
+        self.connection = connection
+        queued, self.queued = self.queued, []
+        for query in queued:
+            connection.sendQuery(query)
+
+    def responseReceived(self, string):
+        try:
+            unmarshalled = jsonrpclib.getCodec().loads(string)
+        except ValueError:
+            log.err(None, "undecodable JSON-RPC reply, dropping connection")
+            self.connection.transport.loseConnection()
+            return
+        # Only JSON-RPC 2.0 replies are batched; a pre-version 1.0 reply may
+        # be an array as well.
+        if isinstance(unmarshalled, list) and all(
+                isinstance(element, dict) and "jsonrpc" in element
+                for element in unmarshalled):
+            for element in unmarshalled:
+                self._dispatch(element)
+        else:
+            self._dispatch(unmarshalled)
+
+    def _dispatch(self, unmarshalled):
+        id = unmarshalled.get("id") if isinstance(unmarshalled, dict) else None
+        if id is not None:
+            query = self.requests.pop(id)
+        elif isinstance(unmarshalled, dict) and "jsonrpc" in unmarshalled and self.batches:
+            query = self.batches.popleft()
+        elif self.unnumbered:
+            query = self.unnumbered.popleft()
+        else:
+            query = None
+        if query is None:
+            log.msg("discarding reply for unknown request id %r" % (id,))
+            return
+        query.parseUnmarshalled(unmarshalled)
+        if query.version == jsonrpclib.VERSION_PRE1 and self.unnumbered:
+            self._write(self.unnumbered[0])
+
+    def disconnect(self):
+        if self.connector is not None:
+            self.connector.disconnect()
+
+    def clientConnectionFailed(self, _, reason):
+        self.connection = None
+        self.connector = None
+        self.queued = []
+        self.unnumbered.clear()
+        self.batches.clear()
+        self.requests.failAll(reason)
+
+    clientConnectionLost = clientConnectionFailed
+
+
 class Proxy(BaseProxy):
     """
     A Proxy for making remote JSON-RPC calls.
@@ -110,7 +359,7 @@ class Proxy(BaseProxy):
     """
 
     def __init__(self, host, port, version=jsonrpclib.VERSION_PRE1,
-                 factoryClass=QueryFactory):
+                 factoryClass=QueryFactory, persistent=False):
         """
         @type host: C{str}
         @param host: The host to which method calls are made.
@@ -128,30 +377,85 @@ class Proxy(BaseProxy):
         @param factoryClass: The factoryClass should be a subclass of
         QueryFactory (class, not instance) that will be used instead of
         QueryFactory.
+
+        @type persistent: C{bool}
+        @param persistent: If true, all calls share one long-lived connection
+        which pipelines requests and is re-opened on demand after it has been
+        lost. Otherwise every call opens its own connection.
         """
         BaseProxy.__init__(self, version, factoryClass)
         self.host = host
         self.port = port
+        self.connection = None
+        if persistent:
+            self.connection = PersistentQueryFactory(host, port, self.requests)
 
     def callRemote(self, method, *args, **kwargs):
         version = self._getVersion(kwargs)
         factoryClass = self._getFactoryClass(kwargs)
         factory = factoryClass(method, version, *args)
-        reactor.connectTCP(self.host, self.port, factory)
+        self.requests.register(factory)
+        if self.metrics is not None:
+            factory.deferred.addBoth(self.metrics.call(method, client=True))
+        if self.connection is None:
+            reactor.connectTCP(self.host, self.port, factory)
+        else:
+            self.connection.sendQuery(factory)
         return factory.deferred
 
+    def _sendBatch(self, batch):
+        if self.connection is None:
+            reactor.connectTCP(self.host, self.port, BatchQueryFactory(batch))
+        else:
+            self.connection.sendQuery(batch)
+
+    def disconnect(self):
+        """
+        Close the persistent connection, if any.
+        """
+        if self.connection is not None:
+            self.connection.disconnect()
+
 
 class RPCFactory(protocol.ServerFactory):
+    """
+    Factory for JSON-RPC server connections.
+
+    By default every connection gets its own instances of the sub-handler
+    classes given to putSubHandler. With sharedHandlers, the sub-handlers
+    are instantiated once and shared by all connections, together with the
+    dispatch table of their methods, so accepting a connection does no
+    per-handler work. Shared sub-handlers get per-connection state through
+    methods decorated with with_protocol, and sub-handlers given the
+    'protocol' argument are passed a prototype connection instead of the
+    real one. The sub-handlers of a connection are read-only then. A
+    connection keeps the sub-handlers it was accepted with; putSubHandler
+    only affects later connections.
+    """
 
     protocol = None
 
-    def __init__(self, rpcClass, maxLength=1024):
+    def __init__(self, rpcClass, maxLength=1024, sharedHandlers=False):
         self.maxLength = maxLength
         self.protocol = rpcClass
         self.subHandlers = {}
+        self.sharedHandlers = sharedHandlers
+        self._prototype = None
+        self._sharedSubHandlers = None
 
     def buildProtocol(self, addr):
         p = protocol.ServerFactory.buildProtocol(self, addr)
+        if self.sharedHandlers:
+            if self._prototype is None:
+                self._prototype = self._buildSubHandlers(self.protocol())
+                self._sharedSubHandlers = types.MappingProxyType(self._prototype.subHandlers)
+            p.subHandlers = self._sharedSubHandlers
+            # The prototype's table is cleared when a sub-handler changes.
+            p._sharedDispatchTable = self._prototype.dispatchTable
+            return p
+        return self._buildSubHandlers(p)
+
+    def _buildSubHandlers(self, p):
         for key, val in self.subHandlers.items():
             klass, args, kws = val
             if args and args[0] == 'protocol':
@@ -162,9 +466,11 @@ class RPCFactory(protocol.ServerFactory):
 
     def putSubHandler(self, name, klass, args=(), kws={}):
         self.subHandlers[name] = (klass, args, kws)
+        self._prototype = None
 
     def addIntrospection(self):
         self.putSubHandler('system', Introspection, ('protocol',))
 
 
-__all__ = ["JSONRPC", "Proxy", "RPCFactory"]
+__all__ = ["JSONRPC", "Limiter", "Proxy", "RPCFactory", "RawJSON", "cached", "in_process", "in_thread", "limited",
+           "single_flight", "with_protocol"]
@@ -0,0 +1,288 @@
+"""
+Serving JSON-RPC on all cores.
+
+A reactor runs in one thread, so a server only uses one core. Run
+
+    python -m txjsonrpc_ng.serve --workers 4 --port 7080 myapp.server:Example
+
+to create the listening socket once and start worker processes which each
+run a reactor and accept connections on the shared socket. The kernel
+spreads the connections over the workers. A worker which exits is
+restarted, and the numbers the workers report, including their
+metrics, are summed up by the supervising process. With --metrics-port,
+it serves the summed up metrics in the Prometheus text format.
+
+The server is named as module:name. If it is a JSONRPC resource, the
+workers serve it over HTTP with a JSONRPCSite; if it is a protocol factory
+like RPCFactory, they serve the netstring protocol. Classes and functions
+are called without arguments to create the resource or factory in each
+worker.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.internet.interfaces import IProtocolFactory
+from twisted.protocols import policies
+from twisted.python import log, reflect
+from twisted.web.resource import IResource
+
+from txjsonrpc_ng.metrics import REGISTRY
+
+# File descriptors of the listening socket and the report pipe in the
+# workers.
+LISTEN_FD = 3
+REPORT_FD = 4
+
+
+def load(spec):
+    """
+    Return the protocol factory to serve for a module:name spec.
+    """
+    module, _, name = spec.partition(":")
+    if not name:
+        raise ValueError("expected module:name, got %r" % spec)
+    server = reflect.namedAny("%s.%s" % (module, name))
+    if not (IResource.providedBy(server) or IProtocolFactory.providedBy(server)) and callable(server):
+        server = server()
+    if IResource.providedBy(server):
+        from txjsonrpc_ng.web.jsonrpc import JSONRPCSite
+        return JSONRPCSite(server)
+    if IProtocolFactory.providedBy(server):
+        return server
+    raise TypeError("%r is neither a resource nor a protocol factory" % spec)
+
+
+def listen(port, interface="", backlog=50):
+    """
+    Return a non-blocking listening TCP socket for the workers to share.
+    """
+    family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def aggregate(reports):
+    """
+    Sum up the numbers in the reports of the workers, recursing into
+    nested dicts.
+    """
+    totals = {}
+    for report in reports:
+        _add(totals, {name: value for name, value in report.items() if name != "pid"})
+    return totals
+
+
+def _add(totals, report):
+    for name, value in report.items():
+        if isinstance(value, dict):
+            _add(totals.setdefault(name, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            totals[name] = totals.get(name, 0) + value
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """
+    The supervisor's end of a worker process.
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.buffer = b""
+        self.ended = defer.Deferred()
+
+    def childDataReceived(self, childFD, data):
+        if childFD != REPORT_FD:
+            return
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                report = json.loads(line)
+            except ValueError:
+                log.msg("worker %d: undecodable report %r" % (self.index, line))
+                continue
+            self.supervisor.reported(self.index, report)
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self.index, reason)
+        self.ended.callback(None)
+
+
+class Supervisor:
+    """
+    Start the worker processes serving on a shared socket and restart them
+    when they exit.
+
+    @type spec: C{str}
+    @ivar spec: The server to run in the workers, as module:name.
+
+    @type sock: C{socket.socket}
+    @ivar sock: The listening socket, see listen().
+
+    @type restart_delay: C{float}
+    @ivar restart_delay: Seconds to wait before restarting a worker, so a
+    worker which cannot start does not keep a core busy.
+
+    @type stop_timeout: C{float}
+    @ivar stop_timeout: Seconds to wait for the workers to exit on stop()
+    before killing them.
+    """
+
+    def __init__(self, spec, sock, workers=None, restart_delay=1.0, report_interval=5.0,
+                 stop_timeout=10.0, clock=reactor):
+        self.spec = spec
+        self.sock = sock
+        self.count = workers or os.cpu_count() or 1
+        self.restart_delay = restart_delay
+        self.report_interval = report_interval
+        self.stop_timeout = stop_timeout
+        self.clock = clock
+        self.workers = {}
+        self.reports = {}
+        self.restarts = 0
+        self.stopping = False
+
+    def start(self):
+        for index in range(self.count):
+            self.spawn(index)
+        self.clock.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        worker = WorkerProtocol(self, index)
+        self.workers[index] = worker
+        args = [sys.executable, "-m", "txjsonrpc_ng.serve", "--worker",
+                "--family", str(int(self.sock.family)),
+                "--report-interval", str(self.report_interval), self.spec]
+        self.clock.spawnProcess(
+            worker, sys.executable, args, env=os.environ, path=os.getcwd(),
+            childFDs={1: 1, 2: 2, LISTEN_FD: self.sock.fileno(), REPORT_FD: "r"})
+
+    def reported(self, index, report):
+        self.reports[index] = report
+
+    def workerEnded(self, index, reason):
+        del self.workers[index]
+        self.reports.pop(index, None)
+        if self.stopping:
+            return
+        log.msg("worker %d exited (%s), restarting" % (index, reason.getErrorMessage()))
+        self.restarts += 1
+        self.clock.callLater(self.restart_delay, self.spawn, index)
+
+    def pids(self):
+        return sorted(worker.transport.pid for worker in self.workers.values() if worker.transport.pid)
+
+    def stats(self):
+        """
+        Return the sums of the last reports of the running workers, with the
+        number of workers and restarts.
+        """
+        stats = aggregate(self.reports.values())
+        stats.update(workers=len(self.workers), restarts=self.restarts)
+        return stats
+
+    def stop(self):
+        """
+        Stop the workers; return a Deferred firing once all have exited.
+        """
+        self.stopping = True
+        workers = list(self.workers.values())
+        for worker in workers:
+            self._signal(worker, "TERM")
+        kill = self.clock.callLater(self.stop_timeout, lambda: [self._signal(worker, "KILL") for worker in workers])
+        d = defer.DeferredList([worker.ended for worker in workers])
+        d.addCallback(lambda _: kill.active() and kill.cancel())
+        return d
+
+    def _signal(self, worker, signal):
+        try:
+            worker.transport.signalProcess(signal)
+        except error.ProcessExitedAlready:
+            pass
+
+
+class _CountingFactory(policies.WrappingFactory):
+    """
+    Count the connections a worker accepts.
+    """
+
+    noisy = False
+    accepted = 0
+
+    def buildProtocol(self, addr):
+        self.accepted += 1
+        return policies.WrappingFactory.buildProtocol(self, addr)
+
+
+def run_worker(spec, family, report_interval=5.0):
+    """
+    Serve spec on the socket passed by the supervisor until the reactor
+    stops.
+    """
+    factory = _CountingFactory(load(spec))
+    reactor.adoptStreamPort(LISTEN_FD, family, factory)
+    # The port uses a copy of the descriptor.
+    os.close(LISTEN_FD)
+
+    def report():
+        stats = {"pid": os.getpid(), "connections": len(factory.protocols), "accepted": factory.accepted,
+                 "metrics": REGISTRY.snapshot()}
+        try:
+            os.write(REPORT_FD, json.dumps(stats).encode() + b"\n")
+        except OSError:
+            # The supervisor is gone.
+            if reactor.running:
+                reactor.stop()
+
+    task.LoopingCall(report).start(report_interval)
+    reactor.run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m txjsonrpc_ng.serve", description=__doc__.split("\n\n")[1])
+    parser.add_argument("spec", help="the JSONRPC resource or protocol factory to serve, as module:name")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument("--port", type=int, default=7080)
+    parser.add_argument("--interface", default="")
+    parser.add_argument("--backlog", type=int, default=50)
+    parser.add_argument("--restart-delay", type=float, default=1.0)
+    parser.add_argument("--report-interval", type=float, default=5.0)
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve the metrics of all workers on this port")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--family", type=int, default=int(socket.AF_INET), help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    log.startLogging(sys.stderr)
+    if options.worker:
+        run_worker(options.spec, socket.AddressFamily(options.family), options.report_interval)
+        return
+    # Fail here rather than in every worker.
+    load(options.spec)
+    sock = listen(options.port, options.interface, options.backlog)
+    supervisor = Supervisor(options.spec, sock, options.workers, options.restart_delay, options.report_interval)
+    supervisor.start()
+    if options.metrics_port is not None:
+        from twisted.web import server
+        from txjsonrpc_ng.web.metrics import MetricsResource
+        resource = MetricsResource(lambda: supervisor.stats().get("metrics", {}))
+        reactor.listenTCP(options.metrics_port, server.Site(resource), interface=options.interface)
+    reactor.run()
+
+
+__all__ = ["Supervisor", "aggregate", "listen", "load", "main"]
+
+
+if __name__ == "__main__":
+    main()
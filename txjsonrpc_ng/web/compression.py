@@ -0,0 +1,465 @@
+"""
+HTTP content codings for compressing responses.
+
+gzip and deflate are always available, br and zstd if the brotli and
+zstandard packages are installed. Further codings can be added with
+register_encoding.
+"""
+import gzip
+import struct
+import zlib
+from typing import Dict, Iterable, Optional
+
+
+class Encoding:
+    """
+    A content coding, named as in the Accept-Encoding header.
+    """
+    name = ""
+    default_level: Optional[int] = None
+
+    def compress(self, data: bytes, level: Optional[int] = None) -> bytes:
+        raise NotImplementedError("Implement compress() in subclasses")
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError("Implement decompress() in subclasses")
+
+    def compressor(self, level: Optional[int] = None):
+        """
+        Return an object for compressing a stream, with the methods
+        compress(data) and flush() of zlib compression objects.
+        """
+        raise NotImplementedError("Implement compressor() in subclasses")
+
+    def decompressor(self):
+        """
+        Return an object for decompressing a stream, with the methods
+        decompress(data, max_length=-1) and flush(). If max_length is not
+        negative, decompress stops once it has returned max_length bytes or
+        a little more; the stream cannot be continued after that.
+        """
+        raise NotImplementedError("Implement decompressor() in subclasses")
+
+    def begin(self, data: bytes, level: Optional[int] = None):
+        """
+        Compress data as the beginning of a stream which finish() completes,
+        possibly several times with different endings. Return the state to
+        pass to finish(), a tuple starting with the compressed data, or None
+        if the coding cannot do this.
+        """
+        return None
+
+    def finish(self, state, data: bytes, level: Optional[int] = None) -> bytes:
+        """
+        Return the compressed stream of the data passed to begin() followed
+        by data.
+        """
+        raise NotImplementedError("Implement finish() in subclasses supporting begin()")
+
+
+class GzipEncoding(Encoding):
+    name = "gzip"
+    default_level = 9
+
+    def compress(self, data: bytes, level: Optional[int] = None) -> bytes:
+        return gzip.compress(data, compresslevel=self.default_level if level is None else level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+    def compressor(self, level: Optional[int] = None):
+        return zlib.compressobj(self.default_level if level is None else level, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+
+    def decompressor(self):
+        return _ZlibDecompressor(zlib.decompressobj(16 + zlib.MAX_WBITS))
+
+    def begin(self, data: bytes, level: Optional[int] = None):
+        return _begin(self.compressor(level), data), zlib.crc32(data), len(data)
+
+    def finish(self, state, data: bytes, level: Optional[int] = None) -> bytes:
+        head, crc, size = state
+        return b"".join((head, _deflate(data, self.default_level if level is None else level),
+                         struct.pack("<II", zlib.crc32(data, crc), (size + len(data)) & 0xffffffff)))
+
+
+class DeflateEncoding(Encoding):
+    name = "deflate"
+    default_level = 6
+
+    def compress(self, data: bytes, level: Optional[int] = None) -> bytes:
+        return zlib.compress(data, self.default_level if level is None else level)
+
+    def decompress(self, data: bytes) -> bytes:
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Some servers send a raw deflate stream without zlib header.
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+
+    def compressor(self, level: Optional[int] = None):
+        return zlib.compressobj(self.default_level if level is None else level)
+
+    def decompressor(self):
+        return _DeflateDecompressor()
+
+    def begin(self, data: bytes, level: Optional[int] = None):
+        return _begin(self.compressor(level), data), zlib.adler32(data)
+
+    def finish(self, state, data: bytes, level: Optional[int] = None) -> bytes:
+        head, adler = state
+        return b"".join((head, _deflate(data, self.default_level if level is None else level),
+                         struct.pack(">I", zlib.adler32(data, adler))))
+
+
+class BrotliEncoding(Encoding):
+    name = "br"
+    # Higher qualities are too slow for compressing on the fly.
+    default_level = 5
+
+    def __init__(self):
+        import brotli
+        self._brotli = brotli
+
+    def compress(self, data: bytes, level: Optional[int] = None) -> bytes:
+        compressed: bytes = self._brotli.compress(data, quality=self.default_level if level is None else level)
+        return compressed
+
+    def decompress(self, data: bytes) -> bytes:
+        decompressed: bytes = self._brotli.decompress(data)
+        return decompressed
+
+    def compressor(self, level: Optional[int] = None):
+        return _BrotliCompressor(self._brotli.Compressor(quality=self.default_level if level is None else level))
+
+    def decompressor(self):
+        return _BrotliDecompressor(self._brotli.Decompressor())
+
+
+class ZstdEncoding(Encoding):
+    name = "zstd"
+    default_level = 3
+
+    def __init__(self):
+        import zstandard
+        self._zstandard = zstandard
+
+    def compress(self, data: bytes, level: Optional[int] = None) -> bytes:
+        compressor = self._zstandard.ZstdCompressor(level=self.default_level if level is None else level)
+        return compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        # Unlike decompress(), a decompressobj does not need the content
+        # size in the frame header.
+        return self._zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    def compressor(self, level: Optional[int] = None):
+        return self._zstandard.ZstdCompressor(level=self.default_level if level is None else level).compressobj()
+
+    def decompressor(self):
+        return _ZstdDecompressor(self._zstandard.ZstdDecompressor())
+
+
+def _begin(compressor, data: bytes) -> bytes:
+    # A sync flush ends the deflate data on a byte boundary without ending
+    # the stream, so further deflate blocks can be appended. The compressor
+    # is not kept, as it holds far more memory than the compressed data.
+    begun: bytes = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return begun
+
+
+def _deflate(data: bytes, level: int) -> bytes:
+    """
+    Compress data as the final raw deflate blocks of a stream begun with
+    _begin(). They do not refer back to the data of the beginning.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _BrotliCompressor:
+
+    def __init__(self, compressor):
+        self._compressor = compressor
+
+    def compress(self, data: bytes) -> bytes:
+        compressed: bytes = self._compressor.process(data)
+        return compressed
+
+    def flush(self) -> bytes:
+        compressed: bytes = self._compressor.finish()
+        return compressed
+
+
+class _ZlibDecompressor:
+
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+
+    def decompress(self, data: bytes, max_length: int = -1) -> bytes:
+        # For zlib, a max_length of 0 means no limit.
+        if max_length == 0:
+            return b""
+        decompressed: bytes = self._decompressor.decompress(data, max(max_length, 0))
+        return decompressed
+
+    def flush(self) -> bytes:
+        decompressed: bytes = self._decompressor.flush()
+        return decompressed
+
+
+class _BrotliDecompressor:
+
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+
+    def decompress(self, data: bytes, max_length: int = -1) -> bytes:
+        decompressed: bytes
+        if max_length < 0:
+            decompressed = self._decompressor.process(data)
+        else:
+            decompressed = self._decompressor.process(data, output_buffer_limit=max_length)
+        return decompressed
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class _Full(Exception):
+    pass
+
+
+class _ZstdDecompressor:
+    """
+    A zstandard decompression object takes no output limit, so decompress
+    into a stream writer which stops at the limit.
+    """
+    # Size of the chunks written to the sink.
+    write_size = 65536
+
+    def __init__(self, decompressor):
+        self._writer = decompressor.stream_writer(self, write_size=self.write_size)
+        self._output = []
+        self._size = 0
+        self._max_length = -1
+
+    def decompress(self, data: bytes, max_length: int = -1) -> bytes:
+        self._output, self._size, self._max_length = [], 0, max_length
+        try:
+            self._writer.write(data)
+        except _Full:
+            pass
+        return b"".join(self._output)
+
+    def flush(self) -> bytes:
+        return b""
+
+    def write(self, data: bytes) -> int:
+        self._output.append(bytes(data))
+        self._size += len(data)
+        if 0 <= self._max_length <= self._size:
+            raise _Full()
+        return len(data)
+
+
+class _DeflateDecompressor:
+    """
+    Decompress deflate data with or without zlib header, like
+    DeflateEncoding.decompress.
+    """
+
+    def __init__(self) -> None:
+        self._decompressor: Optional[_ZlibDecompressor] = None
+
+    def decompress(self, data: bytes, max_length: int = -1) -> bytes:
+        if self._decompressor is None and data:
+            self._decompressor = _ZlibDecompressor(zlib.decompressobj())
+            try:
+                return self._decompressor.decompress(data, max_length)
+            except zlib.error:
+                self._decompressor = _ZlibDecompressor(zlib.decompressobj(-zlib.MAX_WBITS))
+        if self._decompressor is None:
+            return b""
+        return self._decompressor.decompress(data, max_length)
+
+    def flush(self) -> bytes:
+        return self._decompressor.flush() if self._decompressor is not None else b""
+
+
+encodings: Dict[str, Encoding] = {}
+
+# Server preference when the client accepts several codings equally.
+PREFERENCE = ("zstd", "br", "gzip", "deflate")
+
+
+def register_encoding(encoding: Encoding) -> None:
+    encodings[encoding.name] = encoding
+
+
+for _encoding_class in (GzipEncoding, DeflateEncoding, BrotliEncoding, ZstdEncoding):
+    try:
+        register_encoding(_encoding_class())
+    except ImportError:
+        pass
+
+
+def available(preference: Iterable[str] = PREFERENCE) -> list:
+    """
+    Return the names of the registered codings, in order of preference.
+    """
+    return [name for name in preference if name in encodings]
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """
+    Map each coding of an Accept-Encoding header to its q-value.
+    """
+    accepted: Dict[str, float] = {}
+    if not header:
+        return accepted
+    for item in header.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name == "x-gzip":
+            name = "gzip"
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def negotiate(header: Optional[str], preference: Iterable[str] = PREFERENCE) -> Optional[str]:
+    """
+    Return the coding to use for a response, or None to send it unencoded.
+
+    The accepted coding with the highest q-value wins; ties are resolved
+    by the order of preference.
+    """
+    accepted = parse_accept_encoding(header)
+    if not accepted:
+        return None
+    wildcard = accepted.get("*", 0.0)
+    best, best_q = None, 0.0
+    for name in available(preference):
+        q = accepted.get(name, wildcard)
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def _decodings(content_encoding: Iterable[str]) -> list:
+    """
+    Return the encodings to undo for Content-Encoding headers, in the order
+    they have to be undone.
+    """
+    result = []
+    names = [name.strip().lower()
+             for header in content_encoding for name in header.split(",")]
+    for name in reversed(names):
+        if name in ("", "identity"):
+            continue
+        if name == "x-gzip":
+            name = "gzip"
+        if name not in encodings:
+            raise ValueError("unsupported content encoding %r" % name)
+        result.append(encodings[name])
+    return result
+
+
+def decode(data: bytes, content_encoding: Iterable[str]) -> bytes:
+    """
+    Undo the codings listed in Content-Encoding headers, applied in order.
+    """
+    for encoding in _decodings(content_encoding):
+        data = encoding.decompress(data)
+    return data
+
+
+class BodyTooLarge(ValueError):
+    """
+    A body is larger than allowed, after decoding.
+    """
+
+
+# Codings a Decoder undoes at most; each stacked coding multiplies the
+# size a small body can decompress to.
+MAX_CODINGS = 1
+
+
+class Decoder:
+    """
+    Undo the codings listed in Content-Encoding headers for a body which
+    arrives in chunks, without keeping the encoded body around.
+
+    If max_size is given, BodyTooLarge is raised as soon as the decoded body
+    grows larger, without decompressing more than max_size bytes per
+    coding. Bodies with more than max_codings codings are refused with
+    ValueError.
+    """
+
+    def __init__(self, content_encoding: Iterable[str] = (), max_size: Optional[int] = None,
+                 max_codings: int = MAX_CODINGS):
+        decodings = _decodings(content_encoding)
+        if len(decodings) > max_codings:
+            raise ValueError("more than %d content codings" % max_codings)
+        self.decompressors = [encoding.decompressor() for encoding in decodings]
+        self.max_size = max_size
+        self.size = 0
+        # Decompressed bytes per coding, limited like the decoded body.
+        self._sizes = [0] * len(self.decompressors)
+
+    def decode(self, data: bytes) -> bytes:
+        try:
+            for index, decompressor in enumerate(self.decompressors):
+                if not data:
+                    break
+                data = self._limit(index, decompressor.decompress(data, self._remaining(index)))
+        except BodyTooLarge:
+            raise
+        except Exception as e:
+            # zlib, brotli and zstandard each raise their own error type.
+            raise ValueError("undecodable body: %s" % e) from e
+        return self._count(data)
+
+    def flush(self) -> bytes:
+        """
+        Return the rest of the decoded body once all chunks have been
+        passed to decode().
+        """
+        data = b""
+        try:
+            for index, decompressor in enumerate(self.decompressors):
+                if data:
+                    data = self._limit(index, decompressor.decompress(data, self._remaining(index)))
+                data += self._limit(index, decompressor.flush())
+        except BodyTooLarge:
+            raise
+        except Exception as e:
+            raise ValueError("undecodable body: %s" % e) from e
+        return self._count(data)
+
+    def _remaining(self, index: int) -> int:
+        # One byte more than allowed tells that the body is too large.
+        if self.max_size is None:
+            return -1
+        return self.max_size - self._sizes[index] + 1
+
+    def _limit(self, index: int, data: bytes) -> bytes:
+        self._sizes[index] += len(data)
+        if self.max_size is not None and self._sizes[index] > self.max_size:
+            raise BodyTooLarge("body larger than %d bytes" % self.max_size)
+        return data
+
+    def _count(self, data: bytes) -> bytes:
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise BodyTooLarge("body larger than %d bytes" % self.max_size)
+        return data
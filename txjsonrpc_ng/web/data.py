@@ -1,11 +1,120 @@
-from dataclasses import dataclass
-from typing import Union, Dict, List, Optional
+import hashlib
+from dataclasses import dataclass, field
+from typing import Any, Union, Dict, List, Optional, Tuple
+
+from txjsonrpc_ng import jsonrpclib
+
+
+@dataclass
+class RawJSON:
+    """
+    A result which is serialized already, like a JSON column of a database
+    or the response of another service. The servers insert it into their
+    responses byte for byte, without parsing it, so it must be valid JSON.
+
+    Only a RawJSON returned as the result itself is inserted as is; a
+    RawJSON within other values cannot be serialized.
+    """
+    value: bytes
+
+    def __post_init__(self):
+        if isinstance(self.value, str):
+            self.value = self.value.encode()
+
+    def serialize(self, id, version: int, callback: Optional[bytes] = None) -> bytes:
+        """
+        Return the response to a call with id and version.
+        """
+        prefix, suffix = _envelope(id, version, callback)
+        return b"".join((prefix, self.value, suffix))
 
 
 @dataclass
 class CacheableResult:
+    """
+    A result which is serialized only once, however many calls return it.
+
+    The serialized value is shared by the responses to all calls, which
+    differ only by their envelope: the id and version of the call and the
+    JSONP callback. Compressed responses are kept per coding and version;
+    as the id comes last in a response, the compressed data up to the id is
+    kept, and the end of it is compressed per call, see
+    compression.Encoding.begin(). JSONP responses are compressed per call,
+    so clients cannot add responses to keep by choosing callbacks.
+    """
+    value: Union[Dict, List, RawJSON]
+    # The serialized value.
+    body: Optional[bytes] = None
+    # The compressed responses, keyed by (coding, version): the
+    # complete response for pre-version 1.0 calls, which do not contain an
+    # id, else the state returned by Encoding.begin().
+    compressed_values: Dict[Tuple[str, int], Any] = field(default_factory=dict)
+    # Seconds clients may use the result without asking again, sent as
+    # Cache-Control max-age.
+    max_age: Optional[int] = None
+    _etag: Optional[str] = field(default=None, repr=False, compare=False)
+
+    @property
+    def etag(self) -> str:
+        """
+        The entity tag of the result, sent in the ETag header.
+
+        It is computed from the serialized value only, as the responses for
+        calls with different ids differ just by their envelope, and is
+        therefore weak.
+        """
+        if self._etag is None:
+            digest = hashlib.blake2b(self.serialized(), digest_size=16).hexdigest()
+            self._etag = 'W/"%s"' % digest
+        return self._etag
+
+    def serialized(self) -> bytes:
+        """
+        Return the serialized value, serializing it on first use. Raises
+        the error of the JSON codec if the value is not serializable.
+        """
+        if self.body is None:
+            if isinstance(self.value, RawJSON):
+                self.body = self.value.value
+            else:
+                self.body = jsonrpclib.getCodec().dumpb(self.value)
+        return self.body
+
+    def envelope(self, id, version: int, callback: Optional[bytes] = None) -> Tuple[bytes, bytes]:
+        """
+        Return the parts of the response to a call with id and version
+        before and after the serialized value.
+        """
+        return _envelope(id, version, callback)
+
+    def serialize(self, id, version: int, callback: Optional[bytes] = None) -> bytes:
+        """
+        Return the response to a call with id and version.
+        """
+        prefix, suffix = self.envelope(id, version, callback)
+        return b"".join((prefix, self.serialized(), suffix))
+
+    def nbytes(self) -> int:
+        """
+        Return the size of the serialized and compressed data kept.
+        """
+        size = len(self.body) if self.body is not None else 0
+        for value in self.compressed_values.values():
+            size += len(value if isinstance(value, bytes) else value[0])
+        return size
+
+
+@dataclass
+class StreamingResult:
+    """
+    A result which is encoded and written in chunks while it is serialized,
+    instead of building the whole response in memory first.
+    """
     value: Union[Dict, List]
-    string_value: Optional[str] = None
-    compressed_value: Optional[bytes] = None
 
 
+def _envelope(id, version: int, callback: Optional[bytes]) -> Tuple[bytes, bytes]:
+    prefix, suffix = jsonrpclib.envelopeb(id, version)
+    if callback:
+        prefix, suffix = callback + b"(" + prefix, suffix + b")"
+    return prefix, suffix
@@ -12,12 +12,22 @@ Maintainer: U{Duncan McGreggor<mailto:oubiwann@adytum.us>}
 """
 
 import codecs
+import collections
+import functools
 import io
+import re
+from typing import Iterator
 
 from twisted.web.client import Agent
 from twisted.web.http_headers import Headers
 
-from .render import renderer_factory
+from txjsonrpc_ng.cache import SingleFlight, cached, call_key, single_flight
+from txjsonrpc_ng.limits import Limiter, Overloaded, limit, limited
+from txjsonrpc_ng.metrics import REGISTRY
+from txjsonrpc_ng.workers import in_process, in_thread
+from . import compression as encodings
+from .data import CacheableResult, RawJSON, StreamingResult
+from .render import DEFAULT_COMPRESSION, DefaultRenderer, renderer_factory
 
 try:
     import urlparse
@@ -28,19 +38,20 @@ try:
     import xmlrpclib
 except ImportError:
     import xmlrpc.client as xmlrpclib
-import gzip
 
 from twisted.web import resource, server
-from twisted.internet import defer, reactor
+from twisted.internet import defer, error, protocol, reactor
 from twisted.python import log, context
 from twisted.web import http
-from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 from zope.interface import implementer
 
 from txjsonrpc_ng import jsonrpclib
-from txjsonrpc_ng.jsonrpc import BaseProxy, BaseQueryFactory, BaseSubhandler
+from txjsonrpc_ng.jsonrpc import (
+    BaseProxy, BaseQueryFactory, BaseSubhandler, BatchQueryMixin)
 from xmlrpc.client import Fault as XMLRPCFault
 
 # Useful so people don't need to import xmlrpclib directly.
@@ -49,6 +60,10 @@ Binary = xmlrpclib.Binary
 Boolean = xmlrpclib.Boolean
 DateTime = xmlrpclib.DateTime
 
+# JSONP callbacks are echoed into the response, so only names of JavaScript
+# functions, possibly dotted, are accepted.
+_JSONP_CALLBACK = re.compile(rb"^[A-Za-z_$][\w$.]*\Z")
+
 
 def with_request(method):
     """
@@ -114,6 +129,24 @@ class JSONRPC(resource.Resource, BaseSubhandler):
     Binary, Boolean, DateTime, Deferreds, or Handler instances.
 
     By default methods beginning with 'jsonrpc_' are published.
+
+    Response compression is configured by setting compression to a
+    render.CompressionSettings instance.
+
+    Methods can wrap large results in a data.StreamingResult to have them
+    encoded, compressed and written in chunks.
+
+    If single_flight is true, concurrent calls of a method with the same
+    parameters share one call, except for methods decorated with
+    with_request; see cache.SingleFlight. Use the single_flight decorator
+    to enable this for single methods.
+
+    If limiter is set to a limits.Limiter, calls beyond its limits fail
+    with an Overloaded fault, sent with status 503. Use the limited
+    decorator to limit single methods.
+
+    Calls, payload sizes, serialization and compression are recorded in
+    metrics, metrics.REGISTRY by default; set it to None to record nothing.
     """
 
     # Error codes for Twisted, if they conflict with yours then
@@ -124,24 +157,61 @@ class JSONRPC(resource.Resource, BaseSubhandler):
     isLeaf = 1
     except_map: dict = {}
     auth_token = "Auth-Token"
+    compression = DEFAULT_COMPRESSION
+    single_flight = False
+    limiter = None
+    metrics = REGISTRY
 
     def __init__(self):
         resource.Resource.__init__(self)
         BaseSubhandler.__init__(self)
+        self.flights = SingleFlight()
 
     def render(self, request):
         request.content.seek(0, 0)
         # Unmarshal the JSON-RPC data.
-        content = request.content.read().decode()
+        content = request.content.read()
         if not content and request.method == 'GET' and 'request' in request.args:
             content = request.args['request'][0]
-        self.callback = request.args['callback'][0] if 'callback' in request.args else None
-        self.is_jsonp = True if self.callback else False
-        if not self.is_jsonp:
+        if self.metrics is not None:
+            self.metrics.request_bytes.observe(len(content))
+        # Twisted decodes query arguments as bytes. The callback belongs to
+        # this request; the resource is shared by concurrent requests.
+        key = b'callback' if b'callback' in request.args else 'callback'
+        callback = request.args[key][0] if key in request.args else None
+        if isinstance(callback, str):
+            callback = callback.encode()
+        if not callback:
+            callback = None
             request.setHeader("content-type", "application/json")
+        elif not _JSONP_CALLBACK.match(callback):
+            request.setResponseCode(http.BAD_REQUEST)
+            request.setHeader("content-type", "text/plain")
+            return b"invalid JSONP callback"
         else:
             request.setHeader("content-type", "text/javascript")
-        parsed = jsonrpclib.loads(content)
+        parsed = jsonrpclib.loadb(content)
+        token = None
+        if request.requestHeaders.hasHeader(self.auth_token):
+            token = request.requestHeaders.getRawHeaders(self.auth_token)[0]
+        if isinstance(parsed, list):
+            return self._renderBatch(parsed, request, token, callback)
+        d, id, version = self._callFunction(parsed, request, token)
+        d.addCallback(self._cbRender, request, id, version, callback)
+        if not d.called:
+            def _responseFailed(err, call):
+                call.cancel()
+
+            request.notifyFinish().addErrback(_responseFailed, d)
+        return server.NOT_DONE_YET
+
+    def _callFunction(self, parsed, request, token):
+        """
+        Dispatch a single decoded call.
+
+        Return a Deferred which fires with the result of the call or with a
+        Fault, together with the id and protocol version of the call.
+        """
         functionPath = parsed.get("method")
         params = parsed.get('params', {})
         args, kwargs = [], {}
@@ -150,9 +220,6 @@ class JSONRPC(resource.Resource, BaseSubhandler):
         else:
             kwargs = params
         id = parsed.get('id')
-        token = None
-        if request.requestHeaders.hasHeader(self.auth_token):
-            token = request.requestHeaders.getRawHeaders(self.auth_token)[0]
         version = parsed.get('jsonrpc')
         if version:
             version = int(float(version))
@@ -163,51 +230,155 @@ class JSONRPC(resource.Resource, BaseSubhandler):
         # XXX this all needs to be re-worked to support logic for multiple
         # versions...
         try:
-            function = self._getFunction(functionPath)
+            entry = self._getDispatchEntry(functionPath)
+            function = entry.function
             d = None
-            if hasattr(function, 'requires_auth'):
+            if entry.requires_auth:
                 d = defer.maybeDeferred(self.auth, token, functionPath)
         except jsonrpclib.Fault as f:
-            self._cbRender(f, request, id, version)
+            return defer.succeed(f), id, version
+        function = limit(self.limiter, function)
+        if entry.with_request:
+            args = [request] + args
+        elif self.single_flight:
+            function = functools.partial(self.flights.call, (functionPath, call_key(args, kwargs)), function)
+
+        if self.metrics is not None:
+            done = self.metrics.call(functionPath)
+        if d:
+            d.addCallback(context.call, function, *args, **kwargs)
         else:
-            if hasattr(function, 'with_request'):
-                args = [request] + args
+            d = defer.maybeDeferred(function, *args, **kwargs)
+        d.addCallback(self._cbHandler)
+        if self.metrics is not None:
+            d.addBoth(done)
+        d.addErrback(self._ebRender, id)
+        return d, id, version
+
+    def _cbHandler(self, result):
+        if isinstance(result, Handler):
+            return result.result
+        return result
 
-            if d:
-                d.addCallback(context.call, function, *args, **kwargs)
+    def _renderBatch(self, batch, request, token, callback=None):
+        """
+        Dispatch all calls of a JSON-RPC 2.0 batch concurrently and reply
+        with a single array once all of them have finished.
+        """
+        if not batch:
+            f = jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC, "empty batch")
+            self._cbRender(f, request, None, jsonrpclib.VERSION_2, callback)
+            return server.NOT_DONE_YET
+        calls = []
+        for parsed in batch:
+            if isinstance(parsed, dict):
+                d, id, version = self._callFunction(parsed, request, token)
+                # Notifications are run but get no element in the reply.
+                calls.append((d, id, version, id is not None))
             else:
-                d = defer.maybeDeferred(function, *args, **kwargs)
-            d.addErrback(self._ebRender, id)
-            d.addCallback(self._cbRender, request, id, version)
+                f = jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC, "invalid request")
+                calls.append((defer.succeed(f), None, jsonrpclib.VERSION_2, True))
+        d = defer.DeferredList([call[0] for call in calls], consumeErrors=True)
+        d.addCallback(self._cbRenderBatch, request, calls, callback)
 
-            def _responseFailed(err, call):
-                call.cancel()
+        def _responseFailed(err, calls):
+            for call in calls:
+                call[0].cancel()
 
-            request.notifyFinish().addErrback(_responseFailed, d)
+        request.notifyFinish().addErrback(_responseFailed, calls)
         return server.NOT_DONE_YET
 
-    def _cbRender(self, result, request, id, version):
+    def _cbRenderBatch(self, results, request, calls, callback=None):
+        if request.channel is None:
+            # The connection was lost, e.g. because the client cancelled
+            # the call.
+            return None
+        parts = []
+        for (success, result), (_, id, version, reply) in zip(results, calls):
+            if reply:
+                parts.append(self._dumps(result, id, version))
+        if not parts:
+            request.finish()
+            return None
+        text = self._jsonp(b"[%s]" % b", ".join(parts), callback)
+        renderer = DefaultRenderer(text, None, jsonrpclib.VERSION_2, request, self.compression, self.metrics)
+        return self._finish(renderer.render(lambda text, id, version: text), request, renderer)
+
+    def _cbRender(self, result, request, id, version, callback=None):
         if isinstance(result, Handler):
             result = result.result
 
-        if result is not None:
-            renderer = renderer_factory(result, id, version, request)
-            renderer.render(self._render_text)
+        if request.channel is None:
+            # The connection was lost, e.g. because the client cancelled
+            # the call.
+            return result
+        if result is None:
+            request.finish()
+            return result
+        if isinstance(result, Overloaded):
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        renderer = renderer_factory(result, id, version, request, self.compression, self.metrics, callback)
+        render = self._render_chunks if renderer.streaming else self._render_text
+        d = self._finish(renderer.render(functools.partial(render, callback=callback)), request, renderer)
+        if d is None:
+            return result
+        return d.addCallback(lambda _: result)
+
+    def _finish(self, written, request, renderer):
+        """
+        Finish the request once the renderer has written the response, which
+        may happen later if it compresses in a thread.
+        """
+        if written is None:
+            request.finish()
+            return None
+
+        def finish(_):
+            if not renderer.request_lost:
+                request.finish()
 
-        request.finish()
-        return result
+        return written.addCallback(finish)
 
-    def _render_text(self, result, id, version) -> str:
+    def _render_text(self, result, id, version, callback=None) -> bytes:
+        if self.metrics is not None:
+            return self._jsonp(self.metrics.serialization.time(self._dumps, result, id, version), callback)
+        return self._jsonp(self._dumps(result, id, version), callback)
+
+    def _render_chunks(self, result, id, version, callback=None) -> Iterator[bytes]:
+        if callback:
+            yield callback + b"("
+        if version == jsonrpclib.VERSION_PRE1:
+            result = (result,)
+        yield from jsonrpclib.iterencode(result, id=id, version=version)
+        if callback:
+            yield b")"
+
+    def _jsonp(self, s: bytes, callback=None) -> bytes:
+        if not callback:
+            return s
+        return b"%s(%s)" % (callback, s)
+
+    def _dumps(self, result, id, version) -> bytes:
+        # Cacheable and streaming results in a batch, which is rendered as
+        # a whole.
+        if isinstance(result, RawJSON):
+            return result.serialize(id, version)
+        if isinstance(result, CacheableResult):
+            try:
+                return result.serialize(id, version)
+            except Exception:
+                result = result.value
+        elif isinstance(result, StreamingResult):
+            result = result.value
         if version == jsonrpclib.VERSION_PRE1:
             if not isinstance(result, jsonrpclib.Fault):
                 result = (result,)
+        s: bytes
         try:
-            s = jsonrpclib.dumps(result, id=id, version=version) if not self.is_jsonp else "%s(%s)" % (
-                self.callback, jsonrpclib.dumps(result, id=id, version=version))
+            s = jsonrpclib.dumpb(result, id=id, version=version)
         except:
             f = jsonrpclib.Fault(self.FAILURE, "can't serialize output")
-            s = jsonrpclib.dumps(f, id=id, version=version) if not self.is_jsonp else "%s(%s)" % (
-                self.callback, jsonrpclib.dumps(f, id=id, version=version))
+            s = jsonrpclib.dumpb(f, id=id, version=version)
         return s
 
     def _map_exception(self, exception):
@@ -216,7 +387,9 @@ class JSONRPC(resource.Resource, BaseSubhandler):
     def _ebRender(self, failure, id):
         if isinstance(failure.value, jsonrpclib.Fault):
             return failure.value
-        log.err(failure)
+        if not failure.check(defer.CancelledError):
+            # Calls are cancelled when their client goes away.
+            log.err(failure)
         message = failure.value.message if hasattr(failure.value, 'message') else repr(failure.value)
         code = self._map_exception(type(failure.value))
         return jsonrpclib.Fault(code, message)
@@ -225,6 +398,78 @@ class JSONRPC(resource.Resource, BaseSubhandler):
         return True
 
 
+class JSONRPCRequest(server.Request):
+    """
+    A request which decodes a compressed body chunk by chunk as it arrives
+    and refuses bodies larger than the max_body_size of its site.
+
+    The body is stored decoded, so JSONRPC reads it as usual.
+    """
+    decoder = None
+    body_error = None
+
+    def gotLength(self, length):
+        max_size = getattr(self.channel.site, "max_body_size", None)
+        if max_size is not None and length is not None and length > max_size:
+            # Reject the body before any of it has been read.
+            self.content = io.BytesIO()
+            self.rejectBody(http.REQUEST_ENTITY_TOO_LARGE, b"Request Entity Too Large")
+            return
+        server.Request.gotLength(self, length)
+        content_encoding = self.requestHeaders.getRawHeaders("content-encoding", [])
+        try:
+            self.decoder = encodings.Decoder(content_encoding, max_size)
+        except ValueError:
+            self.rejectBody(http.UNSUPPORTED_MEDIA_TYPE, b"Unsupported Media Type")
+
+    def handleContentChunk(self, data):
+        if self.body_error is not None:
+            return
+        try:
+            self.content.write(self.decoder.decode(data))
+        except encodings.BodyTooLarge:
+            self.rejectBody(http.REQUEST_ENTITY_TOO_LARGE, b"Request Entity Too Large")
+        except ValueError:
+            self.rejectBody(http.BAD_REQUEST, b"Bad Request")
+
+    def requestReceived(self, command, path, version):
+        if self.body_error is None:
+            try:
+                self.content.write(self.decoder.flush())
+            except encodings.BodyTooLarge:
+                self.rejectBody(http.REQUEST_ENTITY_TOO_LARGE, b"Request Entity Too Large")
+            except ValueError:
+                self.rejectBody(http.BAD_REQUEST, b"Bad Request")
+        if self.body_error is not None:
+            return
+        server.Request.requestReceived(self, command, path, version)
+
+    def rejectBody(self, code, message):
+        """
+        Answer with an error status and drop the connection, without reading
+        the rest of the body.
+        """
+        self.body_error = code
+        self.content = io.BytesIO()
+        self.channel.transport.write(b"HTTP/1.1 %d %s\r\n\r\n" % (code, message))
+        self.channel.loseConnection()
+
+
+class JSONRPCSite(server.Site):
+    """
+    A site which decodes compressed request bodies as they arrive.
+
+    @type max_body_size: C{int} or None
+    @ivar max_body_size: Requests with a larger body, after decoding, are
+    refused with status 413 as soon as they exceed it.
+    """
+    requestFactory = JSONRPCRequest
+
+    def __init__(self, resource, max_body_size=None, *args, **kwargs):
+        server.Site.__init__(self, resource, *args, **kwargs)
+        self.max_body_size = max_body_size
+
+
 @implementer(IBodyProducer)
 class StringProducer:
     """
@@ -245,14 +490,92 @@ class StringProducer:
         pass
 
 
+class BodyReceiver(protocol.Protocol):
+    """
+    Collect a response body, decoding it chunk by chunk.
+
+    The Deferred fires with the decoded body, or fails as soon as the body
+    cannot be decoded or is larger than the decoder allows.
+    """
+
+    def __init__(self, deferred, decoder):
+        self.deferred = deferred
+        self.decoder = decoder
+        self.chunks = []
+
+    def cancel(self, deferred):
+        """
+        Stop receiving the body; use as the canceller of the Deferred.
+        """
+        self.deferred = None
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self.deferred is None:
+            return
+        try:
+            self.chunks.append(self.decoder.decode(data))
+        except ValueError:
+            d, self.deferred = self.deferred, None
+            self.transport.stopProducing()
+            d.errback()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self.deferred is None:
+            return
+        d, self.deferred = self.deferred, None
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            d.errback(reason)
+            return
+        try:
+            self.chunks.append(self.decoder.flush())
+        except ValueError:
+            d.errback()
+            return
+        d.callback(b"".join(self.chunks))
+
+
+def _maxAge(cache_control):
+    """
+    Return the max-age of Cache-Control headers, or None.
+    """
+    for header in cache_control:
+        for directive in header.split(","):
+            name, _, value = directive.partition("=")
+            if name.strip().lower() == "max-age":
+                try:
+                    return int(value.strip().strip('"'))
+                except ValueError:
+                    return None
+    return None
+
+
 class QueryFactory(BaseQueryFactory):
     """
     Factory for making JSON-RPC requests using twisted.web.client.Agent.
     """
     deferred = None
+    # Responses with a larger body, after decoding, fail with
+    # compression.BodyTooLarge.
+    max_body_size = None
+    # Sent as If-None-Match; the call returns cachedResult if the server
+    # answers that it has not been modified.
+    etag = None
+    cachedResult = None
+    # Taken from the ETag and Cache-Control headers of the response.
+    responseETag = None
+    responseMaxAge = None
+    # Seconds after which a request which has been made is cancelled and
+    # the call fails with twisted.internet.error.TimeoutError.
+    timeout = None
+    request = None
+    timeoutCall = None
 
     def __init__(self, agent, url, method, username, password, version=jsonrpclib.VERSION_PRE1, compress=False, *args):
         BaseQueryFactory.__init__(self, method, version, *args)
+        # Cancelling the call cancels the request.
+        self.deferred = defer.Deferred(self._cancel)
         self.agent = agent
         self.url = url
         self.username = username
@@ -271,7 +594,11 @@ class QueryFactory(BaseQueryFactory):
         }
 
         if self.compress:
-            headers_dict[b'Accept-Encoding'] = [b'gzip']
+            accepted = encodings.available() if self.compress is True else self.compress
+            headers_dict[b'Accept-Encoding'] = [', '.join(accepted).encode()]
+
+        if self.etag is not None:
+            headers_dict[b'If-None-Match'] = [self.etag.encode()]
 
         if self.username:
             auth = '%s:%s' % (self.username, self.password)
@@ -294,36 +621,61 @@ class QueryFactory(BaseQueryFactory):
         # Add callbacks
         d.addCallback(self._handleResponse)
         d.addErrback(self._handleError)
+        self.request = d
+        if self.timeout is not None:
+            self.timeoutCall = reactor.callLater(self.timeout, self._timedOut)
+            self.deferred.addBoth(self._stopTimeout)
         return d
 
+    def _cancel(self, deferred):
+        self.deferred = None
+        self._stopTimeout(None)
+        if self.request is not None:
+            self.request.cancel()
+
+    def _timedOut(self):
+        d, self.deferred = self.deferred, None
+        self.request.cancel()
+        if d is not None:
+            d.errback(error.TimeoutError("no reply after %s seconds" % self.timeout))
+
+    def _stopTimeout(self, result):
+        if self.timeoutCall is not None and self.timeoutCall.active():
+            self.timeoutCall.cancel()
+        return result
+
     def _handleResponse(self, response):
         """
         Handle the HTTP response.
         """
+        self.responseETag = response.headers.getRawHeaders('etag', [None])[0]
+        self.responseMaxAge = _maxAge(response.headers.getRawHeaders('cache-control', []))
+        if self.deferred is None:
+            # Timed out or cancelled meanwhile.
+            return response
+        if response.code == http.NOT_MODIFIED and self.etag is not None:
+            self.deferred.callback(self.cachedResult)
+            self.deferred = None
+            return response
+
         if response.code != 200:
             self.badStatus(str(response.code), response.phrase.decode('utf-8'))
             return response
 
-        # Read the response body
-        d = readBody(response)
+        # Read and decode the response body as it arrives.
+        content_encoding = response.headers.getRawHeaders('content-encoding', [])
+        receiver = BodyReceiver(None, encodings.Decoder(content_encoding, self.max_body_size))
+        receiver.deferred = d = defer.Deferred(receiver.cancel)
+        response.deliverBody(receiver)
         d.addCallback(self._processBody, response)
         d.addErrback(self._handleError)
         return d
 
     def _processBody(self, body, response):
         """
-        Process the response body, handling gzip compression if needed.
+        Process the decoded response body.
         """
-        # Check for gzip compression
-        content_encoding = response.headers.getRawHeaders(b'content-encoding')
-        if content_encoding and b'gzip' in [enc.lower() for enc in content_encoding]:
-            compressed_file = io.BytesIO(body)
-            with gzip.GzipFile(mode='rb', fileobj=compressed_file) as in_file:
-                body = in_file.read()
-            compressed_file.close()
-
-        # Parse the response
-        self.parseResponse(body.decode('utf-8'))
+        self.parseResponse(body)
 
     def _handleError(self, failure):
         """
@@ -334,6 +686,17 @@ class QueryFactory(BaseQueryFactory):
             self.deferred = None
 
 
+class BatchQueryFactory(BatchQueryMixin, QueryFactory):
+    """
+    Factory for sending a batch of calls in one JSON-RPC 2.0 request.
+    """
+
+    def __init__(self, agent, url, batch, username, password, compress=False):
+        QueryFactory.__init__(self, agent, url, None, username, password,
+                              batch.version, compress)
+        self._setBatch(batch)
+
+
 class Proxy(BaseProxy):
     """
     A Proxy for making remote JSON-RPC calls.
@@ -346,7 +709,9 @@ class Proxy(BaseProxy):
 
     def __init__(self, url, username=None, password=None,
                  version=jsonrpclib.VERSION_PRE1, compress=False, factoryClass=QueryFactory,
-                 ssl_ctx_factory=None, pool=None):
+                 ssl_ctx_factory=None, pool=None, max_body_size=None, cache_size=0,
+                 timeout=None, max_in_flight=None, max_persistent_per_host=None,
+                 cached_connection_timeout=None):
         """
         @type url: C{str}
         @param url: The URL to which to post method calls.  Calls will be made
@@ -372,6 +737,11 @@ class Proxy(BaseProxy):
         the version of the spec that txJSON-RPC was originally released with,
         pre-Version 1.0.
 
+        @type compress: C{bool} or sequence of C{str}
+        @param compress: If true, ask the server for a compressed response,
+        accepting all content codings available here. Pass a sequence of
+        coding names to accept only those, e.g. ["gzip"].
+
         @type ssl_ctx_factory: C{twisted.internet.ssl.ClientContextFactory} or None
         @param ssl_ctx_factory: SSL client context factory class to use instead
         of default twisted.internet.ssl.ClientContextFactory.
@@ -379,6 +749,36 @@ class Proxy(BaseProxy):
         @type pool: C{twisted.web.client.HTTPConnectionPool} or None
         @param pool: Connection pool to use for the Agent. If None, a new pool
         will be created.
+
+        @type max_body_size: C{int} or None
+        @param max_body_size: Calls fail with compression.BodyTooLarge as soon
+        as a response body, after decoding, grows larger than this.
+
+        @type cache_size: C{int}
+        @param cache_size: The number of results with an ETag to keep. A call
+        with the same method, parameters and version is answered from this
+        cache while the result is fresh according to its max-age, and
+        otherwise sent with If-None-Match so the server can answer that it is
+        unchanged. Results are returned as kept, so do not modify them.
+
+        @type timeout: C{float} or None
+        @param timeout: Seconds after which a call whose request has been sent
+        is cancelled and fails with twisted.internet.error.TimeoutError. Pass
+        timeout to callRemote to override it for a single call.
+
+        @type max_in_flight: C{int} or None
+        @param max_in_flight: The maximum number of calls and batches sent at
+        once; further calls wait until one of them has finished.
+
+        @type max_persistent_per_host: C{int} or None
+        @param max_persistent_per_host: The number of idle connections the
+        pool created by the proxy keeps open per host. Defaults to
+        max_in_flight if that is given, and to the default of
+        HTTPConnectionPool otherwise.
+
+        @type cached_connection_timeout: C{float} or None
+        @param cached_connection_timeout: Seconds after which the pool
+        created by the proxy closes an idle connection.
         """
         BaseProxy.__init__(self, version, factoryClass)
 
@@ -406,6 +806,11 @@ class Proxy(BaseProxy):
             port = None
         self.secure = (scheme == 'https')
         self.compress = compress
+        self.max_body_size = max_body_size
+        self.cache_size = cache_size
+        self.responses = collections.OrderedDict()
+        self.timeout = timeout
+        self.limiter = Limiter(max_in_flight) if max_in_flight is not None else None
         self.ssl_ctx_factory = ssl_ctx_factory
         if port:
             clean_url = '%s://%s:%d%s' % (scheme, host, port, path)
@@ -416,6 +821,13 @@ class Proxy(BaseProxy):
         # Create Agent
         if pool is None:
             pool = HTTPConnectionPool(reactor)
+            if max_persistent_per_host is None:
+                max_persistent_per_host = max_in_flight
+            if max_persistent_per_host is not None:
+                pool.maxPersistentPerHost = max_persistent_per_host
+            if cached_connection_timeout is not None:
+                pool.cachedConnectionTimeout = cached_connection_timeout
+        self.pool = pool
 
         if self.secure:
             from twisted.internet import ssl
@@ -428,11 +840,78 @@ class Proxy(BaseProxy):
 
     def callRemote(self, method, *args, **kwargs):
         version = self._getVersion(kwargs)
-        # XXX generate unique id and pass it as a parameter
         factoryClass = self._getFactoryClass(kwargs)
         factory = factoryClass(self.agent, self.url, method, self.username, self.password, version, self.compress, *args)
+        factory.max_body_size = self.max_body_size
+        factory.timeout = kwargs.get("timeout", self.timeout)
+        key = None
+        if self.cache_size:
+            key = (method, version, call_key(args, {}))
+            fresh = self._getCachedResponse(key, factory)
+            if fresh is not None:
+                return fresh
+        d = factory.deferred
+        if key is not None:
+            d.addCallback(self._cacheResponse, key, factory)
+        if self.metrics is None:
+            return self._send(factory)
+        done = self.metrics.call(method, client=True)
+        return self._send(factory).addBoth(done)
+
+    def _send(self, factory):
+        """
+        Make the request of factory once the in-flight limit allows it.
+        Cancelling a call which is still waiting leaves nothing behind, as
+        calls are only registered once their request is made.
+        """
+        if self.limiter is not None:
+            return self.limiter.run(self._makeRequest, factory)
+        return self._makeRequest(factory)
+
+    def _makeRequest(self, factory):
+        d = factory.deferred
+        if not isinstance(factory, BatchQueryFactory):
+            # The calls of a batch are registered when they are added.
+            self.requests.register(factory)
         factory._makeRequest()
-        return factory.deferred
+        return d
+
+    def _getCachedResponse(self, key, factory):
+        """
+        Return a Deferred firing with a fresh cached result for key, or
+        prepare factory to revalidate a stale one.
+        """
+        try:
+            etag, result, expires = self.responses[key]
+        except KeyError:
+            return None
+        self.responses.move_to_end(key)
+        if expires is not None and expires > reactor.seconds():
+            return defer.succeed(result)
+        factory.etag = etag
+        factory.cachedResult = result
+        return None
+
+    def _cacheResponse(self, result, key, factory):
+        if factory.responseETag is None:
+            self.responses.pop(key, None)
+            return result
+        expires = None
+        if factory.responseMaxAge is not None:
+            expires = reactor.seconds() + factory.responseMaxAge
+        self.responses[key] = (factory.responseETag, result, expires)
+        self.responses.move_to_end(key)
+        while len(self.responses) > self.cache_size:
+            self.responses.popitem(last=False)
+        return result
+
+    def _sendBatch(self, batch):
+        factory = BatchQueryFactory(self.agent, self.url, batch, self.username,
+                                    self.password, self.compress)
+        factory.max_body_size = self.max_body_size
+        factory.timeout = self.timeout
+        self._send(factory)
 
 
-__all__ = ["JSONRPC", "Handler", "Proxy"]
+__all__ = ["JSONRPC", "JSONRPCSite", "Handler", "Limiter", "Proxy", "RawJSON", "cached", "in_process", "in_thread",
+           "limited", "single_flight"]
@@ -0,0 +1,29 @@
+"""
+A resource serving metrics in the Prometheus text format.
+"""
+from twisted.web import resource
+
+from txjsonrpc_ng.metrics import REGISTRY, prometheus
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serve a snapshot of metrics.Metrics to GET requests, e.g. at /metrics
+    next to a JSONRPC resource.
+
+    snapshot is called for every request; by default it is the snapshot
+    method of metrics.REGISTRY.
+    """
+
+    isLeaf = True
+
+    def __init__(self, snapshot=None):
+        resource.Resource.__init__(self)
+        self.snapshot = snapshot if snapshot is not None else REGISTRY.snapshot
+
+    def render_GET(self, request):
+        request.setHeader("content-type", "text/plain; version=0.0.4; charset=utf-8")
+        return prometheus(self.snapshot()).encode()
+
+
+__all__ = ["MetricsResource"]
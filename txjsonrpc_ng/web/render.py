@@ -1,96 +1,360 @@
 import abc
-import gzip
-import io
 import time
 from collections.abc import Callable
-from typing import Any, Optional
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
 
+from twisted.internet import reactor, task, threads
+from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IPushProducer
+from twisted.logger import Logger
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+from twisted.web import http
 from twisted.web.http import Request
+from zope.interface import implementer
 
-from .data import CacheableResult
+from txjsonrpc_ng import jsonrpclib
+from txjsonrpc_ng.metrics import Metrics
+from . import compression as encodings
+from .data import CacheableResult, StreamingResult
+
+_log = Logger()
+
+
+@dataclass
+class CompressionSettings:
+    # Responses smaller than this are sent uncompressed.
+    min_size: int = 1000
+    # Content codings offered to clients, in order of preference.
+    encodings: Tuple[str, ...] = encodings.PREFERENCE
+    # Compression level per coding name; codings not listed use their
+    # default level.
+    levels: Dict[str, int] = field(default_factory=dict)
+    # Responses of at least this size are compressed in a worker thread
+    # instead of the reactor thread; None compresses everything inline.
+    thread_threshold: Optional[int] = None
+    # Thread pool for compressing; None uses the reactor's thread pool.
+    thread_pool: Optional[ThreadPool] = None
+    # Log the sizes and duration of each compression at debug level. Off
+    # by default, as legacy log observers write debug events too; the
+    # metrics record compression anyway.
+    log_compression: bool = False
+
+
+DEFAULT_COMPRESSION = CompressionSettings()
 
 
 class Renderer(metaclass=abc.ABCMeta):
+    """
+    Write a response, compressed if the client accepts it.
+
+    render() returns None once the response has been written, or a
+    Deferred if it is written later because compression runs in a thread.
+    """
 
-    def __init__(self, id: str, version: int, request: Request):
+    def __init__(self, id: str, version: int, request: Request,
+                 compression: CompressionSettings = DEFAULT_COMPRESSION, metrics: Optional[Metrics] = None):
         self.id = id
         self.version = version
         self.request = request
+        self.compression = compression
+        self.metrics = metrics
+        self.request_lost = False
+
+    # Streaming renderers are passed a function returning an iterator of
+    # chunks instead of the complete response, hence the Any result of the
+    # function passed to render().
+    streaming = False
 
     @abc.abstractmethod
-    def render(self, string_renderer: Callable[[Any, str, int], str]) -> None:
+    def render(self, string_renderer: Callable[[Any, str, int], Any]) -> Optional[Deferred]:
         pass
 
-    def handle_compression(self, response_string: str, cached_response: Optional[bytes],
-                           cache_updater: Optional[Callable[[bytes], None]]) -> None:
-        compression = self.request.getHeader('Accept-encoding')
+    def handle_compression(self, response_string: Union[str, bytes],
+                           cache: Optional[Dict[str, bytes]]) -> Optional[Deferred]:
+        """
+        Write response_string, compressed with the coding negotiated with
+        the client. Compressed data is looked up in and added to cache,
+        keyed by coding name, unless cache is None.
+        """
+        if isinstance(response_string, str):
+            response_string = response_string.encode()
         original_size = len(response_string)
-        if compression == "gzip" and original_size >= 1000:
-            if cached_response is not None:
-                response_binary = cached_response
-            else:
-                start_time = time.time()
-                out_file = io.BytesIO()
-                with gzip.GzipFile(mode='wb', fileobj=out_file) as in_file:
-                    in_file.write(response_string.encode())
-                response_binary = out_file.getvalue()
-
-                compressed_size = len(response_binary)
-                elapsed_time = time.time() - start_time
-                break_even = (original_size - compressed_size) / elapsed_time / 1024 / 1024
-                print("renderer: compress data {} -> {} ({:.1f} %) in {:.2f} ms (break even at {:.1f} MB/s)".format(original_size,
-                                                                                                          compressed_size,
-                                                                                                          compressed_size * 100 / original_size,
-                                                                                                          elapsed_time * 1000,
-                                                                                                          break_even))
-                if cache_updater is not None:
-                    cache_updater(response_binary)
-
-            self.request.setHeader("content-encoding", "gzip")
+        if self.metrics is not None:
+            self.metrics.response_bytes.observe(original_size)
+        encoding = None
+        if original_size >= self.compression.min_size:
+            encoding = encodings.negotiate(self.request.getHeader('Accept-encoding'),
+                                           self.compression.encodings)
+            self.request.setHeader("vary", "Accept-Encoding")
+        if encoding is None:
+            self.write(response_string, None)
+            return None
+        if cache is not None and encoding in cache:
+            self.write(cache[encoding], encoding)
+            return None
+        start_time = time.time()
+        threshold = self.compression.thread_threshold
+        if threshold is not None and self.bytes_to_compress(response_string, encoding) >= threshold:
+            return self.compress_in_thread(response_string, encoding, start_time, cache)
+        self.write_compressed(self.compress(response_string, encoding), encoding, original_size,
+                              start_time, cache)
+        return None
+
+    def compress(self, response_string: bytes, encoding: str) -> bytes:
+        return encodings.encodings[encoding].compress(response_string, self.compression.levels.get(encoding))
+
+    def bytes_to_compress(self, response_string: bytes, encoding: str) -> int:
+        """
+        Return how many bytes compress() compresses for response_string,
+        which decides whether it runs in a thread.
+        """
+        return len(response_string)
+
+    def compress_in_thread(self, response_string: bytes, encoding: str, start_time: float,
+                           cache: Optional[Dict[str, bytes]]) -> Deferred:
+        def request_lost(failure):
+            self.request_lost = True
+
+        self.request.notifyFinish().addErrback(request_lost)
+        if self.compression.thread_pool is None:
+            d = threads.deferToThread(self.compress, response_string, encoding)
         else:
-            response_binary = response_string.encode()
+            d = threads.deferToThreadPool(reactor, self.compression.thread_pool, self.compress,
+                                          response_string, encoding)
+        d.addCallback(self.write_compressed, encoding, len(response_string), start_time, cache)
+
+        def compression_failed(failure):
+            log.err(failure, "renderer: compression failed, sending uncompressed data")
+            self.write(response_string, None)
 
+        d.addErrback(compression_failed)
+        return d
+
+    def write_compressed(self, response_binary: bytes, encoding: str, original_size: int, start_time: float,
+                         cache: Optional[Dict[str, bytes]]) -> None:
+        compressed_size = len(response_binary)
+        elapsed_time = time.time() - start_time
+        if self.metrics is not None:
+            self.metrics.record_compression(encoding, original_size, compressed_size, elapsed_time)
+        if self.compression.log_compression:
+            _log.debug(
+                "renderer: {encoding} compress data {original_size} -> {compressed_size} ({ratio:.1%}) "
+                "in {elapsed_ms:.2f} ms (break even at {break_even:.1f} MB/s)",
+                encoding=encoding, original_size=original_size, compressed_size=compressed_size,
+                ratio=compressed_size / original_size, elapsed_ms=elapsed_time * 1000,
+                break_even=(original_size - compressed_size) / max(elapsed_time, 1e-9) / 1024 / 1024)
+        if cache is not None:
+            cache[encoding] = response_binary
+        self.write(response_binary, encoding)
+
+    def write(self, response_binary: bytes, encoding: Optional[str]) -> None:
+        if self.request_lost:
+            return
+        if encoding is not None:
+            self.request.setHeader("content-encoding", encoding)
         self.request.setHeader(b"content-length", str(len(response_binary)))
         self.request.write(response_binary)
 
 
 class DefaultRenderer(Renderer):
 
-    def __init__(self, result: Any, id: str, version: int, request: Request):
-        super().__init__(id, version, request)
+    def __init__(self, result: Any, id: str, version: int, request: Request,
+                 compression: CompressionSettings = DEFAULT_COMPRESSION, metrics: Optional[Metrics] = None):
+        super().__init__(id, version, request, compression, metrics)
         self.result = result
 
-    def render(self, string_renderer: Callable[[Any, str, int], str]) -> None:
+    def render(self, string_renderer: Callable[[Any, str, int], bytes]) -> Optional[Deferred]:
         result_string = string_renderer(self.result, self.id, self.version)
 
-        self.handle_compression(result_string, None, None)
+        return self.handle_compression(result_string, None)
 
 
 class CacheableResultRenderer(Renderer):
+    """
+    Write the response for a CacheableResult, which is serialized only
+    once, around the envelope for the call. Compressed responses are kept
+    in the result for further calls, except JSONP responses, which are
+    compressed per call as their callback is chosen by the client; see
+    CacheableResult.
+    """
 
-    def __init__(self, result: CacheableResult, id: str, version: int, request: Request):
-        super().__init__(id, version, request)
+    def __init__(self, result: CacheableResult, id: str, version: int, request: Request,
+                 compression: CompressionSettings = DEFAULT_COMPRESSION, metrics: Optional[Metrics] = None,
+                 callback: Optional[Union[str, bytes]] = None):
+        super().__init__(id, version, request, compression, metrics)
         self.result = result
+        if isinstance(callback, str):
+            callback = callback.encode()
+        # The JSONP callback, if any.
+        self.callback = callback or None
+        # The key and value compress() found worth keeping in the result;
+        # stored by write_compressed() in the reactor thread, as compress()
+        # may run in a worker thread.
+        self.keep: Optional[Tuple[Tuple[str, int], Any]] = None
 
-    def render(self, call: Callable[[Any, str, int], str]) -> None:
-        if self.result.string_value is not None:
-            string_value = self.result.string_value
-        else:
-            string_value = call(self.result.value, self.id, self.version)
-            self.result.string_value = string_value
+    def render(self, call: Callable[[Any, str, int], bytes]) -> Optional[Deferred]:
+        try:
+            if self.result.body is None and self.metrics is not None:
+                self.metrics.serialization.time(self.result.serialized)
+            etag = self.result.etag
+        except Exception:
+            # Not serializable; the string renderer reports that.
+            return self.handle_compression(call(self.result.value, self.id, self.version), None)
+        self.request.setHeader("etag", etag)
+        if self.result.max_age is not None:
+            self.request.setHeader("cache-control", "max-age=%d" % self.result.max_age)
+        if etag_matches(self.request.getHeader("if-none-match"), etag):
+            self.request.setResponseCode(http.NOT_MODIFIED)
+            return None
+
+        return self.handle_compression(self.result.serialize(self.id, self.version, self.callback), None)
+
+    def compress(self, response_string: bytes, encoding: str) -> bytes:
+        coding = encodings.encodings[encoding]
+        level = self.compression.levels.get(encoding)
+        if self.callback is not None:
+            return coding.compress(response_string, level)
+        key = (encoding, self.version)
+        cached = self.result.compressed_values.get(key)
+        if isinstance(cached, bytes):
+            return cached
+        if self.version == jsonrpclib.VERSION_PRE1:
+            # Without id, the response is the same for all calls.
+            compressed = coding.compress(response_string, level)
+            self.keep = key, compressed
+            return compressed
+        prefix, suffix = self.result.envelope(self.id, self.version)
+        if cached is None:
+            cached = coding.begin(prefix + self.result.serialized(), level)
+            if cached is None:
+                return coding.compress(response_string, level)
+            self.keep = key, cached
+        return coding.finish(cached, suffix, level)
+
+    def write_compressed(self, response_binary: bytes, encoding: str, original_size: int, start_time: float,
+                         cache: Optional[Dict[str, bytes]]) -> None:
+        if self.keep is not None:
+            key, value = self.keep
+            self.keep = None
+            self.result.compressed_values.setdefault(key, value)
+        super().write_compressed(response_binary, encoding, original_size, start_time, cache)
+
+    def bytes_to_compress(self, response_string: bytes, encoding: str) -> int:
+        if self.callback is not None:
+            return len(response_string)
+        cached = self.result.compressed_values.get((encoding, self.version))
+        if isinstance(cached, bytes):
+            return 0
+        if cached is not None:
+            # Only the end with the id is left to compress.
+            return len(self.result.envelope(self.id, self.version)[1])
+        return len(response_string)
+
+
+@implementer(IPushProducer)
+class StreamingRenderer(Renderer):
+    """
+    Write a response chunk by chunk as it is encoded, compressing each chunk
+    on the fly. The response is sent with chunked transfer encoding, and
+    encoding pauses while the transport cannot keep up with the client.
+
+    Once data has been sent an error can no longer be reported to the
+    client, so the connection is dropped instead.
+    """
+    streaming = True
+
+    def __init__(self, result: StreamingResult, id: str, version: int, request: Request,
+                 compression: CompressionSettings = DEFAULT_COMPRESSION, metrics: Optional[Metrics] = None):
+        super().__init__(id, version, request, compression, metrics)
+        self.result = result
+        self.producer_task: Optional[task.CooperativeTask] = None
+        self.paused = False
+
+    def render(self, chunk_renderer: Callable[[Any, str, int], Any]) -> Optional[Deferred]:
+        # The size is not known in advance, so min_size does not apply.
+        encoding = encodings.negotiate(self.request.getHeader('Accept-encoding'),
+                                       self.compression.encodings)
+        self.request.setHeader("vary", "Accept-Encoding")
+        compressor = None
+        if encoding is not None:
+            self.request.setHeader("content-encoding", encoding)
+            compressor = encodings.encodings[encoding].compressor(self.compression.levels.get(encoding))
+        chunks: Iterator[bytes] = chunk_renderer(self.result.value, self.id, self.version)
+        self.producer_task = task.cooperate(self.write_chunks(chunks, compressor))
+        self.request.registerProducer(self, True)
+        d = self.producer_task.whenDone()
+        d.addCallbacks(self.written, self.failed)
+        return d
+
+    def write_chunks(self, chunks: Iterator[bytes], compressor) -> Iterator[None]:
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                self.request.write(chunk)
+            yield None
+        if compressor is not None:
+            self.request.write(compressor.flush())
+        if self.metrics is not None:
+            self.metrics.response_bytes.observe(size)
+
+    def written(self, _) -> None:
+        self.request.unregisterProducer()
+
+    def failed(self, failure) -> None:
+        if not self.request_lost:
+            log.err(failure, "renderer: streaming response failed, dropping connection")
+            self.request_lost = True
+            self.request.unregisterProducer()
+            self.request.loseConnection()
+
+    def pauseProducing(self) -> None:
+        if self.producer_task is not None and not self.paused:
+            self.paused = True
+            self.producer_task.pause()
+
+    def resumeProducing(self) -> None:
+        if self.producer_task is not None and self.paused:
+            self.paused = False
+            self.producer_task.resume()
+
+    def stopProducing(self) -> None:
+        self.request_lost = True
+        if self.producer_task is None:
+            return
+        try:
+            self.producer_task.stop()
+        except (task.TaskDone, task.TaskFailed):
+            pass
 
-        def update_value(compressed_value: bytes) -> None:
-            self.result.compressed_value = compressed_value
 
-        self.handle_compression(
-            string_value,
-            self.result.compressed_value,
-            update_value
-        )
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Return whether an If-None-Match header matches etag, using the weak
+    comparison required for If-None-Match.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == opaque:
+            return True
+    return False
 
 
-def renderer_factory(result, id, version, request: Request):
+def renderer_factory(result, id, version, request: Request,
+                     compression: CompressionSettings = DEFAULT_COMPRESSION, metrics: Optional[Metrics] = None,
+                     callback: Optional[Union[str, bytes]] = None):
     if isinstance(result, CacheableResult):
-        return CacheableResultRenderer(result, id, version, request)
+        return CacheableResultRenderer(result, id, version, request, compression, metrics, callback)
+    elif isinstance(result, StreamingResult):
+        return StreamingRenderer(result, id, version, request, compression, metrics)
     else:
-        return DefaultRenderer(result, id, version, request)
+        return DefaultRenderer(result, id, version, request, compression, metrics)
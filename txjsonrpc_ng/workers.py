@@ -0,0 +1,152 @@
+"""
+Running jsonrpc_ methods outside of the reactor thread, and as coroutines.
+
+Decorate CPU-bound or blocking methods with in_thread or in_process. The
+dispatchers of both servers then run them in a worker and send the result
+once it is available; exceptions are reported as Faults as usual.
+
+Methods defined with async def are run with run_coroutine.
+"""
+import asyncio
+import inspect
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from twisted.internet import defer, reactor, threads
+
+from txjsonrpc_ng.limits import uncancellable
+
+
+class ThreadExecutor:
+    """
+    Run calls in a twisted.python.threadpool.ThreadPool, or in the reactor's
+    thread pool if pool is None.
+
+    A pool which has not been started is started on first use and stopped
+    when the reactor shuts down. A call cannot be stopped once it has been
+    handed to the pool, so its Deferred is marked with uncancellable.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool
+
+    def run(self, function, *args, **kwargs):
+        if self.pool is None:
+            return uncancellable(threads.deferToThread(function, *args, **kwargs))
+        if not self.pool.started:
+            self.pool.start()
+            reactor.addSystemEventTrigger("during", "shutdown", self._stop)
+        return uncancellable(threads.deferToThreadPool(reactor, self.pool, function, *args, **kwargs))
+
+    def _stop(self):
+        if self.pool.started:
+            self.pool.stop()
+
+
+class ProcessExecutor:
+    """
+    Run calls in a concurrent.futures process pool.
+
+    Without a pool, a ProcessPoolExecutor with up to max_workers processes
+    is created on first use. It starts worker processes only when calls are
+    waiting and none is idle, and is shut down with the reactor. Its workers
+    are spawned rather than forked, as forking the reactor process is
+    unsafe.
+
+    The function and its arguments and result are pickled, so the function
+    must be importable from its module: use module level functions or
+    static methods.
+
+    Cancelling a call removes it from the pool if no worker has started it
+    yet. A running call cannot be stopped; cancelling its Deferred merely
+    fails it, and a Limiter keeps its slot until it has finished.
+    """
+
+    def __init__(self, pool=None, max_workers=None):
+        self.pool = pool
+        self.max_workers = max_workers
+
+    def run(self, function, *args, **kwargs):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            reactor.addSystemEventTrigger("during", "shutdown", self.pool.shutdown, cancel_futures=True)
+        future = self.pool.submit(function, *args, **kwargs)
+        d = defer.Deferred(lambda _: future.cancel())
+        future.add_done_callback(lambda future: reactor.callFromThread(self._done, future, d))
+        return uncancellable(d, future.cancel)
+
+    def _done(self, future, d):
+        if d.called:
+            # Cancelled.
+            return
+        if future.cancelled():
+            d.errback(defer.CancelledError())
+            return
+        exception = future.exception()
+        if exception is not None:
+            d.errback(exception)
+        else:
+            d.callback(future.result())
+
+
+def run_coroutine(function, *args, **kwargs):
+    """
+    Call a coroutine function; return a Deferred for its result. Cancelling
+    the Deferred cancels the coroutine.
+
+    With the asyncio reactor, the coroutine runs as an asyncio Task, so it
+    can use asyncio libraries like asyncio database drivers; it awaits a
+    Deferred d with d.asFuture(asyncio.get_running_loop()). With other
+    reactors it runs with Deferred.fromCoroutine and awaits Deferreds and
+    other coroutines only.
+    """
+    coroutine = function(*args, **kwargs)
+    if not _asyncio_reactor():
+        return defer.Deferred.fromCoroutine(coroutine)
+    d = defer.Deferred.fromFuture(asyncio.ensure_future(coroutine))
+
+    def cancelled(failure):
+        # Report cancelling like other Deferreds do.
+        failure.trap(asyncio.CancelledError)
+        raise defer.CancelledError()
+
+    return d.addErrback(cancelled)
+
+
+def _asyncio_reactor():
+    module = sys.modules.get("twisted.internet.asyncioreactor")
+    return module is not None and isinstance(reactor, module.AsyncioSelectorReactor)
+
+
+def _check_not_coroutine(method):
+    if inspect.iscoroutinefunction(method):
+        raise TypeError("%s is a coroutine function, which runs in the reactor thread" % method.__name__)
+
+
+def in_thread(pool=None):
+    """
+    Decorator to run a jsonrpc_ method in a thread pool; see ThreadExecutor.
+    """
+    def decorator(method):
+        _check_not_coroutine(method)
+        method.executor = ThreadExecutor(pool)
+        return method
+
+    return decorator
+
+
+def in_process(pool=None, max_workers=None):
+    """
+    Decorator to run a jsonrpc_ method in a process pool; see
+    ProcessExecutor.
+    """
+    def decorator(method):
+        _check_not_coroutine(method)
+        method.executor = ProcessExecutor(pool, max_workers)
+        return method
+
+    return decorator
+
+
+__all__ = ["ProcessExecutor", "ThreadExecutor", "in_process", "in_thread", "run_coroutine"]